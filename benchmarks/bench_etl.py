@@ -0,0 +1,227 @@
+"""
+Бенчмарк сервиса на синтетических данных.
+
+Создает синтетическую схему content в отдельной БД (по умолчанию etl_bench на сервере из переменных окружения
+DB_HOST, DB_PORT, POSTGRES_USER, POSTGRES_PASSWORD), запускает локальную замену Elasticsearch и прогоняет
+первичную загрузку и сканирование обновлений кодом сервиса. Для каждого этапа выводит количество документов
+в секунду, пиковое потребление памяти и время по этапам конвейера, запросам к БД и bulk-запросам.
+Запуск из корня репозитория:
+
+    python -m benchmarks.bench_etl --films 10000 --es-latency 0.005 --es-reject 0.01
+
+Результаты можно сохранить в JSON (--json) и сравнить с результатами до изменения.
+"""
+import argparse
+import json
+import logging
+import resource
+import time
+from typing import Dict, List
+
+from benchmarks.fake_es import FakeElasticsearch
+from benchmarks.synthetic_data import generate, get_settings, touch
+from postgres_to_es import main as service
+from postgres_to_es.elastic_loader import ESLoader, load_all_files
+from postgres_to_es.extract import (PostgresExctract, get_all_film_to_upload,
+                                    get_initial_watermark)
+from postgres_to_es.metrics import (BULK_DURATION, QUERY_DURATION,
+                                    STAGE_SECONDS, Metric)
+from postgres_to_es.models import FilmWorkTables, GenreTables, PersonTables
+from postgres_to_es.utils import BaseStorage, State
+
+INDEX = 'movies_bench'
+
+
+class MemoryStorage(BaseStorage):
+    """Хранение состояния в памяти: бенчмарк не должен трогать состояние сервиса"""
+
+    def __init__(self):
+        self.state = {}
+
+    def save_state(self, state: dict) -> None:
+        self.state = dict(state)
+
+    def retrieve_state(self) -> dict:
+        return dict(self.state)
+
+
+def metric_totals(metric: Metric) -> Dict[str, float]:
+    """
+    Текущие значения метрики по наборам меток, для гистограмм - сумма наблюдений
+    :param metric: метрика
+    :return: словарь {метки: значение}
+    """
+    with metric._lock:
+        values = dict(metric._values)
+    return {'/'.join(key) or metric.name: value[1] if isinstance(value, tuple) else value
+            for key, value in values.items()}
+
+
+def snapshot() -> Dict[str, Dict[str, float]]:
+    """Снимок метрик времени по этапам"""
+    return {
+        'stage': metric_totals(STAGE_SECONDS),
+        'query': metric_totals(QUERY_DURATION),
+        'bulk': metric_totals(BULK_DURATION),
+    }
+
+
+def reset_peak_rss() -> bool:
+    """
+    Сброс пикового потребления памяти процессом (VmHWM) перед этапом, доступно только в Linux
+    :return: True, если пик сброшен и peak_rss вернет пик за этап
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def read_vm_hwm() -> float:
+    """Пиковое потребление памяти процессом с последнего сброса в Мб по /proc/self/status"""
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    raise OSError('VmHWM не найден в /proc/self/status')
+
+
+def peak_rss(phase_reset: bool) -> Dict[str, float]:
+    """
+    Пиковое потребление памяти процессом и дочерними процессами в Мб.
+    ru_maxrss - пик за все время работы процесса, поэтому пик за этап берется из VmHWM, если его удалось сбросить
+    перед этапом. Для дочерних процессов ru_maxrss - пик самого большого из завершенных процессов за все время работы
+    :param phase_reset: пик процесса был сброшен перед этапом
+    :return: словарь с пиком процесса, его областью (phase/process) и пиком дочерних процессов
+    """
+    self_mb, scope = None, 'process'
+    if phase_reset:
+        try:
+            self_mb, scope = read_vm_hwm(), 'phase'
+        except OSError:
+            pass
+    if self_mb is None:
+        self_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        'self_mb': self_mb,
+        'self_scope': scope,
+        'children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def phase_result(name: str, docs: int, elapsed: float, before: dict, phase_reset: bool) -> dict:
+    """
+    Результат этапа бенчмарка: скорость, память и время по этапам, накопленное за время этапа
+    :param name: название этапа
+    :param docs: количество загруженных документов
+    :param elapsed: время этапа в секундах
+    :param before: снимок метрик до начала этапа
+    :param phase_reset: результат reset_peak_rss перед началом этапа
+    :return: словарь результата
+    """
+    after = snapshot()
+    timings = {group: {key: value - before[group].get(key, 0) for key, value in values.items()
+                       if value - before[group].get(key, 0) > 0}
+               for group, values in after.items()}
+    return {'phase': name, 'docs': docs, 'seconds': elapsed, 'docs_per_sec': docs / elapsed if elapsed else 0,
+            'rss': peak_rss(phase_reset), 'timings': timings}
+
+
+def run_full_load(postgres: PostgresExctract, esl: ESLoader, es: FakeElasticsearch, args) -> dict:
+    before, indexed = snapshot(), es.stats['indexed']
+    phase_reset = reset_peak_rss()
+    started = time.perf_counter()
+    film_data = get_all_film_to_upload(postgres, args.page_size)
+    load_all_files(film_data, esl, INDEX, queue_size=args.queue_size, workers=args.workers)
+    return phase_result('full_load', es.stats['indexed'] - indexed, time.perf_counter() - started, before,
+                        phase_reset)
+
+
+def run_incremental(postgres: PostgresExctract, esl: ESLoader, es: FakeElasticsearch, settings: dict, args) -> dict:
+    tables = [
+        PersonTables(['content.person', 'content.person_film_work', 'pfw.person_id']),
+        GenreTables(['content.genre', 'content.genre_film_work', 'pfw.genre_id']),
+        FilmWorkTables(['content.film_work', '']),
+    ]
+    state = State(MemoryStorage())
+    watermark = get_initial_watermark(postgres)
+    for table in tables:
+        state.set_state(table.table_to_check_update, watermark)
+    touch(settings, films=args.touch_films, persons=args.touch_persons, genres=args.touch_genres, seed=args.seed)
+
+    before, indexed = snapshot(), es.stats['indexed']
+    phase_reset = reset_peak_rss()
+    started = time.perf_counter()
+    while service.update_cycle(postgres, esl, state, tables):
+        pass
+    return phase_result('incremental', es.stats['indexed'] - indexed, time.perf_counter() - started, before,
+                        phase_reset)
+
+
+def print_result(result: dict) -> None:
+    rss = result['rss']
+    scope = 'за этап' if rss['self_scope'] == 'phase' else 'за все время работы процесса'
+    print(f'\n{result["phase"]}: {result["docs"]} документов за {result["seconds"]:.2f} с, '
+          f'{result["docs_per_sec"]:.0f} док/с, пиковая память {rss["self_mb"]:.0f} Мб {scope} '
+          f'(дочерние процессы {rss["children_mb"]:.0f} Мб за все время работы)')
+    for group, values in result['timings'].items():
+        for key, value in sorted(values.items(), key=lambda item: -item[1]):
+            print(f'    {group:<6} {key:<32} {value:8.3f} с')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--films', type=int, default=10000)
+    parser.add_argument('--db-name', default='etl_bench')
+    parser.add_argument('--skip-generate', action='store_true', help='использовать уже созданные данные')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--es-latency', type=float, default=0, help='задержка ответа ES в секундах')
+    parser.add_argument('--es-reject', type=float, default=0, help='доля документов, отклоняемых с кодом 429')
+    parser.add_argument('--page-size', type=int, default=service.PAGE_SIZE)
+    parser.add_argument('--bulk-docs', type=int, default=service.BULK_MAX_DOCS)
+    parser.add_argument('--concurrency', type=int, default=service.BULK_CONCURRENCY)
+    parser.add_argument('--compress', action='store_true')
+    parser.add_argument('--queue-size', type=int, default=service.PIPELINE_QUEUE_SIZE)
+    parser.add_argument('--workers', type=int, default=service.TRANSFORM_WORKERS)
+    parser.add_argument('--batch-size', type=int, default=service.UPDATE_BATCH_SIZE)
+    parser.add_argument('--touch-films', type=int, default=100)
+    parser.add_argument('--touch-persons', type=int, default=100)
+    parser.add_argument('--touch-genres', type=int, default=1)
+    parser.add_argument('--json', help='файл для сохранения результатов')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    settings = get_settings(args.db_name)
+    if not args.skip_generate:
+        started = time.perf_counter()
+        counts = generate(settings, args.films, seed=args.seed)
+        print(f'Синтетические данные за {time.perf_counter() - started:.1f} с: {counts}')
+
+    # сканирование обновлений берет индекс и размер пачки из настроек модуля main
+    service.INDEX = INDEX
+    service.UPDATE_BATCH_SIZE = args.batch_size
+    service.PIPELINE_QUEUE_SIZE = args.queue_size
+
+    es = FakeElasticsearch(latency=args.es_latency, reject=args.es_reject, seed=args.seed).start()
+    postgres = PostgresExctract(settings)
+    esl = ESLoader(es.url, args.bulk_docs, compress=args.compress, concurrency=args.concurrency)
+    results: List[dict] = []
+    try:
+        results.append(run_full_load(postgres, esl, es, args))
+        results.append(run_incremental(postgres, esl, es, settings, args))
+    finally:
+        esl.close()
+        postgres.close()
+        es.shutdown()
+    for result in results:
+        print_result(result)
+    print(f'\nES: {es.stats}')
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'args': vars(args), 'results': results, 'es': es.stats}, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Микробенчмарк сериализации тела bulk-запроса.
+
+Сравнивает прежний способ (json.dumps строки действия и документа, склейка строк и encode)
+с BulkPayload на orjson и на стандартном json. Запуск из корня репозитория:
+
+    python -m benchmarks.bench_serializer --docs 20000
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+
+from postgres_to_es import serializer
+from postgres_to_es.serializer import BulkPayload
+
+ORJSON = serializer.orjson
+
+
+def make_documents(count: int, seed: int = 0) -> list:
+    """
+    Документы фильмов в формате индекса с реалистичным количеством участников и жанров
+    :param count: количество документов
+    :param seed: начальное значение генератора случайных чисел
+    :return: список документов
+    """
+    rnd = random.Random(seed)
+    documents = []
+    for i in range(count):
+        actors = [{'id': str(uuid.UUID(int=rnd.getrandbits(128))), 'name': f'Актер Фамилия {rnd.randint(1, 10 ** 5)}'}
+                  for _ in range(rnd.randint(3, 25))]
+        writers = [{'id': str(uuid.UUID(int=rnd.getrandbits(128))), 'name': f'Writer Name {rnd.randint(1, 10 ** 5)}'}
+                   for _ in range(rnd.randint(1, 5))]
+        documents.append({
+            'id': str(uuid.UUID(int=rnd.getrandbits(128))),
+            'title': f'Фильм номер {i}',
+            'description': ' '.join(f'слово{rnd.randint(1, 1000)}' for _ in range(rnd.randint(20, 80))),
+            'rating': round(rnd.uniform(0, 10), 1),
+            'genre': rnd.sample(['Action', 'Drama', 'Comedy', 'Sci-Fi', 'Thriller', 'Documentary'], 2),
+            'actors': actors,
+            'actors_names': [actor['name'] for actor in actors],
+            'director': [f'Director {rnd.randint(1, 1000)}'],
+            'writers': writers,
+            'writers_names': [writer['name'] for writer in writers],
+        })
+    return documents
+
+
+def legacy_body(rows: list, index_name: str) -> bytes:
+    """Тело bulk-запроса так, как его собирал ESLoader до BulkPayload"""
+    prepared_query = []
+    for row in rows:
+        prepared_query.extend([json.dumps({'index': {'_index': index_name, '_id': row['id']}}), json.dumps(row)])
+    return ('\n'.join(prepared_query) + '\n').encode()
+
+
+def payload_body(rows: list, index_name: str) -> memoryview:
+    """Тело bulk-запроса через BulkPayload"""
+    payload = BulkPayload()
+    for row in rows:
+        payload.add(row['id'], {'index': {'_index': index_name, '_id': row['id']}}, row)
+    return payload.body(payload.operations)
+
+
+def use_orjson(enabled: bool) -> None:
+    """Переключаем сериализатор между orjson и стандартным json"""
+    serializer.orjson = ORJSON if enabled else None
+
+
+def measure(variants: list, documents: list, repeat: int) -> list:
+    """
+    Лучшее время каждого варианта из repeat запусков. Варианты запускаются по очереди в каждом круге,
+    чтобы колебания нагрузки на машине одинаково влияли на все варианты
+    :param variants: список (название, функция, использовать orjson)
+    :return: список (название, время в секундах)
+    """
+    best = [float('inf')] * len(variants)
+    try:
+        for _ in range(repeat):
+            for i, (_, func, orjson) in enumerate(variants):
+                use_orjson(orjson)
+                started = time.perf_counter()
+                func(documents, 'movies')
+                best[i] = min(best[i], time.perf_counter() - started)
+    finally:
+        use_orjson(True)
+    return [(name, elapsed) for (name, _, _), elapsed in zip(variants, best)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    documents = make_documents(args.docs)
+    size = len(legacy_body(documents, 'movies'))
+    print(f'{args.docs} документов, тело запроса {size / 1024 / 1024:.1f} Мб')
+
+    variants = [('json.dumps + join (прежний способ)', legacy_body, False)]
+    if ORJSON is not None:
+        variants.append(('BulkPayload + orjson', payload_body, True))
+    variants.append(('BulkPayload + json', payload_body, False))
+    results = measure(variants, documents, args.repeat)
+
+    baseline = results[0][1]
+    for name, elapsed in results:
+        print(f'{name:<38} {elapsed * 1000:8.1f} мс  {args.docs / elapsed:10.0f} док/с  x{baseline / elapsed:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+Бенчмарк сканирования обновлений несколькими экземплярами сервиса.
+
+Создает синтетическую схему content в отдельной БД (по умолчанию etl_bench, см. bench_etl), запускает локальную
+замену Elasticsearch и для каждого количества экземпляров из --workers запускает процессы сервиса
+(python -m postgres_to_es.main) с WORKER_PARTITIONS. Когда экземпляры распределили партиции, изменяет записи
+и ждет, пока все затронутые фильмы не будут загружены. Для каждого запуска выводит документы в секунду с момента
+первой записи в ES, потерянные фильмы и количество записей документов в ES. С --kill один экземпляр завершается
+через SIGKILL после загрузки половины фильмов, его партиции должны забрать остальные экземпляры.
+Запуск из корня репозитория:
+
+    python -m benchmarks.bench_workers --films 20000 --workers 1 2 --es-latency 0.005
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Dict, List, Set
+
+import psycopg2
+
+from benchmarks.fake_es import FakeElasticsearch
+from benchmarks.synthetic_data import generate, get_settings, touch
+from postgres_to_es.coordinator import PARTITION_LOCK, WORKER_LOCK
+from postgres_to_es.elastic_loader import FULL_LOAD_COMPLETED
+from postgres_to_es.extract import PostgresExctract, get_initial_watermark
+from postgres_to_es.models import FilmWorkTables, GenreTables, PersonTables
+from postgres_to_es.utils import PostgresStorage, State
+
+INDEX = 'movies_bench'
+
+LOCKS_REQUEST = """
+SELECT pid, count(*)
+FROM pg_locks
+WHERE locktype = 'advisory' AND classid = %s AND objsubid = 2 AND granted
+GROUP BY pid
+"""
+
+EXPECTED_FILMS_REQUEST = """
+SELECT id FROM content.film_work WHERE updated_at > %(updated_at)s
+UNION
+SELECT pfw.film_work_id FROM content.person_film_work pfw
+JOIN content.person p ON p.id = pfw.person_id
+WHERE p.updated_at > %(updated_at)s
+UNION
+SELECT gfw.film_work_id FROM content.genre_film_work gfw
+JOIN content.genre g ON g.id = gfw.genre_id
+WHERE g.updated_at > %(updated_at)s
+"""
+
+
+def query(settings: Dict[str, str], sql: str, params=None) -> list:
+    connection = psycopg2.connect(**settings)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+    finally:
+        connection.close()
+
+
+def reset_state(settings: Dict[str, str]) -> dict:
+    """
+    Общее состояние экземпляров: первичная загрузка завершена, отметки таблиц - текущее время БД
+    :param settings: настройки подключения к БД бенчмарка
+    :return: отметка
+    """
+    storage = PostgresStorage(settings)
+    storage._execute(f'DELETE FROM {storage.table}')
+    postgres = PostgresExctract(settings)
+    try:
+        watermark = get_initial_watermark(postgres)
+    finally:
+        postgres.close()
+    state = State(storage)
+    state.set_state(FULL_LOAD_COMPLETED, True)
+    for table in (PersonTables(['content.person', 'content.person_film_work', 'pfw.person_id']),
+                  GenreTables(['content.genre', 'content.genre_film_work', 'pfw.genre_id']),
+                  FilmWorkTables(['content.film_work', ''])):
+        state.set_state(table.table_to_check_update, watermark)
+    state.close()
+    return watermark
+
+
+def start_workers(count: int, es: FakeElasticsearch, args) -> List[subprocess.Popen]:
+    env = dict(os.environ, DB_NAME=args.db_name, URL=es.url, INDEX=INDEX, WORKER_PARTITIONS=str(args.partitions),
+               SLEEP_TIME='1', UPDATE_BATCH_SIZE=str(args.batch_size), METRICS_PORT='0', NOTIFY_MODE='false',
+               POLL_ADAPTIVE='false', ASYNC_MODE='false', FINGERPRINT_DB='', INDEX_VERSION='')
+    log = open(args.log, 'ab') if args.log else subprocess.DEVNULL
+    return [subprocess.Popen([sys.executable, '-m', 'postgres_to_es.main'], env=env, stdout=log,
+                             stderr=subprocess.STDOUT) for _ in range(count)]
+
+
+def wait_balanced(settings: Dict[str, str], count: int, args, timeout: float = 60) -> None:
+    """
+    Ждем, пока все экземпляры не займут слоты и не разделят партиции поровну
+    :param settings: настройки подключения к БД бенчмарка
+    :param count: количество экземпляров
+    :param args: аргументы бенчмарка
+    :param timeout: максимальное время ожидания в секундах
+    :return:
+    """
+    share = -(-args.partitions // count)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        workers = query(settings, LOCKS_REQUEST, (WORKER_LOCK,))
+        partitions = [owned for _, owned in query(settings, LOCKS_REQUEST, (PARTITION_LOCK,))]
+        if len(workers) == count and sum(partitions) == args.partitions and max(partitions) <= share:
+            return
+        time.sleep(0.1)
+    raise TimeoutError('Экземпляры сервиса не распределили партиции')
+
+
+def stop_workers(workers: List[subprocess.Popen]) -> None:
+    for worker in workers:
+        if worker.poll() is None:
+            worker.send_signal(signal.SIGTERM)
+    for worker in workers:
+        worker.wait(30)
+
+
+def run(count: int, settings: Dict[str, str], args) -> dict:
+    """
+    Запуск сканирования обновлений count экземплярами сервиса
+    :param count: количество экземпляров
+    :param settings: настройки подключения к БД бенчмарка
+    :param args: аргументы бенчмарка
+    :return: словарь результата
+    """
+    es = FakeElasticsearch(latency=args.es_latency, seed=args.seed).start()
+    watermark = reset_state(settings)
+    workers = start_workers(count, es, args)
+    killed = False
+    try:
+        wait_balanced(settings, count, args)
+        touch(settings, films=args.touch_films, persons=args.touch_persons, genres=args.touch_genres, seed=args.seed)
+        expected: Set[str] = {str(row[0]) for row in query(settings, EXPECTED_FILMS_REQUEST, watermark)}
+        # время считается с первой записи в ES, чтобы не учитывать паузу между сканированиями
+        started = None
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            with es.lock:
+                indexed = expected & set(es.writes)
+            if indexed and started is None:
+                started = time.perf_counter()
+            if len(indexed) == len(expected):
+                break
+            if args.kill and count > 1 and not killed and len(indexed) * 2 >= len(expected):
+                workers[-1].kill()
+                killed = True
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - started if started else 0
+    finally:
+        stop_workers(workers)
+        es.shutdown()
+    writes = sum(es.writes[film_id] for film_id in expected)
+    return {'workers': count, 'expected': len(expected), 'lost': len(expected - indexed), 'seconds': elapsed,
+            'docs_per_sec': len(indexed) / elapsed if elapsed else 0, 'writes': writes,
+            'repeated': writes - len(indexed), 'killed': killed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--films', type=int, default=20000)
+    parser.add_argument('--db-name', default='etl_bench')
+    parser.add_argument('--skip-generate', action='store_true', help='использовать уже созданные данные')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2], help='количество экземпляров сервиса')
+    parser.add_argument('--partitions', type=int, default=8)
+    parser.add_argument('--es-latency', type=float, default=0.005, help='задержка ответа ES в секундах')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--touch-films', type=int, default=2000)
+    parser.add_argument('--touch-persons', type=int, default=200)
+    parser.add_argument('--touch-genres', type=int, default=0)
+    parser.add_argument('--kill', action='store_true', help='завершить один экземпляр после загрузки половины фильмов')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--log', help='файл для вывода экземпляров сервиса')
+    args = parser.parse_args()
+
+    settings = get_settings(args.db_name)
+    if not args.skip_generate:
+        started = time.perf_counter()
+        counts = generate(settings, args.films, seed=args.seed)
+        print(f'Синтетические данные за {time.perf_counter() - started:.1f} с: {counts}')
+
+    results = [run(count, settings, args) for count in args.workers]
+    base = results[0]
+    for result in results:
+        print(f'{result["workers"]} экз.: {result["expected"]} фильмов за {result["seconds"]:.2f} с, '
+              f'{result["docs_per_sec"]:.0f} док/с, ускорение {result["docs_per_sec"] / base["docs_per_sec"]:.2f}, '
+              f'потеряно {result["lost"]}, записей в ES {result["writes"]} (повторных {result["repeated"]})'
+              + (', один экземпляр завершен SIGKILL' if result['killed'] else ''))
+
+
+if __name__ == '__main__':
+    main()
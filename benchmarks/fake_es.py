@@ -0,0 +1,238 @@
+"""
+Локальная замена Elasticsearch для бенчмарков.
+
+Поддерживает запросы, которые выполняет сервис: создание и проверку индекса, _bulk, настройки индекса,
+_refresh, _forcemerge, псевдонимы и удаление индекса. Частичное обновление скриптом выполняется только для
+скрипта замены названий сервиса (RENAME_SCRIPT) на Python. Документы хранятся в памяти. Задержка ответа,
+доля отклоненных с кодом 429 документов и максимальный размер bulk-запроса настраиваются. Отдельный запуск:
+
+    python -m benchmarks.fake_es --port 9200 --latency 0.01 --reject 0.05
+"""
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+def apply_rename(document: dict, changes: list) -> None:
+    """
+    Повторяет на Python скрипт замены названий RENAME_SCRIPT
+    :param document: документ
+    :param changes: параметр changes скрипта
+    :return:
+    """
+    for change in changes:
+        for field in change['objects']:
+            for item in document.get(field) or []:
+                if item['id'] == change['id']:
+                    item['name'] = change['new_name']
+        for field, objects in change['names'].items():
+            if document.get(objects) is not None:
+                document[field] = sorted({item['name'] for item in document[objects]})
+        document.update(change['values'])
+
+
+class FakeElasticsearch(ThreadingHTTPServer):
+    """
+    HTTP-сервер, отвечающий как Elasticsearch
+    :param port: порт, 0 - любой свободный
+    :param latency: задержка ответа на каждый запрос в секундах
+    :param reject: доля документов bulk-запроса, отклоняемых с кодом 429
+    :param seed: начальное значение генератора случайных чисел
+    :param max_bytes: максимальный размер тела bulk-запроса в байтах, как http.max_content_length, больший запрос
+                      отклоняется с кодом 413, 0 - без ограничения
+    """
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0, reject: float = 0, seed: int = 0, max_bytes: int = 0):
+        super().__init__(('127.0.0.1', port), FakeElasticsearchHandler)
+        self.latency = latency
+        self.reject = reject
+        self.max_bytes = max_bytes
+        self.random = random.Random(seed)
+        self.indices = {}
+        self.aliases = {}
+        self.stats = {'requests': 0, 'bulk_requests': 0, 'bulk_bytes': 0, 'indexed': 0, 'updated': 0, 'deleted': 0,
+                      'rejected': 0}
+        # количество записей каждого документа, чтобы находить потерянные и повторные обновления
+        self.writes = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+    def start(self) -> 'FakeElasticsearch':
+        """Запуск сервера в фоновом потоке"""
+        threading.Thread(target=self.serve_forever, name='fake-es', daemon=True).start()
+        return self
+
+    def resolve(self, name: str) -> str:
+        return self.aliases.get(name, name)
+
+    def bulk(self, body: bytes) -> dict:
+        """
+        Выполнение bulk-запроса
+        :param body: тело запроса в формате NDJSON
+        :return: ответ в формате Elasticsearch
+        """
+        lines = body.splitlines()
+        items = []
+        errors = False
+        position = 0
+        with self.lock:
+            self.stats['bulk_requests'] += 1
+            self.stats['bulk_bytes'] += len(body)
+            while position < len(lines):
+                if not lines[position]:
+                    position += 1
+                    continue
+                action = json.loads(lines[position])
+                operation, meta = next(iter(action.items()))
+                document = None
+                if operation in ('index', 'create', 'update'):
+                    document = json.loads(lines[position + 1])
+                    position += 2
+                else:
+                    position += 1
+                if self.random.random() < self.reject:
+                    errors = True
+                    self.stats['rejected'] += 1
+                    items.append({operation: {'_id': meta['_id'], 'status': 429,
+                                              'error': {'type': 'es_rejected_execution_exception'}}})
+                    continue
+                docs = self.indices.setdefault(self.resolve(meta['_index']), {'settings': {}, 'docs': {}})['docs']
+                if operation == 'delete':
+                    status = 200 if docs.pop(meta['_id'], None) is not None else 404
+                    self.stats['deleted'] += 1
+                elif operation == 'update':
+                    status = 200 if meta['_id'] in docs else 404
+                    if status == 200 and 'doc' in document:
+                        docs[meta['_id']].update(document['doc'])
+                    elif status == 200 and 'script' in document:
+                        apply_rename(docs[meta['_id']], document['script']['params']['changes'])
+                    self.stats['updated'] += status == 200
+                    if status == 404:
+                        errors = True
+                        items.append({operation: {'_id': meta['_id'], 'status': status,
+                                                  'error': {'type': 'document_missing_exception'}}})
+                        continue
+                else:
+                    docs[meta['_id']] = document
+                    status = 201
+                    self.stats['indexed'] += 1
+                    self.writes[meta['_id']] += 1
+                items.append({operation: {'_id': meta['_id'], 'status': status}})
+        return {'took': 1, 'errors': errors, 'items': items}
+
+
+class FakeElasticsearchHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: FakeElasticsearch
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def _send(self, status: int, result: dict, with_body: bool = True) -> None:
+        body = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def _parts(self) -> list:
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        return [part for part in urlparse(self.path).path.split('/') if part]
+
+    def do_HEAD(self):
+        parts = self._parts()
+        found = parts and self.server.resolve(parts[0]) in self.server.indices
+        self._send(200 if found else 404, {}, with_body=False)
+
+    def do_GET(self):
+        parts = self._parts()
+        if parts and parts[0] == '_alias':
+            index = self.server.aliases.get(parts[1]) if len(parts) > 1 else None
+            if index is None:
+                self._send(404, {'error': 'alias missing'})
+            else:
+                self._send(200, {index: {'aliases': {parts[1]: {}}}})
+            return
+        index = self.server.resolve(parts[0]) if parts else None
+        if index not in self.server.indices:
+            self._send(404, {'error': 'index_not_found_exception'})
+            return
+        self._send(200, {index: {'settings': self.server.indices[index]['settings']}})
+
+    def do_PUT(self):
+        parts = self._parts()
+        body = json.loads(self._read_body() or b'{}')
+        if len(parts) > 1 and parts[1] == '_settings':
+            self.server.indices[self.server.resolve(parts[0])]['settings'].update(body.get('index', body))
+            self._send(200, {'acknowledged': True})
+        elif parts[0] in self.server.indices:
+            self._send(400, {'error': {'type': 'resource_already_exists_exception'}})
+        else:
+            self.server.indices[parts[0]] = {'settings': body.get('settings', {}), 'docs': {}}
+            self._send(200, {'acknowledged': True, 'index': parts[0]})
+
+    def do_DELETE(self):
+        parts = self._parts()
+        self._read_body()
+        found = self.server.indices.pop(self.server.resolve(parts[0]), None) is not None
+        self._send(200 if found else 404, {'acknowledged': found})
+
+    def do_POST(self):
+        parts = self._parts()
+        body = self._read_body()
+        if parts[-1] == '_bulk' and self.server.max_bytes and len(body) > self.server.max_bytes:
+            self._send(413, {'error': 'Request Entity Too Large'})
+        elif parts[-1] == '_bulk':
+            self._send(200, self.server.bulk(body))
+        elif parts[-1] == '_aliases':
+            for action in json.loads(body)['actions']:
+                if 'remove_index' in action:
+                    self.server.indices.pop(action['remove_index']['index'], None)
+                if 'remove' in action:
+                    self.server.aliases.pop(action['remove']['alias'], None)
+                if 'add' in action:
+                    self.server.aliases[action['add']['alias']] = action['add']['index']
+            self._send(200, {'acknowledged': True})
+        else:
+            self._send(200, {'acknowledged': True})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=9200)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--reject', type=float, default=0)
+    parser.add_argument('--max-bytes', type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeElasticsearch(args.port, args.latency, args.reject, max_bytes=args.max_bytes)
+    print(f'Fake Elasticsearch: {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.stats)
+
+
+if __name__ == '__main__':
+    main()
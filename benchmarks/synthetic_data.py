@@ -0,0 +1,194 @@
+"""
+Генератор синтетической схемы content для бенчмарков.
+
+Создает таблицы film_work, person, genre, person_film_work и genre_film_work в отдельной БД
+и заполняет их через COPY. На фильм приходится 1-3 жанра, 1-2 режиссера, 1-3 сценариста и 5-20 актеров,
+участники выбираются из общего списка, поэтому один человек участвует в нескольких фильмах.
+Отдельный запуск:
+
+    python -m benchmarks.synthetic_data --films 10000
+"""
+import argparse
+import io
+import os
+import random
+import uuid
+from typing import Dict, List
+
+import psycopg2
+
+SCHEMA = """
+DROP SCHEMA IF EXISTS content CASCADE;
+CREATE SCHEMA content;
+CREATE TABLE content.film_work (
+    id uuid PRIMARY KEY,
+    title text NOT NULL,
+    description text,
+    rating double precision,
+    updated_at timestamp with time zone NOT NULL DEFAULT now()
+);
+CREATE TABLE content.person (
+    id uuid PRIMARY KEY,
+    full_name text NOT NULL,
+    updated_at timestamp with time zone NOT NULL DEFAULT now()
+);
+CREATE TABLE content.genre (
+    id uuid PRIMARY KEY,
+    name text NOT NULL,
+    updated_at timestamp with time zone NOT NULL DEFAULT now()
+);
+CREATE TABLE content.person_film_work (
+    id uuid PRIMARY KEY,
+    film_work_id uuid NOT NULL REFERENCES content.film_work (id) ON DELETE CASCADE,
+    person_id uuid NOT NULL REFERENCES content.person (id) ON DELETE CASCADE,
+    role text NOT NULL
+);
+CREATE TABLE content.genre_film_work (
+    id uuid PRIMARY KEY,
+    film_work_id uuid NOT NULL REFERENCES content.film_work (id) ON DELETE CASCADE,
+    genre_id uuid NOT NULL REFERENCES content.genre (id) ON DELETE CASCADE
+);
+"""
+
+INDEXES = """
+CREATE INDEX film_work_updated_at_idx ON content.film_work (updated_at, id);
+CREATE INDEX person_updated_at_idx ON content.person (updated_at, id);
+CREATE INDEX genre_updated_at_idx ON content.genre (updated_at, id);
+CREATE INDEX person_film_work_film_idx ON content.person_film_work (film_work_id);
+CREATE INDEX person_film_work_person_idx ON content.person_film_work (person_id);
+CREATE INDEX genre_film_work_film_idx ON content.genre_film_work (film_work_id);
+CREATE INDEX genre_film_work_genre_idx ON content.genre_film_work (genre_id);
+ANALYZE;
+"""
+
+GENRES = ['Action', 'Adventure', 'Animation', 'Biography', 'Comedy', 'Crime', 'Documentary', 'Drama', 'Family',
+          'Fantasy', 'History', 'Horror', 'Music', 'Musical', 'Mystery', 'News', 'Romance', 'Sci-Fi', 'Short',
+          'Sport', 'Talk-Show', 'Thriller', 'War', 'Western', 'Reality-TV', 'Game-Show']
+
+# количество участников фильма по ролям: (минимум, максимум)
+ROLES = {'director': (1, 2), 'writer': (1, 3), 'actor': (5, 20)}
+
+
+def get_settings(dbname: str) -> Dict[str, str]:
+    """
+    Настройки подключения к БД бенчмарка: сервер и пользователь берутся из переменных окружения сервиса
+    :param dbname: название БД бенчмарка
+    :return: словарь настроек подключения в формате psycopg2
+    """
+    return {
+        'dbname': dbname,
+        'user': os.environ.get('POSTGRES_USER'),
+        'password': os.environ.get('POSTGRES_PASSWORD'),
+        'host': os.environ.get('DB_HOST'),
+        'port': os.environ.get('DB_PORT'),
+        'options': '-c search_path=content',
+    }
+
+
+def ensure_database(settings: Dict[str, str]) -> None:
+    """
+    Создаем БД для бенчмарка, если ее нет
+    :param settings: настройки подключения к БД бенчмарка
+    :return:
+    """
+    admin_settings = dict(settings, dbname='postgres')
+    admin_settings.pop('options', None)
+    connection = psycopg2.connect(**admin_settings)
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1 FROM pg_database WHERE datname = %s', (settings['dbname'],))
+            if not cursor.fetchone():
+                cursor.execute(f'CREATE DATABASE "{settings["dbname"]}"')
+    finally:
+        connection.close()
+
+
+def _copy(cursor, table: str, columns: List[str], rows: List[tuple]) -> None:
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(str(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN', buffer)
+
+
+def generate(settings: Dict[str, str], films: int, persons_per_film: float = 2.0, seed: int = 0) -> Dict[str, int]:
+    """
+    Создаем схему content и заполняем ее синтетическими данными
+    :param settings: настройки подключения к БД бенчмарка
+    :param films: количество фильмов
+    :param persons_per_film: отношение количества людей к количеству фильмов
+    :param seed: начальное значение генератора случайных чисел
+    :return: количество строк по таблицам
+    """
+    rnd = random.Random(seed)
+
+    def new_id() -> uuid.UUID:
+        return uuid.UUID(int=rnd.getrandbits(128), version=4)
+
+    ensure_database(settings)
+    genre_rows = [(new_id(), name) for name in GENRES]
+    person_rows = [(new_id(), f'Person {i}') for i in range(max(1, int(films * persons_per_film)))]
+    film_rows, person_film_rows, genre_film_rows = [], [], []
+    for i in range(films):
+        film_id = new_id()
+        description = ' '.join(f'word{rnd.randint(1, 1000)}' for _ in range(rnd.randint(20, 80)))
+        film_rows.append((film_id, f'Film {i}', description, round(rnd.uniform(0, 10), 1)))
+        for genre_id, _ in rnd.sample(genre_rows, rnd.randint(1, 3)):
+            genre_film_rows.append((new_id(), film_id, genre_id))
+        for role, (low, high) in ROLES.items():
+            for person_id, _ in rnd.sample(person_rows, min(len(person_rows), rnd.randint(low, high))):
+                person_film_rows.append((new_id(), film_id, person_id, role))
+
+    connection = psycopg2.connect(**settings)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute(SCHEMA)
+            _copy(cursor, 'content.genre', ['id', 'name'], genre_rows)
+            _copy(cursor, 'content.person', ['id', 'full_name'], person_rows)
+            _copy(cursor, 'content.film_work', ['id', 'title', 'description', 'rating'], film_rows)
+            _copy(cursor, 'content.genre_film_work', ['id', 'film_work_id', 'genre_id'], genre_film_rows)
+            _copy(cursor, 'content.person_film_work', ['id', 'film_work_id', 'person_id', 'role'], person_film_rows)
+            cursor.execute(INDEXES)
+    finally:
+        connection.close()
+    return {'film_work': len(film_rows), 'person': len(person_rows), 'genre': len(genre_rows),
+            'person_film_work': len(person_film_rows), 'genre_film_work': len(genre_film_rows)}
+
+
+def touch(settings: Dict[str, str], films: int = 0, persons: int = 0, genres: int = 0, seed: int = 0) -> None:
+    """
+    Имитация изменений для сканирования обновлений: обновляем updated_at случайных записей
+    :param settings: настройки подключения к БД бенчмарка
+    :param films: количество измененных фильмов
+    :param persons: количество измененных людей
+    :param genres: количество измененных жанров
+    :param seed: начальное значение генератора случайных чисел
+    :return:
+    """
+    connection = psycopg2.connect(**settings)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute('SELECT setseed(%s)', (seed / 2 ** 31,))
+            for table, count in (('content.film_work', films), ('content.person', persons),
+                                 ('content.genre', genres)):
+                if count:
+                    cursor.execute(f'UPDATE {table} SET updated_at = now() '
+                                   f'WHERE id IN (SELECT id FROM {table} ORDER BY random() LIMIT %s)', (count,))
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--films', type=int, default=10000)
+    parser.add_argument('--db-name', default='etl_bench')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(generate(get_settings(args.db_name), args.films, seed=args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,546 @@
+import asyncio
+import gzip
+import json
+import logging
+import signal
+from collections import deque
+from datetime import datetime
+from typing import List, Optional, Set, Tuple, Union
+from urllib.parse import urljoin
+from uuid import UUID
+
+import aiohttp
+import asyncpg
+
+from postgres_to_es.elastic_loader import (ES_RETRY_STATUSES, FAILED_FILMS,
+                                           FULL_LOAD_COMPLETED,
+                                           FULL_LOAD_LAST_ID, add_failed_films,
+                                           get_bulk_payload, parse_bulk_errors,
+                                           split_bulk)
+from postgres_to_es.extract import (FILMWORK_SELECT, MIN_ID,
+                                    SCAN_HORIZON_REQUEST, STATS_ACCESS_ERROR,
+                                    STATS_ACCESS_REQUEST, check_scan_horizon)
+from postgres_to_es.fingerprint import FingerprintStore
+from postgres_to_es.metrics import DOCUMENTS
+from postgres_to_es.models import BaseTableClass
+from postgres_to_es.serializer import BulkPayload, Operation, bulk_has_errors
+from postgres_to_es.utils import BACKOFF_EXCEPTIONS, State, async_backoff
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# ошибки соединения асинхронных клиентов, при которых запрос повторяется
+ASYNC_BACKOFF_EXCEPTIONS = BACKOFF_EXCEPTIONS + (asyncpg.PostgresConnectionError, asyncpg.InterfaceError,
+                                                 aiohttp.ClientConnectionError, asyncio.TimeoutError, OSError)
+
+# Запросы для asyncpg: параметры передаются позиционно ($1, $2 ...), названия таблиц подставляются через format
+FILM_UPDATE_REQUEST = """
+SELECT id, updated_at
+FROM {table}
+WHERE (updated_at, id) > ($1, $2)
+    AND updated_at < $4
+ORDER BY updated_at, id
+LIMIT $3
+"""
+
+FILM_REQUEST = """
+SELECT DISTINCT pfw.film_work_id AS id
+FROM {table} pfw
+WHERE {field} = ANY($1::uuid[])
+"""
+
+FILM_REQUEST_PREPARE = FILMWORK_SELECT + """
+WHERE fw.id = ANY($1::uuid[])
+"""
+
+SQL_REQUEST = FILMWORK_SELECT + """
+WHERE fw.id > $1
+ORDER BY fw.id
+LIMIT $2
+"""
+
+
+def get_connection_settings(settings: dict) -> dict:
+    """
+    Преобразование настроек подключения psycopg2 в параметры asyncpg
+    :param settings: словарь настроек подключения в формате psycopg2
+    :return: словарь параметров asyncpg.connect
+    """
+    connection_settings = {
+        'database': settings.get('dbname'),
+        'user': settings.get('user'),
+        'password': settings.get('password'),
+        'host': settings.get('host'),
+        'port': settings.get('port'),
+    }
+    # параметры сервера из options вида '-c search_path=content'
+    server_settings = {}
+    for option in (settings.get('options') or '').split('-c'):
+        if '=' in option:
+            name, value = option.strip().split('=', 1)
+            server_settings[name] = value
+    connection_settings['server_settings'] = server_settings
+    return {name: value for name, value in connection_settings.items() if value}
+
+
+def adopt_record(record: asyncpg.Record) -> dict:
+    """
+    Преобразование строки результата запроса в словарь, uuid приводятся к строке как в синхронной версии
+    :param record: строка результата запроса
+    :return: словарь
+    """
+    return {name: str(value) if isinstance(value, UUID) else value for name, value in record.items()}
+
+
+async def init_connection(connection: asyncpg.Connection) -> None:
+    """
+    Настройка нового соединения пула: jsonb возвращается разобранным, как в psycopg2
+    :param connection: соединение asyncpg
+    :return:
+    """
+    await connection.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+class AsyncPostgresExtract:
+    """Асинхронный аналог PostgresExctract: запросы выполняются через пул соединений asyncpg"""
+
+    def __init__(self, settings, min_connections: int = 1, max_connections: int = 5):
+        self.settings = settings
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.pool = None
+
+    @async_backoff(logger, exceptions=ASYNC_BACKOFF_EXCEPTIONS)
+    async def fetch(self, sql_request: str, *args) -> List[dict]:
+        """
+        Выполнение запроса в БД
+        :param sql_request: текст запроса
+        :param args: параметры запроса
+        :return: список строк результата в виде словарей
+        """
+        if self.pool is None:
+            self.pool = await asyncpg.create_pool(min_size=self.min_connections, max_size=self.max_connections,
+                                                  init=init_connection, **get_connection_settings(self.settings))
+        return [adopt_record(record) for record in await self.pool.fetch(sql_request, *args)]
+
+    async def close(self) -> None:
+        """
+        Закрываем все соединения пула
+        :return:
+        """
+        if self.pool is not None:
+            await self.pool.close()
+
+
+class AsyncESLoader:
+    """
+    Асинхронный аналог ESLoader: пачки отправляются одновременно через одну сессию aiohttp,
+    количество одновременных bulk-запросов ограничено concurrency
+    """
+
+    def __init__(self, url: str, bulk_max_docs: int = 500, bulk_max_bytes: int = 5 * 1024 * 1024,
+                 compress: bool = False, concurrency: int = 1, timeout: int = 60, max_retries: int = 5):
+        self.url = url
+        self.bulk_max_docs = bulk_max_docs
+        self.bulk_max_bytes = bulk_max_bytes
+        self.compress = compress
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.stats = {'indexed': 0, 'retried': 0, 'failed': 0}
+        # до Python 3.10 примитивы asyncio привязываются к циклу событий при создании, поэтому семафор создается
+        # при первом запросе, как и сессия
+        self.semaphore = None
+        self.session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Сессия создается при первом запросе, когда цикл событий уже запущен
+        :return: сессия aiohttp
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency),
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """
+        Семафор создается при первом запросе, когда цикл событий уже запущен
+        :return: семафор, ограничивающий количество одновременных bulk-запросов
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.semaphore
+
+    @async_backoff(logger, exceptions=ASYNC_BACKOFF_EXCEPTIONS)
+    async def _post_bulk(self, body: Union[bytes, memoryview]) -> Tuple[int, bytes]:
+        """
+        Отправка тела bulk-запроса в ES
+        :param body: подготовленное тело запроса
+        :return: код и тело ответа ES
+        """
+        headers = {'Content-Type': 'application/x-ndjson'}
+        if self.compress:
+            body = gzip.compress(body, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        async with self._get_session().post(urljoin(self.url, '_bulk'), data=body, headers=headers) as response:
+            return response.status, await response.read()
+
+    async def _send_bulk(self, payload: BulkPayload, operations: List[Operation]) -> List[str]:
+        """
+        Отправка одной пачки операций в ES и разбор ошибок сохранения данных. Документы, отклоненные
+        из-за перегрузки ES, отправляются повторно с экспоненциальной задержкой. Слишком большая для ES
+        пачка (413) отправляется двумя половинами, при других ошибках запроса документы пачки не сохранены
+        :param payload: Подготовленные операции
+        :param operations: Пачка операций для отправки
+        :return: Список id документов, которые не удалось сохранить
+        """
+        failed = []
+        attempt = 0
+        while operations:
+            async with self._get_semaphore():
+                status, content = await self._post_bulk(payload.body(operations))
+            retry = []
+            if status in ES_RETRY_STATUSES:
+                retry = operations
+            elif status == 413 and len(operations) > 1:
+                logger.warning(f'Bulk-запрос из {len(operations)} документов больше допустимого в ES, '
+                               f'делим пачку пополам')
+                self._count('failed', len(failed))
+                middle = len(operations) // 2
+                halves = await asyncio.gather(self._send_bulk(payload, operations[:middle]),
+                                              self._send_bulk(payload, operations[middle:]))
+                return failed + halves[0] + halves[1]
+            elif status >= 400:
+                logger.error(f'ES вернул ошибку {status} на bulk-запрос из {len(operations)} документов: '
+                             f'{content[:1000].decode(errors="replace")}')
+                failed.extend(doc_id for doc_id, _, _ in operations)
+                break
+            elif bulk_has_errors(content):
+                retry, failed_ids = parse_bulk_errors(operations, content)
+                failed.extend(failed_ids)
+                self._count('indexed', len(operations) - len(retry) - len(failed_ids))
+            else:
+                self._count('indexed', len(operations))
+            if not retry:
+                break
+            attempt += 1
+            if attempt > self.max_retries:
+                logger.error(f'Не удалось сохранить {len(retry)} документов после {self.max_retries} попыток')
+                failed.extend(doc_id for doc_id, _, _ in retry)
+                break
+            self._count('retried', len(retry))
+            await asyncio.sleep(min(0.1 * 2 ** attempt, 10))
+            operations = retry
+        self._count('failed', len(failed))
+        return failed
+
+    def _count(self, counter: str, value: int) -> None:
+        """
+        Увеличиваем счетчик статистики загрузки
+        :param counter: название счетчика
+        :param value: величина приращения
+        :return:
+        """
+        self.stats[counter] += value
+        DOCUMENTS.inc(value, result=counter)
+
+    async def load_to_es(self, records: List[dict], index_name: str) -> List[str]:
+        """
+        Отправка данных в ES. Данные разбиваются на пачки, которые отправляются одновременно
+        :param records: Список словарей с данными
+        :param index_name: название индекса
+        :return: Список id документов, которые не удалось сохранить
+        """
+        payload = get_bulk_payload(records, index_name)
+        chunks = split_bulk(payload.operations, self.bulk_max_docs, self.bulk_max_bytes)
+        results = await asyncio.gather(*(self._send_bulk(payload, chunk) for chunk in chunks))
+        return [doc_id for failed in results for doc_id in failed]
+
+    @async_backoff(logger, exceptions=ASYNC_BACKOFF_EXCEPTIONS)
+    async def check_index(self, index_name: str) -> bool:
+        """
+        Проверяем наличие индекса в эластик
+        :param index_name: Имя индекса
+        :return: True/False
+        """
+        async with self._get_session().get(urljoin(self.url, index_name)) as response:
+            if response.status == 200:
+                logger.info(f'Схема индекса {index_name} уже существует')
+                return True
+            return False
+
+    async def create_index(self, index: str, filename: str = 'schema.json') -> None:
+        """
+        Создаем индекс в Elastic
+        :param index: название индекса
+        :param filename: файл со схемой данных в формате json
+        :return:
+        """
+        with open(filename) as file:
+            index_schema = file.read()
+        async with self._get_session().put(urljoin(self.url, index), data=index_schema,
+                                           headers={'Content-Type': 'application/json'}):
+            logger.info(f'Схема {index} успешно создана')
+
+    def log_bulk_stats(self) -> None:
+        """
+        Выводим в лог статистику загрузки в ES
+        :return:
+        """
+        logger.info(f'Загрузка в ES: сохранено {self.stats["indexed"]}, повторно отправлено {self.stats["retried"]}, '
+                    f'не сохранено {self.stats["failed"]}')
+
+    async def close(self) -> None:
+        """
+        Закрываем HTTP-соединения
+        :return:
+        """
+        if self.session is not None:
+            await self.session.close()
+
+
+class AsyncETL:
+    """
+    Асинхронный режим сервиса: первичная загрузка и сканирование обновлений в одном потоке.
+    Запросы обогащения к БД и bulk-запросы к ES выполняются одновременно, не более concurrency
+    """
+
+    def __init__(self, postgres: AsyncPostgresExtract, esl: AsyncESLoader, state: State, tables: List[BaseTableClass],
+                 index: str, fingerprints: Optional[FingerprintStore] = None, page_size: int = 200,
+                 batch_size: int = 100, sleep_time: int = 10, concurrency: int = 4, horizon_max_lag: float = 0):
+        self.postgres = postgres
+        self.esl = esl
+        self.state = state
+        self.tables = tables
+        self.index = index
+        self.fingerprints = fingerprints
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.sleep_time = sleep_time
+        self.concurrency = concurrency
+        self.horizon_max_lag = horizon_max_lag
+        # семафор и событие остановки создаются в run(), в цикле событий, в котором они используются
+        self.semaphore = None
+        self.stop_event = None
+
+    async def get_scan_horizon(self) -> datetime:
+        """
+        Граница сканирования обновлений, см. SCAN_HORIZON_REQUEST
+        :return: время границы
+        """
+        row = (await self.postgres.fetch(SCAN_HORIZON_REQUEST))[0]
+        return check_scan_horizon(row['horizon'], row['now'], self.horizon_max_lag)
+
+    async def get_initial_watermark(self) -> dict:
+        """
+        Отметка, начиная с которой отслеживаются изменения, если сохраненной отметки нет: граница сканирования
+        :return: словарь отметки
+        """
+        return {'updated_at': (await self.get_scan_horizon()).isoformat(), 'id': MIN_ID}
+
+    async def get_table_watermark(self, table: BaseTableClass) -> dict:
+        """
+        Получаем сохраненную отметку последней обработанной записи таблицы
+        :param table: таблица для проверки
+        :return: словарь отметки
+        """
+        watermark = self.state.get_state(table.table_to_check_update)
+        if not watermark:
+            return await self.get_initial_watermark()
+        if isinstance(watermark, str):
+            # отметка в формате предыдущих версий - только локальное время сервиса без часового пояса
+            return {'updated_at': datetime.fromisoformat(watermark).astimezone().isoformat(), 'id': MIN_ID}
+        return watermark
+
+    async def full_load(self) -> bool:
+        """
+        Первичная загрузка всех фильмов: страницы читаются из БД по id фильма, пока предыдущие страницы
+        загружаются в ES. id последнего фильма сохраняется по порядку страниц после их загрузки
+        :return: True, если загружены все фильмы, False, если загрузка остановлена
+        """
+        last_id = self.state.get_state(FULL_LOAD_LAST_ID)
+        if last_id and last_id != MIN_ID:
+            logger.info(f'Продолжаем загрузку данных о фильмах после фильма {last_id}.')
+        elif self.fingerprints:
+            self.fingerprints.clear()
+        last_id = last_id or MIN_ID
+        in_flight = deque()
+        completed = False
+        while not self.stop_event.is_set():
+            page = await self.postgres.fetch(SQL_REQUEST, last_id, self.page_size)
+            if page:
+                last_id = page[-1]['id']
+                in_flight.append((last_id, asyncio.ensure_future(self.esl.load_to_es(page, self.index))))
+            if len(page) < self.page_size:
+                completed = True
+                break
+            while len(in_flight) >= self.concurrency:
+                await self._checkpoint(*in_flight.popleft())
+        while in_flight:
+            await self._checkpoint(*in_flight.popleft())
+        return completed
+
+    async def _checkpoint(self, last_id: str, load: asyncio.Future) -> None:
+        """
+        Ожидание загрузки страницы и сохранение id последнего фильма страницы вместе с id фильмов,
+        которые не удалось сохранить: они загружаются повторно в цикле сканирования обновлений
+        :param last_id: id последнего фильма страницы
+        :param load: загрузка страницы в ES
+        :return:
+        """
+        add_failed_films(self.state, await load)
+        self.state.set_state(FULL_LOAD_LAST_ID, last_id)
+
+    async def exchange_app(self, table: BaseTableClass, horizon: datetime) -> Tuple[Set[str], Optional[dict], bool]:
+        """
+        Читает одну пачку изменений таблицы, начиная с отметки последней обработанной записи,
+        и собирает id затронутых фильмов
+        :param table: таблица для проверки
+        :param horizon: граница сканирования, изменения не раньше нее читаются следующим циклом
+        :return: id затронутых фильмов, новая отметка (None, если изменений нет), признак наличия следующей пачки
+        """
+        watermark = await self.get_table_watermark(table)
+        updated_data = await self.postgres.fetch(FILM_UPDATE_REQUEST.format(table=table.table_to_check_update),
+                                                 datetime.fromisoformat(watermark['updated_at']), watermark['id'],
+                                                 self.batch_size, horizon)
+        if not updated_data:
+            return set(), None, False
+        films_id = await self.get_related_films({row['id'] for row in updated_data}, table)
+        last_row = updated_data[-1]
+        new_watermark = {'updated_at': last_row['updated_at'].isoformat(), 'id': last_row['id']}
+        return films_id, new_watermark, len(updated_data) == self.batch_size
+
+    async def get_related_films(self, data_id: Set[str], table: BaseTableClass) -> Set[str]:
+        """
+        Получаем id фильмов, связанных с измененными записями таблицы
+        :param data_id: множество id измененных записей
+        :param table: таблица, в которой произошли изменения
+        :return: множество id фильмов
+        """
+        if not table.table_list[1]:
+            return set(data_id)
+        films = await self.postgres.fetch(FILM_REQUEST.format(table=table.table_list[1], field=table.table_list[2]),
+                                          list(data_id))
+        return {film['id'] for film in films}
+
+    async def load_films(self, films_id: Set[str]) -> Set[str]:
+        """
+        Загрузка фильмов в ES: пачки фильмов получаются из БД и загружаются одновременно
+        :param films_id: множество id фильмов
+        :return: множество id фильмов, которые не удалось сохранить
+        """
+        films_id = sorted(films_id)
+        results = await asyncio.gather(*(self.load_film_pack(films_id[i:i + self.batch_size])
+                                         for i in range(0, len(films_id), self.batch_size)))
+        return {film_id for failed in results for film_id in failed}
+
+    async def load_film_pack(self, films_id: List[str]) -> List[str]:
+        """
+        Получение пачки фильмов из БД и загрузка изменившихся фильмов в ES
+        :param films_id: список id фильмов
+        :return: Список id фильмов, которые не удалось сохранить
+        """
+        async with self.semaphore:
+            prepared_data = await self.postgres.fetch(FILM_REQUEST_PREPARE, films_id)
+        if self.fingerprints:
+            prepared_data = self.fingerprints.filter_changed(prepared_data)
+        if not prepared_data:
+            return []
+        logger.info('Заливаем изменения в Elastic')
+        failed = await self.esl.load_to_es(prepared_data, self.index)
+        if self.fingerprints:
+            self.fingerprints.save(prepared_data, exclude=failed)
+        return failed
+
+    async def update_cycle(self) -> bool:
+        """
+        Один цикл сканирования обновлений: таблицы проверяются одновременно, каждый затронутый фильм
+        загружается в ES один раз, после загрузки сохраняются отметки
+        :return: признак того, что в таблицах остались необработанные изменения и работа не остановлена
+        """
+        # граница получается до чтения изменений, одна для всех таблиц цикла
+        horizon = await self.get_scan_horizon()
+        results = await asyncio.gather(*(self.exchange_app(table, horizon) for table in self.tables))
+        # фильмы, которые ES не сохранил в предыдущих циклах, загружаются повторно
+        dirty_films = set(self.state.get_state(FAILED_FILMS) or [])
+        has_more = False
+        for films_id, _, table_has_more in results:
+            dirty_films |= films_id
+            has_more = has_more or table_has_more
+        failed = await self.load_films(dirty_films)
+        if failed:
+            logger.warning(f'Не удалось сохранить в ES {len(failed)} фильмов, повторим загрузку в следующем цикле')
+        if failed or self.state.get_state(FAILED_FILMS):
+            self.state.set_state(FAILED_FILMS, sorted(failed) or None)
+        for table, (_, watermark, _) in zip(self.tables, results):
+            if watermark:
+                self.state.set_state(table.table_to_check_update, watermark)
+        return has_more and not self.stop_event.is_set()
+
+    async def wait(self) -> None:
+        """
+        Пауза между сканированиями обновлений, прерывается сигналом остановки
+        :return:
+        """
+        logger.info(f'Засыпаем на {self.sleep_time} сек.')
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), self.sleep_time)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self) -> None:
+        """
+        Основной цикл асинхронного режима
+        :return:
+        """
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop)
+        try:
+            if not (await self.postgres.fetch(STATS_ACCESS_REQUEST))[0]['allowed']:
+                raise RuntimeError(STATS_ACCESS_ERROR)
+            if (not self.state.get_state(FULL_LOAD_COMPLETED) and self.state.get_state(FULL_LOAD_LAST_ID) is None
+                    and await self.esl.check_index(self.index)):
+                # индекс загружен версией сервиса, которая не сохраняла прогресс первичной загрузки
+                for table in self.tables:
+                    self.state.set_state(table.table_to_check_update, await self.get_table_watermark(table))
+                self.state.set_state(FULL_LOAD_COMPLETED, True)
+                self.state.flush()
+                logger.info(f'Схема {self.index} загружена предыдущей версией сервиса, первичная загрузка не требуется')
+            elif not self.state.get_state(FULL_LOAD_COMPLETED):
+                for table in self.tables:
+                    if not self.state.get_state(table.table_to_check_update):
+                        self.state.set_state(table.table_to_check_update, await self.get_initial_watermark())
+                if self.state.get_state(FULL_LOAD_LAST_ID) is None:
+                    # начало загрузки сохраняется до создания индекса, как в синхронном режиме
+                    self.state.set_state(FULL_LOAD_LAST_ID, MIN_ID)
+                    self.state.flush()
+                if not await self.esl.check_index(self.index):
+                    logger.info(f'Схемы {self.index} не существует. Создаем схему')
+                    await self.esl.create_index(self.index)
+                logger.info(f'Загружаем данные о фильмах в Схему {self.index}.')
+                if await self.full_load():
+                    self.state.set_state(FULL_LOAD_COMPLETED, True)
+                    logger.info(f'Первичная загрузка данных в Схему {self.index} завершена.')
+                self.esl.log_bulk_stats()
+            while not self.stop_event.is_set():
+                while await self.update_cycle():
+                    pass
+                self.state.flush()
+                self.esl.log_bulk_stats()
+                if self.fingerprints:
+                    self.fingerprints.log_stats()
+                await self.wait()
+        finally:
+            await self.esl.close()
+            await self.postgres.close()
+
+    def stop(self) -> None:
+        """
+        Обработчик SIGTERM/SIGINT: прекращаем чтение новых данных, уже полученные данные дорабатываются
+        """
+        logger.info('Получен сигнал остановки, завершаем работу')
+        self.stop_event.set()
@@ -0,0 +1,158 @@
+import logging
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Optional, Set
+
+import psycopg2
+
+from postgres_to_es.metrics import OWNED_PARTITIONS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# классы advisory-блокировок: слот экземпляра, партиция фильмов, первичная загрузка
+WORKER_LOCK = 73100
+PARTITION_LOCK = 73101
+BOOTSTRAP_LOCK = 73102
+
+MAX_WORKERS = 64
+
+# номер партиции фильма в SQL-запросе с параметрами, совпадает с film_partition
+PARTITION_SQL = "(('x' || right(replace({column}::text, '-', ''), 8))::bit(32)::bigint %% %(partition_count)s)"
+
+LIVE_WORKERS_REQUEST = """
+SELECT count(*)
+FROM pg_locks
+WHERE locktype = 'advisory'
+    AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+    AND classid = %s
+    AND objsubid = 2
+    AND granted
+"""
+
+
+def film_partition(film_id: str, partition_count: int) -> int:
+    """
+    Номер партиции фильма: остаток от деления последних 32 бит id фильма на количество партиций
+    :param film_id: id фильма
+    :param partition_count: количество партиций
+    :return: номер партиции
+    """
+    return (uuid.UUID(str(film_id)).int & 0xFFFFFFFF) % partition_count
+
+
+class WorkerCoordinator:
+    """
+    Распределение партиций фильмов между экземплярами сервиса через advisory-блокировки Postgres.
+    Каждый экземпляр держит блокировку своего слота и блокировки своих партиций на отдельном соединении.
+    Экземпляр берет не больше ceil(partition_count / количество экземпляров) партиций и отпускает лишние,
+    поэтому при запуске нового экземпляра партиции перераспределяются. Если экземпляр упал, Postgres
+    закрывает его соединение и снимает блокировки, и его партиции забирают остальные экземпляры
+    """
+
+    def __init__(self, settings: dict, partition_count: int, max_workers: int = MAX_WORKERS):
+        self.settings = settings
+        self.partition_count = partition_count
+        self.max_workers = max_workers
+        self.connection = None
+        self.slot: Optional[int] = None
+        self.owned: Set[int] = set()
+
+    def _connect(self) -> None:
+        """
+        Подключаемся к БД и занимаем свободный слот экземпляра
+        :return:
+        """
+        self.connection = psycopg2.connect(**self.settings)
+        self.connection.autocommit = True
+        self.owned = set()
+        self.slot = next((slot for slot in range(self.max_workers) if self._try_lock(WORKER_LOCK, slot)), None)
+        if self.slot is None:
+            raise RuntimeError(f'Все {self.max_workers} слотов экземпляров заняты')
+        logger.info(f'Экземпляр сервиса занял слот {self.slot}')
+
+    def _execute(self, sql: str, params: tuple):
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0]
+
+    def _try_lock(self, lock_class: int, key: int) -> bool:
+        return self._execute('SELECT pg_try_advisory_lock(%s, %s)', (lock_class, key))
+
+    def _unlock(self, lock_class: int, key: int) -> None:
+        self._execute('SELECT pg_advisory_unlock(%s, %s)', (lock_class, key))
+
+    def live_workers(self) -> int:
+        """
+        Количество работающих экземпляров сервиса
+        :return: количество занятых слотов
+        """
+        return self._execute(LIVE_WORKERS_REQUEST, (WORKER_LOCK,))
+
+    def rebalance(self) -> Set[int]:
+        """
+        Приводим количество своих партиций к доле этого экземпляра: лишние партиции отпускаем, свободные берем.
+        При потере соединения все партиции считаются потерянными, соединение восстанавливается при следующем вызове
+        :return: партиции, полученные при этом вызове
+        """
+        acquired = set()
+        try:
+            if self.connection is None:
+                self._connect()
+            target = -(-self.partition_count // max(self.live_workers(), 1))
+            released = sorted(self.owned)[target:]
+            for partition in released:
+                self._unlock(PARTITION_LOCK, partition)
+                self.owned.discard(partition)
+            # перебор начинается с партиций своего слота, чтобы экземпляры не претендовали на одни и те же партиции
+            for i in range(self.partition_count):
+                if len(self.owned) >= target:
+                    break
+                partition = (self.slot * target + i) % self.partition_count
+                if partition not in self.owned and self._try_lock(PARTITION_LOCK, partition):
+                    self.owned.add(partition)
+                    acquired.add(partition)
+            if acquired or released:
+                logger.info(f'Партиции экземпляра: {sorted(self.owned)}, получены {sorted(acquired)}, '
+                            f'отпущены {released}')
+        except (psycopg2.Error, RuntimeError) as e:
+            logger.error(f'Ошибка координации экземпляров: {e}, партиции освобождены')
+            self.owned = set()
+            acquired = set()
+            self.close()
+        OWNED_PARTITIONS.set(len(self.owned))
+        return acquired
+
+    @contextmanager
+    def bootstrap(self, stop_event: threading.Event, poll_interval: float = 1):
+        """
+        Первичная загрузка выполняется одним экземпляром: остальные ждут, пока она не закончится
+        :param stop_event: событие остановки сервиса, прерывает ожидание
+        :param poll_interval: интервал попыток взять блокировку в секундах
+        :return: True, если блокировка получена, False, если ожидание прервано остановкой сервиса
+        """
+        if self.connection is None:
+            self._connect()
+        acquired = self._try_lock(BOOTSTRAP_LOCK, 0)
+        if not acquired:
+            logger.info('Первичную загрузку выполняет другой экземпляр, ждем ее завершения')
+        while not acquired and not stop_event.wait(poll_interval):
+            acquired = self._try_lock(BOOTSTRAP_LOCK, 0)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self._unlock(BOOTSTRAP_LOCK, 0)
+
+    def close(self) -> None:
+        """
+        Закрываем соединение, все блокировки экземпляра снимаются
+        :return:
+        """
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except psycopg2.Error:
+                pass
+            self.connection = None
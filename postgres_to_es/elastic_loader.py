@@ -1,53 +1,395 @@
+import gzip
 import json
 import logging
-from typing import Generator, List
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Generator, Iterable, List, Optional, Tuple, Union
 from urllib.parse import urljoin
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from .extract import adopt_request_result
-from .utils import backoff
+from .metrics import BULK_BYTES, BULK_DURATION, DOCUMENTS, timed
+from .pipeline import Pipeline, ordered_map
+from .serializer import BulkPayload, Operation, bulk_has_errors, loads
+from .utils import State, backoff
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+FULL_LOAD_LAST_ID = 'full_load_last_id'
+FULL_LOAD_COMPLETED = 'full_load_completed'
+INDEX_VERSION_LOADED = 'index_version'
+REINDEX_WATERMARK = 'reindex_watermark'
+# id фильмов, которые ES не сохранил, они загружаются повторно в следующем цикле сканирования обновлений
+FAILED_FILMS = 'failed_films'
+
+
+ES_RETRY_STATUSES = {429, 502, 503, 504}
+
+# настройки индекса на время первичной загрузки: поиск не обновляется, реплики не создаются
+BULK_LOAD_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+# Замена названия переименованной записи в документе фильма: в списках {id, name} имя заменяется по id, списки
+# имен (actors_names, writers_names) собираются заново из списков {id, name} без повторов. Для полей, у которых
+# нет списка {id, name} (director, genre), передается текущий список имен фильма из БД
+RENAME_SCRIPT = """
+for (change in params.changes) {
+    for (field in change.objects) {
+        if (ctx._source[field] != null) {
+            for (item in ctx._source[field]) {
+                if (item.id == change.id) {
+                    item.name = change.new_name;
+                }
+            }
+        }
+    }
+    for (entry in change.names.entrySet()) {
+        if (ctx._source[entry.getValue()] != null) {
+            def names = new TreeSet();
+            for (item in ctx._source[entry.getValue()]) {
+                names.add(item.name);
+            }
+            ctx._source[entry.getKey()] = new ArrayList(names);
+        }
+    }
+    for (entry in change.values.entrySet()) {
+        ctx._source[entry.getKey()] = entry.getValue();
+    }
+}
+"""
+
+# поля документа фильма, в которых хранится название записи, по роли: списки {id, name}, списки имен,
+# собираемые из списков {id, name}, и списки имен, значение которых берется из БД
+RENAME_FIELDS = {
+    'actor': (['actors'], {'actors_names': 'actors'}, []),
+    'writer': (['writers'], {'writers_names': 'writers'}, []),
+    'director': ([], {}, ['director']),
+    'genre': ([], {}, ['genre']),
+}
+
+
+def split_bulk(operations: List[Operation], max_docs: int, max_bytes: int) -> Generator:
+    """
+    Разбивает операции на пачки, ограниченные количеством документов и размером в байтах
+    :param operations: Список операций
+    :param max_docs: максимальное количество документов в пачке
+    :param max_bytes: максимальный размер пачки в байтах
+    :return: Генератор пачек операций
+    """
+    chunk, chunk_size = [], 0
+    for operation in operations:
+        operation_size = operation[2] - operation[1]
+        if chunk and (len(chunk) >= max_docs or chunk_size + operation_size > max_bytes):
+            yield chunk
+            chunk, chunk_size = [], 0
+        chunk.append(operation)
+        chunk_size += operation_size
+    if chunk:
+        yield chunk
+
+
+def parse_bulk_errors(operations: List[Operation], content: bytes) -> Tuple[List[Operation], List[str]]:
+    """
+    Разбор ответа _bulk с ошибками
+    :param operations: Пачка отправленных операций
+    :param content: тело ответа ES
+    :return: операции для повторной отправки и id документов, которые не удалось сохранить
+    """
+    retry, failed = [], []
+    for operation, item in zip(operations, loads(content)['items']):
+        result = next(iter(item.values()))
+        error_message = result.get('error')
+        if not error_message:
+            continue
+        if result['status'] in ES_RETRY_STATUSES:
+            retry.append(operation)
+        else:
+            logger.error(error_message)
+            failed.append(operation[0])
+    return retry, failed
+
+
+class BulkThrottle:
+    """
+    Адаптивное ограничение размера пачки и количества одновременных bulk-запросов.
+    При отказах ES (429, es_rejected_execution_exception) размер пачки уменьшается вдвое,
+    а количество одновременных запросов на единицу. При успешных запросах лимиты постепенно
+    возвращаются к исходным значениям
+    """
+
+    def __init__(self, batch_size: int, concurrency: int, min_batch_size: int = 10, recovery_step: int = 10):
+        self.max_batch_size = batch_size
+        self.max_concurrency = concurrency
+        self.min_batch_size = min(min_batch_size, batch_size)
+        self.recovery_step = recovery_step
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self.in_flight >= self.concurrency:
+                self._condition.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_reject(self) -> None:
+        """ES не справляется с нагрузкой - уменьшаем лимиты"""
+        with self._condition:
+            self._successes = 0
+            batch_size = max(self.min_batch_size, self.batch_size // 2)
+            concurrency = max(1, self.concurrency - 1)
+            # при минимальных лимитах отказы не логируются, их количество видно в статистике загрузки
+            if (batch_size, concurrency) != (self.batch_size, self.concurrency):
+                logger.warning(f'ES отклоняет запросы, уменьшаем пачку до {batch_size}, '
+                               f'одновременных запросов до {concurrency}')
+            self.batch_size = batch_size
+            self.concurrency = concurrency
+
+    def on_success(self) -> None:
+        """Запрос выполнен без отказов - постепенно увеличиваем лимиты"""
+        with self._condition:
+            self._successes += 1
+            if self.batch_size < self.max_batch_size:
+                self.batch_size = min(self.max_batch_size, self.batch_size + self.recovery_step)
+            if self.concurrency < self.max_concurrency and self._successes >= self.recovery_step:
+                self._successes = 0
+                self.concurrency += 1
+                self._condition.notify_all()
+
 
 class ESLoader:
-    def __init__(self, url: str):
+    def __init__(self, url: str, bulk_max_docs: int = 500, bulk_max_bytes: int = 5 * 1024 * 1024,
+                 compress: bool = False, concurrency: int = 1, timeout: int = 60, max_retries: int = 5):
         self.url = url
+        self.bulk_max_bytes = bulk_max_bytes
+        self.compress = compress
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.throttle = BulkThrottle(bulk_max_docs, concurrency)
+        self.stats = {'indexed': 0, 'retried': 0, 'failed': 0}
+        self._stats_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='es-bulk')
 
-    def _get_es_bulk_query(self, rows: List[dict], index_name: str) -> List[str]:
+    def _get_es_bulk_query(self, rows: List[dict], index_name: str) -> BulkPayload:
         """
         Подготавливает bulk-запрос в Elasticsearch
         :param rows: Список словарей с данными
         :param index_name: название индекса
-        :return: Список строк подготовленный для загрузки
+        :return: Операции bulk-запроса, записанные в один буфер
         """
-        prepared_query = []
+        return get_bulk_payload(rows, index_name)
 
-        for row in rows:
-            prepared_query.extend([json.dumps({'index': {'_index': index_name, '_id': row['id']}}), json.dumps(row)])
-        return prepared_query
+    def _split_bulk(self, payload: BulkPayload) -> Generator:
+        """
+        Разбивает операции на пачки, ограниченные текущим размером пачки и размером в байтах
+        :param payload: Подготовленные операции
+        :return: Генератор пачек операций
+        """
+        return split_bulk(payload.operations, self.throttle.batch_size, self.bulk_max_bytes)
 
     @backoff(logger)
-    def load_to_es(self, records: List[dict], index_name: str) -> None:
+    def _post_bulk(self, body: Union[bytes, memoryview]) -> requests.Response:
+        """
+        Отправка тела bulk-запроса в ES
+        :param body: подготовленное тело запроса
+        :return: ответ ES
         """
-        Отправка запроса в ES и разбор ошибок сохранения данных
+        headers = {'Content-Type': 'application/x-ndjson'}
+        BULK_BYTES.inc(len(body))
+        if self.compress:
+            body = gzip.compress(body, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        with BULK_DURATION.time():
+            return self.session.post(urljoin(self.url, '_bulk'), data=body, headers=headers, timeout=self.timeout)
+
+    def _send_bulk(self, payload: BulkPayload, operations: List[Operation]) -> List[str]:
+        """
+        Отправка одной пачки операций в ES и разбор ошибок сохранения данных. Документы, отклоненные
+        из-за перегрузки ES, отправляются повторно с экспоненциальной задержкой. Слишком большая для ES
+        пачка (413) отправляется двумя половинами, при других ошибках запроса документы пачки не сохранены
+        :param payload: Подготовленные операции
+        :param operations: Пачка операций для отправки
+        :return: Список id документов, которые не удалось сохранить
+        """
+        failed = []
+        attempt = 0
+        while operations:
+            with self.throttle:
+                response = self._post_bulk(payload.body(operations))
+            retry = []
+            if response.status_code in ES_RETRY_STATUSES:
+                retry = operations
+            elif response.status_code == 413 and len(operations) > 1:
+                self._count('failed', len(failed))
+                return failed + self._split_send(payload, operations)
+            elif not response.ok:
+                logger.error(f'ES вернул ошибку {response.status_code} на bulk-запрос из {len(operations)} '
+                             f'документов: {response.text[:1000]}')
+                failed.extend(doc_id for doc_id, _, _ in operations)
+                break
+            elif bulk_has_errors(response.content):
+                retry, failed_ids = parse_bulk_errors(operations, response.content)
+                failed.extend(failed_ids)
+                self._count('indexed', len(operations) - len(retry) - len(failed_ids))
+            else:
+                self._count('indexed', len(operations))
+            if not retry:
+                self.throttle.on_success()
+                break
+            self.throttle.on_reject()
+            attempt += 1
+            if attempt > self.max_retries:
+                logger.error(f'Не удалось сохранить {len(retry)} документов после {self.max_retries} попыток')
+                failed.extend(doc_id for doc_id, _, _ in retry)
+                break
+            self._count('retried', len(retry))
+            time.sleep(min(0.1 * 2 ** attempt, 10))
+            operations = retry
+        self._count('failed', len(failed))
+        return failed
+
+    def _split_send(self, payload: BulkPayload, operations: List[Operation]) -> List[str]:
+        """
+        Отправка пачки, которая больше допустимого в ES размера запроса (http.max_content_length), двумя половинами
+        :param payload: Подготовленные операции
+        :param operations: Пачка операций для отправки
+        :return: Список id документов, которые не удалось сохранить
+        """
+        logger.warning(f'Bulk-запрос из {len(operations)} документов больше допустимого в ES, делим пачку пополам')
+        middle = len(operations) // 2
+        return self._send_bulk(payload, operations[:middle]) + self._send_bulk(payload, operations[middle:])
+
+    def _count(self, counter: str, value: int) -> None:
+        """
+        Увеличиваем счетчик статистики загрузки
+        :param counter: название счетчика
+        :param value: величина приращения
+        :return:
+        """
+        with self._stats_lock:
+            self.stats[counter] += value
+        DOCUMENTS.inc(value, result=counter)
+
+    def _submit(self, payload: BulkPayload) -> List[Future]:
+        """
+        Отправляет пачки операций на выполнение в пул потоков
+        :param payload: Подготовленные операции
+        :return: Список Future по каждой отправленной пачке
+        """
+        return [self.executor.submit(self._send_bulk, payload, chunk) for chunk in self._split_bulk(payload)]
+
+    @timed('load_to_es')
+    def load_to_es(self, records: List[dict], index_name: str) -> List[str]:
+        """
+        Отправка данных в ES. Данные разбиваются на пачки, которые отправляются параллельно
         :param records: Список словарей с данными
         :param index_name: название индекса
-        :return: None
+        :return: Список id документов, которые не удалось сохранить
+        """
+        return self._wait_futures(self._submit(self._get_es_bulk_query(records, index_name)))
+
+    def load_payloads(self, payloads: Iterable[BulkPayload]) -> Generator:
+        """
+        Отправка подготовленных страниц операций в ES, одновременно в обработке находится не более concurrency
+        страниц. Страницы возвращаются в исходном порядке после того как ES обработал все их пачки
+        :param payloads: Итерируемый объект с подготовленными операциями
+        :return: Генератор пар (страница операций, список id документов, которые не удалось сохранить)
+        """
+        in_flight = deque()
+        for payload in payloads:
+            in_flight.append((payload, self._submit(payload)))
+            while len(in_flight) >= self.throttle.concurrency:
+                payload, futures = in_flight.popleft()
+                yield payload, self._wait_futures(futures)
+        while in_flight:
+            payload, futures = in_flight.popleft()
+            yield payload, self._wait_futures(futures)
+
+    def update_documents(self, changes: Dict[str, List[dict]], index_name: str) -> List[str]:
+        """
+        Частичное обновление документов скриптом RENAME_SCRIPT без пересборки документов
+        :param changes: словарь {id документа: список замен, см. get_rename_change}
+        :param index_name: название индекса
+        :return: Список id документов, которые не удалось обновить, в том числе отсутствующих в индексе
+        """
+        return self._wait_futures(self._submit(get_update_payload(changes, index_name)))
+
+    def delete_documents(self, ids: Iterable[str], index_name: str) -> List[str]:
+        """
+        Удаление документов из ES. Отсутствие документа в индексе ошибкой не считается
+        :param ids: id документов
+        :param index_name: название индекса
+        :return: Список id документов, которые не удалось удалить
+        """
+        return self._wait_futures(self._submit(get_delete_payload(ids, index_name)))
+
+    def _wait_futures(self, futures: List[Future]) -> List[str]:
+        """
+        Ожидание загрузки всех пачек
+        :param futures: Список Future пачек
+        :return: Список id документов, которые не удалось сохранить
+        """
+        failed = []
+        for future in futures:
+            failed.extend(future.result())
+        return failed
+
+    def scroll_documents(self, index_name: str, size: int = 1000) -> Generator:
+        """
+        Постраничное чтение всех документов индекса через scroll API
+        :param index_name: название индекса
+        :param size: количество документов на странице
+        :return: Генератор списков документов
+        """
+        response = self.session.post(urljoin(self.url, f'{index_name}/_search'), params={'scroll': '1m'},
+                                     json={'size': size, 'sort': ['_doc']}, timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()
+        try:
+            while result['hits']['hits']:
+                yield [hit['_source'] for hit in result['hits']['hits']]
+                response = self.session.post(urljoin(self.url, '_search/scroll'), timeout=self.timeout,
+                                             json={'scroll': '1m', 'scroll_id': result['_scroll_id']})
+                response.raise_for_status()
+                result = response.json()
+        finally:
+            self.session.delete(urljoin(self.url, '_search/scroll'), json={'scroll_id': result['_scroll_id']},
+                                timeout=self.timeout)
+
+    def log_bulk_stats(self) -> None:
         """
-        prepared_query = self._get_es_bulk_query(records, index_name)
-        adopted_query = '\n'.join(prepared_query) + '\n'
-        response = requests.post(urljoin(self.url, '_bulk'), data=adopted_query,
-                                 headers={'Content-Type': 'application/json'}
-                                 )
+        Выводим в лог статистику загрузки в ES
+        :return:
+        """
+        logger.info(f'Загрузка в ES: сохранено {self.stats["indexed"]}, повторно отправлено {self.stats["retried"]}, '
+                    f'не сохранено {self.stats["failed"]}, размер пачки {self.throttle.batch_size}, '
+                    f'одновременных запросов {self.throttle.concurrency}')
 
-        json_response = json.loads(response.content.decode())
-        for item in json_response['items']:
-            error_message = item['index'].get('error')
-            if error_message:
-                logger.error(error_message)
+    def close(self) -> None:
+        """
+        Завершаем пул потоков и закрываем HTTP-соединения
+        :return:
+        """
+        self.executor.shutdown()
+        self.session.close()
 
     def __get_index_data(self, filename='schema.json'):
         """
@@ -56,26 +398,217 @@ class ESLoader:
         with open(filename) as file:
             return json.load(file)
 
-    def create_index(self, index: str):
+    def create_index(self, index: str, bulk_load: bool = False):
         """
         Создаем индекс в Elastic
         :param index: схема данных в формате json
+        :param bulk_load: создать индекс с настройками для первичной загрузки: без обновления поиска и без реплик
         :return: результат выполнения request
         """
-        index_schema = json.dumps(self.__get_index_data())
+        index_data = self.__get_index_data()
+        if bulk_load:
+            settings = index_data.setdefault('settings', {})
+            for key in BULK_LOAD_SETTINGS:
+                settings.pop(key, None)
+            settings.setdefault('index', {}).update(BULK_LOAD_SETTINGS)
+        index_schema = json.dumps(index_data)
         url = urljoin(self.url, index)
-        create_response = requests.request('PUT', url, headers={'Content-Type': 'application/json'}, data=index_schema)
+        create_response = self.session.put(url, headers={'Content-Type': 'application/json'}, data=index_schema,
+                                           timeout=self.timeout)
         logger.info(f'Схема {index} успешно создана')
         return create_response
 
+    def restore_index_settings(self, index: str) -> None:
+        """
+        Возвращаем индексу после первичной загрузки настройки обновления поиска и количества реплик из схемы,
+        если в схеме они не заданы - значения по умолчанию
+        :param index: название индекса
+        :return:
+        """
+        settings = self.__get_index_data().get('settings', {})
+        nested = settings.get('index', {})
+        restored = {key: settings.get(key, nested.get(key)) for key in BULK_LOAD_SETTINGS}
+        response = self.session.put(urljoin(self.url, f'{index}/_settings'), json={'index': restored},
+                                    timeout=self.timeout)
+        response.raise_for_status()
+        logger.info(f'Настройки индекса {index} восстановлены: {restored}')
 
-def load_all_files(film_data: Generator, esl: ESLoader, index: str) -> None:
+    def forcemerge(self, index: str, max_num_segments: int = 1) -> None:
+        """
+        Обновляем поиск и объединяем сегменты загруженного индекса
+        :param index: название индекса
+        :param max_num_segments: количество сегментов после объединения
+        :return:
+        """
+        self.session.post(urljoin(self.url, f'{index}/_refresh'), timeout=self.timeout).raise_for_status()
+        # объединение сегментов большого индекса может занимать больше timeout
+        response = self.session.post(urljoin(self.url, f'{index}/_forcemerge'),
+                                     params={'max_num_segments': max_num_segments})
+        response.raise_for_status()
+        logger.info(f'Сегменты индекса {index} объединены')
+
+    def get_alias_indices(self, alias: str) -> List[str]:
+        """
+        Получаем индексы, на которые указывает псевдоним
+        :param alias: название псевдонима
+        :return: список индексов
+        """
+        response = self.session.get(urljoin(self.url, f'_alias/{alias}'), timeout=self.timeout)
+        if response.status_code == 404:
+            return []
+        response.raise_for_status()
+        return list(response.json())
+
+    def swap_alias(self, alias: str, index: str) -> List[str]:
+        """
+        Атомарно переключаем псевдоним на новый индекс. Индекс с названием псевдонима, созданный
+        предыдущими версиями, удаляется в том же запросе
+        :param alias: название псевдонима
+        :param index: новый индекс
+        :return: список индексов, на которые псевдоним указывал раньше
+        """
+        old_indices = [old_index for old_index in self.get_alias_indices(alias) if old_index != index]
+        actions = [{'remove': {'index': old_index, 'alias': alias}} for old_index in old_indices]
+        if not old_indices and self.session.head(urljoin(self.url, alias), timeout=self.timeout).status_code == 200:
+            actions.append({'remove_index': {'index': alias}})
+        actions.append({'add': {'index': index, 'alias': alias}})
+        response = self.session.post(urljoin(self.url, '_aliases'), json={'actions': actions}, timeout=self.timeout)
+        response.raise_for_status()
+        logger.info(f'Псевдоним {alias} переключен на индекс {index}')
+        return old_indices
+
+    def delete_index(self, index: str) -> None:
+        """
+        Удаляем индекс
+        :param index: название индекса
+        :return:
+        """
+        self.session.delete(urljoin(self.url, index), timeout=self.timeout).raise_for_status()
+        logger.info(f'Индекс {index} удален')
+
+
+def get_bulk_payload(rows: List[dict], index_name: str) -> BulkPayload:
+    """
+    Подготавливает операции index bulk-запроса для документов
+    :param rows: Список словарей с данными
+    :param index_name: название индекса
+    :return: Операции bulk-запроса, записанные в один буфер
     """
+    payload = BulkPayload()
+    for row in rows:
+        payload.add(row['id'], {'index': {'_index': index_name, '_id': row['id']}}, row)
+    return payload
+
+
+def get_delete_payload(ids: Iterable[str], index_name: str) -> BulkPayload:
+    """
+    Подготавливает операции delete bulk-запроса
+    :param ids: id документов
+    :param index_name: название индекса
+    :return: Операции bulk-запроса, записанные в один буфер
+    """
+    payload = BulkPayload()
+    for doc_id in ids:
+        payload.add(doc_id, {'delete': {'_index': index_name, '_id': doc_id}})
+    return payload
+
+
+def get_rename_change(data_id: str, new_name: str, roles: Iterable[str], value_names: List[str]) -> dict:
+    """
+    Параметры замены названия записи в документе фильма для RENAME_SCRIPT
+    :param data_id: id переименованной записи
+    :param new_name: новое название
+    :param roles: роли записи в фильме (actor, writer, director или genre)
+    :param value_names: текущий список имен фильма из БД для полей без списка {id, name} (режиссеры или жанры)
+    :return: словарь параметров замены
+    """
+    objects, names, values = [], {}, {}
+    for role in roles:
+        role_objects, role_names, role_values = RENAME_FIELDS.get(role, ([], {}, []))
+        objects += role_objects
+        names.update(role_names)
+        values.update((field, value_names) for field in role_values)
+    return {'id': data_id, 'new_name': new_name, 'objects': objects, 'names': names, 'values': values}
+
+
+def get_update_payload(changes: Dict[str, List[dict]], index_name: str) -> BulkPayload:
+    """
+    Подготавливает операции update bulk-запроса со скриптом RENAME_SCRIPT
+    :param changes: словарь {id документа: список замен}
+    :param index_name: название индекса
+    :return: Операции bulk-запроса, записанные в один буфер
+    """
+    payload = BulkPayload()
+    for doc_id, doc_changes in changes.items():
+        payload.add(doc_id, {'update': {'_index': index_name, '_id': doc_id, 'retry_on_conflict': 3}},
+                    {'script': {'source': RENAME_SCRIPT, 'lang': 'painless', 'params': {'changes': doc_changes}}})
+    return payload
+
+
+def prepare_film_pack(film_pack: Tuple[List[str], List[tuple]], index_name: str) -> BulkPayload:
+    """
+    Преобразование пачки строк результата запроса в операции bulk-запроса. Выполняется в процессах пула,
+    поэтому строки передаются в виде списка названий колонок и списка кортежей
+    :param film_pack: названия колонок и строки результата запроса
+    :param index_name: название индекса
+    :return: Операции bulk-запроса, записанные в один буфер
+    """
+    columns, rows = film_pack
+    return get_bulk_payload(adopt_request_result([zip(columns, row) for row in rows]), index_name)
+
+
+def add_failed_films(state: State, failed: Iterable[str], key: str = FAILED_FILMS) -> None:
+    """
+    Добавляем фильмы, которые не удалось сохранить в ES, к фильмам для повторной загрузки
+    :param state: хранилище состояния
+    :param failed: id фильмов
+    :param key: ключ состояния, в котором хранятся id фильмов для повторной загрузки
+    :return:
+    """
+    failed = set(failed)
+    if failed:
+        state.set_state(key, sorted(failed.union(state.get_state(key) or [])))
+
+
+def load_all_files(film_data: Generator, esl: ESLoader, index: str, state: Optional[State] = None,
+                   stop_event: Optional[threading.Event] = None, queue_size: int = 4, workers: int = 0,
+                   last_id_key: str = FULL_LOAD_LAST_ID, failed_key: str = FAILED_FILMS) -> bool:
+    """
+    Загрузка всех фильмов конвейером: чтение из БД, преобразование и загрузка в ES выполняются одновременно
     :param film_data: данные для загрузки в виде списка словарей
     :param esl: экземпляр класса ESLoader
     :param index:название схемы данных для загрузки в elastic
-    :return:
+    :param state: хранилище состояния, в которое после каждой загруженной пачки сохраняется id последнего фильма
+                  и id фильмов, которые не удалось сохранить
+    :param stop_event: событие остановки конвейера
+    :param queue_size: размер очередей между этапами конвейера
+    :param workers: количество процессов для преобразования и сериализации данных, 0 - преобразование в потоке
+    :param last_id_key: ключ состояния, в котором хранится id последнего загруженного фильма
+    :param failed_key: ключ состояния, в котором хранятся id фильмов для повторной загрузки
+    :return: True, если загружены все фильмы, False, если загрузка остановлена
     """
-    for film_pack in film_data:
-        bulk_film = adopt_request_result(film_pack)
-        esl.load_to_es(bulk_film, index)
+    def load(payloads: Iterable[BulkPayload]) -> Generator:
+        for payload, failed in esl.load_payloads(payloads):
+            if state and payload.operations:
+                # отметка сдвигается только вместе с сохранением фильмов, которые ES не принял
+                add_failed_films(state, failed, failed_key)
+                state.set_state(last_id_key, payload.operations[-1][0])
+            yield payload
+
+    if not workers:
+        pipeline = Pipeline('full_load', film_data, [
+            ('transform', lambda film_packs: (get_bulk_payload(adopt_request_result(pack), index)
+                                              for pack in film_packs)),
+            ('load', load),
+        ], queue_size, stop_event)
+        return pipeline.run()
+
+    # строки DictRow передаются в процессы в компактном виде: названия колонок и кортежи значений
+    film_packs = ((list(pack[0].keys()), [tuple(row) for row in pack]) for pack in film_data)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        pipeline = Pipeline('full_load', film_packs, [
+            ('transform', lambda packs: ordered_map(executor, partial(prepare_film_pack, index_name=index),
+                                                    packs, workers * 2)),
+            ('load', load),
+        ], queue_size, stop_event)
+        return pipeline.run()
@@ -1,11 +1,18 @@
 import logging
+import select
+import time
+from collections import defaultdict
 from datetime import datetime
-from typing import Generator, List, Tuple
+from typing import Dict, Generator, Iterable, List, Optional, Set, Tuple
 
 import psycopg2
-from psycopg2.extensions import AsIs
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, AsIs
 from psycopg2.extras import DictCursor
+from psycopg2.pool import ThreadedConnectionPool
 
+from postgres_to_es.coordinator import PARTITION_SQL
+from postgres_to_es.metrics import (QUERY_DURATION, ROWS_EXTRACTED,
+                                    SCAN_HORIZON_LAG, timed)
 from postgres_to_es.utils import backoff
 
 logging.basicConfig(level=logging.INFO)
@@ -20,29 +27,9 @@ LIMIT 100
 """
 
 FILM_REQUEST = """
-SELECT fw.id, fw.updated_at
-FROM content.film_work fw
-LEFT JOIN %(table)s pfw ON pfw.film_work_id = fw.id
+SELECT DISTINCT pfw.film_work_id AS id
+FROM %(table)s pfw
 WHERE %(field)s IN %(persons)s
-ORDER BY fw.updated_at
-"""
-
-FILM_REQUEST_PREPARE = """
-SELECT
-    fw.id as fw_id,
-    fw.title,
-    fw.description,
-    fw.rating,
-    pfw.role,
-    p.id,
-    p.full_name,
-    g.name
-FROM content.film_work fw
-LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-LEFT JOIN content.person p ON p.id = pfw.person_id
-LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-LEFT JOIN content.genre g ON g.id = gfw.genre_id
-WHERE fw.id IN %(films_id)s
 """
 
 GENRE_REQUEST = """
@@ -56,141 +43,754 @@ LIMIT 100
 FILM_UPDATE_REQUEST = """
 SELECT id, updated_at
 FROM %(table)s
-WHERE updated_at > %(updatedat)s
-ORDER BY updated_at
+WHERE (updated_at, id) > (%(updatedat)s, %(last_id)s)
+    AND updated_at < %(horizon)s
+ORDER BY updated_at, id
+LIMIT %(limit)s
+"""
+
+# варианты запросов для нескольких экземпляров сервиса: только фильмы своих партиций
+FILM_PARTITION_REQUEST = """
+SELECT DISTINCT pfw.film_work_id AS id
+FROM %(table)s pfw
+WHERE %(field)s IN %(persons)s
+    AND """ + PARTITION_SQL.format(column='pfw.film_work_id') + """ IN %(partitions)s
+"""
+
+FILM_UPDATE_PARTITION_REQUEST = """
+SELECT id, updated_at
+FROM %(table)s
+WHERE (updated_at, id) > (%(updatedat)s, %(last_id)s)
+    AND updated_at < %(horizon)s
+    AND """ + PARTITION_SQL.format(column='id') + """ IN %(partitions)s
+ORDER BY updated_at, id
+LIMIT %(limit)s
+"""
+
+# Граница сканирования обновлений: начало самой старой незавершенной транзакции других сеансов или текущее время.
+# Транзакция, изменившая запись, проставляет updated_at = now() - время своего начала, а видна становится только
+# после фиксации, поэтому записи с updated_at не раньше границы могут еще появиться и читаются следующим циклом.
+# Граница получается отдельным запросом до чтения изменений: транзакция, начатая до нее и уже не видная
+# в pg_stat_activity, зафиксирована, и ее записи видны следующим запросам. Учитываются только транзакции
+# в этой БД, но любая долгая транзакция в ней (сеанс idle in transaction, pg_dump) задерживает границу,
+# поэтому отставание границы от now() проверяется в check_scan_horizon
+SCAN_HORIZON_REQUEST = """
+SELECT LEAST(now(), min(xact_start)) AS horizon, now() AS now
+FROM pg_stat_activity
+WHERE xact_start IS NOT NULL
+    AND pid <> pg_backend_pid()
+    AND backend_type = 'client backend'
+    AND datname = current_database()
+"""
+
+# Транзакции сеансов других пользователей видны в pg_stat_activity только суперпользователю и членам роли
+# pg_read_all_stats, без этого граница сканирования не учитывает их транзакции
+STATS_ACCESS_REQUEST = """
+SELECT pg_has_role(current_user, 'pg_read_all_stats', 'USAGE') AS allowed
+"""
+STATS_ACCESS_ERROR = ('Роли сервиса нужна роль pg_read_all_stats, чтобы видеть транзакции других сеансов: '
+                      'GRANT pg_read_all_stats TO <роль сервиса>')
+
+MAX_UPDATED_AT_REQUEST = """
+SELECT max(updated_at) AS updated_at
+FROM %(table)s
+"""
+
+# Позиция последнего изменения таблицы: при индексе по (updated_at, id) выполняется чтением одной записи индекса
+NEWEST_ROW_REQUEST = """
+SELECT updated_at, id
+FROM %(table)s
+ORDER BY updated_at DESC, id DESC
+LIMIT 1
+"""
+
+# Позиция последнего изменения фильма в партициях экземпляра: индекс читается с конца до первой подходящей записи
+NEWEST_ROW_PARTITION_REQUEST = """
+SELECT updated_at, id
+FROM %(table)s
+WHERE """ + PARTITION_SQL.format(column='id') + """ IN %(partitions)s
+ORDER BY updated_at DESC, id DESC
+LIMIT 1
+"""
+# Данные фильма агрегируются в БД: жанры и участники собираются отдельными подзапросами для каждого фильма,
+# поэтому декартова произведения жанров и участников не возникает
+FILMWORK_SELECT = """
+SELECT
+    fw.id,
+    fw.title,
+    fw.description,
+    fw.rating,
+    COALESCE(g.genre, '{}') AS genre,
+    COALESCE(p.actors, '[]') AS actors,
+    COALESCE(p.actors_names, '{}') AS actors_names,
+    COALESCE(p.director, '{}') AS director,
+    COALESCE(p.writers, '[]') AS writers,
+    COALESCE(p.writers_names, '{}') AS writers_names
+FROM content.film_work fw
+LEFT JOIN LATERAL (
+    SELECT ARRAY_AGG(DISTINCT g.name) AS genre
+    FROM content.genre_film_work gfw
+    JOIN content.genre g ON g.id = gfw.genre_id
+    WHERE gfw.film_work_id = fw.id
+) g ON TRUE
+LEFT JOIN LATERAL (
+    SELECT
+        JSONB_AGG(DISTINCT JSONB_BUILD_OBJECT('id', p.id, 'name', p.full_name))
+            FILTER (WHERE pfw.role = 'actor') AS actors,
+        ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'actor') AS actors_names,
+        ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'director') AS director,
+        JSONB_AGG(DISTINCT JSONB_BUILD_OBJECT('id', p.id, 'name', p.full_name))
+            FILTER (WHERE pfw.role = 'writer') AS writers,
+        ARRAY_AGG(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'writer') AS writers_names
+    FROM content.person_film_work pfw
+    JOIN content.person p ON p.id = pfw.person_id
+    WHERE pfw.film_work_id = fw.id
+) p ON TRUE
+"""
+
+FILM_REQUEST_PREPARE = FILMWORK_SELECT + """
+WHERE fw.id IN %(films_id)s
+"""
+
+SQL_REQUEST = FILMWORK_SELECT + """
+WHERE fw.id > %(last_id)s
+ORDER BY fw.id
+LIMIT %(page_size)s
+"""
+
+NAMES_REQUEST = """
+SELECT id, %(column)s AS name
+FROM %(table)s
+WHERE id IN %(ids)s
+"""
+
+# Фильмы, в документах которых нужно заменить имя переименованных людей, и роли людей в этих фильмах.
+# В документе у режиссеров нет id, поэтому для режиссера фильма берется текущий список режиссеров,
+# собранный так же, как в FILMWORK_SELECT
+PERSON_RENAME_LINKS_REQUEST = """
+SELECT
+    pfw.film_work_id AS id,
+    pfw.person_id AS data_id,
+    ARRAY_AGG(DISTINCT pfw.role) AS roles,
+    CASE WHEN BOOL_OR(pfw.role = 'director') THEN (
+        SELECT ARRAY_AGG(DISTINCT p.full_name)
+        FROM content.person_film_work other
+        JOIN content.person p ON p.id = other.person_id
+        WHERE other.film_work_id = pfw.film_work_id
+            AND other.role = 'director'
+    ) END AS value_names
+FROM content.person_film_work pfw
+WHERE pfw.person_id = ANY(%(ids)s::uuid[])
+GROUP BY pfw.film_work_id, pfw.person_id
+"""
+
+# Фильмы переименованных жанров и текущие списки жанров этих фильмов: в документе у жанров нет id
+GENRE_RENAME_LINKS_REQUEST = """
+SELECT
+    gfw.film_work_id AS id,
+    gfw.genre_id AS data_id,
+    ARRAY['genre'] AS roles,
+    (
+        SELECT ARRAY_AGG(DISTINCT g.name)
+        FROM content.genre_film_work other
+        JOIN content.genre g ON g.id = other.genre_id
+        WHERE other.film_work_id = gfw.film_work_id
+    ) AS value_names
+FROM content.genre_film_work gfw
+WHERE gfw.genre_id = ANY(%(ids)s::uuid[])
+GROUP BY gfw.film_work_id, gfw.genre_id
+"""
+
+# таблицы, изменения названий в которых можно перенести в документы частичным обновлением:
+# колонка с названием и запрос связанных фильмов
+RENAME_SOURCES = {
+    'content.person': ('full_name', PERSON_RENAME_LINKS_REQUEST),
+    'content.genre': ('name', GENRE_RENAME_LINKS_REQUEST),
+}
+
+MIN_ID = '00000000-0000-0000-0000-000000000000'
+
+NOTIFY_CHANNEL = 'etl_changes'
+
+NOTIFY_TRIGGERS_REQUEST = """
+CREATE OR REPLACE FUNCTION content.etl_notify_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME IN ('person_film_work', 'genre_film_work') THEN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM pg_notify('etl_changes', 'content.film_work:' || OLD.film_work_id);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_notify('etl_changes', 'content.film_work:' || NEW.film_work_id);
+        END IF;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('etl_changes', TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME || ':' || OLD.id);
+    ELSE
+        PERFORM pg_notify('etl_changes', TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME || ':' || NEW.id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS etl_notify_change ON content.film_work;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON content.film_work
+    FOR EACH ROW EXECUTE PROCEDURE content.etl_notify_change();
+DROP TRIGGER IF EXISTS etl_notify_change ON content.person;
+CREATE TRIGGER etl_notify_change AFTER UPDATE ON content.person
+    FOR EACH ROW EXECUTE PROCEDURE content.etl_notify_change();
+DROP TRIGGER IF EXISTS etl_notify_change ON content.genre;
+CREATE TRIGGER etl_notify_change AFTER UPDATE ON content.genre
+    FOR EACH ROW EXECUTE PROCEDURE content.etl_notify_change();
+DROP TRIGGER IF EXISTS etl_notify_change ON content.person_film_work;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON content.person_film_work
+    FOR EACH ROW EXECUTE PROCEDURE content.etl_notify_change();
+DROP TRIGGER IF EXISTS etl_notify_change ON content.genre_film_work;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON content.genre_film_work
+    FOR EACH ROW EXECUTE PROCEDURE content.etl_notify_change();
+"""
+
+# Журнал удалений: удаление фильма, а также удаление или изменение связей фильма с людьми и жанрами
+# записывает id фильма. Фильмы, которых больше нет в БД, удаляются из ES, остальные пересобираются
+DELETION_LOG_REQUEST = """
+CREATE TABLE IF NOT EXISTS content.etl_deletion_log (
+    id bigserial PRIMARY KEY,
+    table_name text NOT NULL,
+    film_work_id uuid NOT NULL,
+    created_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE FUNCTION content.etl_log_deletion() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'film_work' THEN
+        INSERT INTO content.etl_deletion_log (table_name, film_work_id) VALUES (TG_TABLE_NAME, OLD.id);
+        RETURN NULL;
+    END IF;
+    INSERT INTO content.etl_deletion_log (table_name, film_work_id) VALUES (TG_TABLE_NAME, OLD.film_work_id);
+    IF TG_OP = 'UPDATE' AND NEW.film_work_id <> OLD.film_work_id THEN
+        INSERT INTO content.etl_deletion_log (table_name, film_work_id) VALUES (TG_TABLE_NAME, NEW.film_work_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS etl_log_deletion ON content.film_work;
+CREATE TRIGGER etl_log_deletion AFTER DELETE ON content.film_work
+    FOR EACH ROW EXECUTE PROCEDURE content.etl_log_deletion();
+DROP TRIGGER IF EXISTS etl_log_deletion ON content.person_film_work;
+CREATE TRIGGER etl_log_deletion AFTER UPDATE OR DELETE ON content.person_film_work
+    FOR EACH ROW EXECUTE PROCEDURE content.etl_log_deletion();
+DROP TRIGGER IF EXISTS etl_log_deletion ON content.genre_film_work;
+CREATE TRIGGER etl_log_deletion AFTER UPDATE OR DELETE ON content.genre_film_work
+    FOR EACH ROW EXECUTE PROCEDURE content.etl_log_deletion();
+"""
+
+DELETION_LOG_READ_REQUEST = """
+SELECT id, film_work_id
+FROM content.etl_deletion_log
+ORDER BY id
+LIMIT %(limit)s
+"""
+
+DELETION_LOG_PENDING_REQUEST = """
+SELECT EXISTS (SELECT 1 FROM content.etl_deletion_log) AS pending
 """
-SQL_REQUEST = """
-SELECT "content"."film_work"."id","content"."film_work"."title", "content"."film_work"."description",
-       "content"."film_work"."rating",
-       ARRAY_AGG(DISTINCT "content"."genre"."name" ) AS "genre",
-       Json_agg(DISTINCT ("content"."person"."id", "content"."person"."full_name"))
-           FILTER (WHERE "content"."person_film_work"."role" = 'actor') AS "actors",
-       ARRAY_AGG(DISTINCT "content"."person"."full_name" ) FILTER (WHERE "content"."person_film_work"."role" = 'actor')
-           AS "actors_names",
-       ARRAY_AGG(DISTINCT ("content"."person"."full_name"))
-           FILTER (WHERE "content"."person_film_work"."role" = 'director') AS "director",
-       Json_agg(DISTINCT ("content"."person"."id", "content"."person"."full_name") )
-           FILTER (WHERE "content"."person_film_work"."role" = 'writer') AS "writers",
-       ARRAY_AGG(DISTINCT ("content"."person"."full_name") )
-           FILTER (WHERE "content"."person_film_work"."role" = 'writer') AS "writers_names"
-FROM "content"."film_work"
-    INNER JOIN "content"."genre_film_work"
-        ON ("content"."film_work"."id" = "content"."genre_film_work"."film_work_id")
-    LEFT OUTER JOIN "content"."genre"
-        ON ("content"."genre_film_work"."genre_id" = "content"."genre"."id")
-    LEFT OUTER JOIN "content"."person_film_work"
-        ON ("content"."film_work"."id" = "content"."person_film_work"."film_work_id")
-    LEFT OUTER JOIN "content"."person"
-        ON ("content"."person_film_work"."person_id" = "content"."person"."id")
-GROUP BY "content"."film_work"."id"
+
+# варианты запросов для нескольких экземпляров сервиса: только записи о фильмах своих партиций
+DELETION_LOG_PARTITION_FILTER = PARTITION_SQL.format(column='film_work_id') + ' IN %(partitions)s'
+
+DELETION_LOG_PARTITION_READ_REQUEST = """
+SELECT id, film_work_id
+FROM content.etl_deletion_log
+WHERE """ + DELETION_LOG_PARTITION_FILTER + """
+ORDER BY id
+LIMIT %(limit)s
+"""
+
+DELETION_LOG_PARTITION_PENDING_REQUEST = """
+SELECT EXISTS (SELECT 1 FROM content.etl_deletion_log WHERE """ + DELETION_LOG_PARTITION_FILTER + """) AS pending
+"""
+
+DELETION_LOG_CLEAR_REQUEST = """
+DELETE FROM content.etl_deletion_log
+WHERE id IN %(ids)s
+"""
+
+EXISTING_FILMS_REQUEST = """
+SELECT id
+FROM content.film_work
+WHERE id IN %(films_id)s
 """
 
 
 class PostgresExctract:
 
-    def __init__(self, settings):
+    def __init__(self, settings, min_connections: int = 1, max_connections: int = 5, health_check_interval: int = 30):
         self.settings = settings
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.health_check_interval = health_check_interval
+        self.pool = None
+        self.stats = {'acquired': 0, 'discarded': 0}
+        self._last_used = {}
 
-    def postgres_request(self, sql_request, params=None, n=200) -> Generator:
+    def postgres_request(self, sql_request, params=None, n=200, query_name: str = 'query') -> Generator:
         """
-        Исполняющий метод. По выпонении закрывает соединение
+        Исполняющий метод. Берет соединение из пула и по выполнении возвращает его обратно
         :param sql_request: запрос для исполнения
         :param params: параметр для подстановки в запрос
         :param n: размер пачки данных запроса возвращаемых через один цикл
+        :param query_name: название запроса для метрик
         :return:
         """
-        self._create_connection()
-        self.cursor.execute(sql_request, params)
-        while True:
-            out = self.cursor.fetchmany(n)
-            if not out:
-                break
-            yield out
-        self._close_connection()
+        connection = self._get_connection()
+        try:
+            with connection.cursor(cursor_factory=DictCursor) as cursor:
+                with QUERY_DURATION.time(query=query_name):
+                    cursor.execute(sql_request, params)
+                while True:
+                    out = cursor.fetchmany(n)
+                    if not out:
+                        break
+                    ROWS_EXTRACTED.inc(len(out), query=query_name)
+                    yield out
+        finally:
+            self._put_connection(connection)
+
+    def postgres_execute(self, sql_request, params=None) -> None:
+        """
+        Исполняет запрос, не возвращающий данных, и фиксирует транзакцию
+        :param sql_request: запрос для исполнения
+        :param params: параметр для подстановки в запрос
+        :return:
+        """
+        connection = self._get_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql_request, params)
+            connection.commit()
+        finally:
+            self._put_connection(connection)
 
     @backoff(logger)
-    def _create_connection(self) -> None:
+    def _get_connection(self):
+        """
+        Получаем соединение из пула. Если соединение долго простаивало, проверяем что оно живое
+        :return: соединение с БД
+        """
+        if self.pool is None:
+            self.pool = ThreadedConnectionPool(self.min_connections, self.max_connections, **self.settings)
+            logger.info(f'Создан пул соединений с БД ({self.min_connections}-{self.max_connections})')
+        connection = self.pool.getconn()
+        last_used = self._last_used.get(id(connection), 0)
+        if connection.closed or time.monotonic() - last_used > self.health_check_interval:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                connection.rollback()
+            except psycopg2.Error:
+                self._put_connection(connection, broken=True)
+                raise
+        self.stats['acquired'] += 1
+        return connection
+
+    def _put_connection(self, connection, broken: bool = False) -> None:
         """
-        Создаем соединение
+        Возвращаем соединение в пул. Разорванное соединение закрываем
+        :param connection: соединение с БД
+        :param broken: признак того, что соединение неработоспособно
+        :return:
+        """
+        if self.pool is None or self.pool.closed:
+            return
+        broken = broken or bool(connection.closed)
+        if broken:
+            self.stats['discarded'] += 1
+            self._last_used.pop(id(connection), None)
+        else:
+            self._last_used[id(connection)] = time.monotonic()
+        self.pool.putconn(connection, close=broken)
+
+    def log_pool_stats(self) -> None:
+        """
+        Выводим в лог статистику пула соединений
+        :return:
+        """
+        if self.pool is None or self.pool.closed:
+            logger.info('Пул соединений с БД не создан')
+            return
+        logger.info(f'Пул соединений: занято {len(self.pool._used)}, свободно {len(self.pool._pool)}, '
+                    f'выдано {self.stats["acquired"]}, закрыто разорванных {self.stats["discarded"]}')
+
+    def close(self) -> None:
+        """
+        Закрываем все соединения пула
+        :return:
+        """
+        if self.pool is not None and not self.pool.closed:
+            self.pool.closeall()
+        self.pool = None
+
+
+class ChangeListener:
+    """
+    Получение уведомлений об изменениях в БД через LISTEN/NOTIFY. Уведомления отправляют триггеры
+    из NOTIFY_TRIGGERS_REQUEST в формате "<таблица>:<id>"
+    """
+
+    def __init__(self, settings, channel: str = NOTIFY_CHANNEL, debounce: float = 0.5, max_batch: int = 1000):
+        self.settings = settings
+        self.channel = channel
+        self.debounce = debounce
+        self.max_batch = max_batch
+        self.connection = None
+
+    @backoff(logger)
+    def _connect(self) -> None:
+        """
+        Создаем отдельное соединение в режиме autocommit и подписываемся на канал
         :return:
         """
         self.connection = psycopg2.connect(**self.settings)
-        self.cursor = self.connection.cursor(cursor_factory=DictCursor)
+        self.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {self.channel}')
+        logger.info(f'Подписались на уведомления канала {self.channel}')
+
+    def wait(self, timeout: float) -> Dict[str, Set[str]]:
+        """
+        Ждем уведомлений не дольше timeout секунд. После первого уведомления дособираем пачку
+        в течение debounce секунд или до max_batch уведомлений
+        :param timeout: максимальное время ожидания
+        :return: словарь {название таблицы: множество id измененных записей}
+        """
+        if self.connection is None or self.connection.closed:
+            self._connect()
+        changes = defaultdict(set)
+        received = 0
+        deadline = time.monotonic() + timeout
+        while received < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                if select.select([self.connection], [], [], remaining) == ([], [], []):
+                    continue
+                self.connection.poll()
+            except (psycopg2.Error, OSError) as e:
+                logger.error(f'Потеряно соединение для получения уведомлений: {e}')
+                self.close()
+                break
+            if not received and self.connection.notifies:
+                deadline = min(deadline, time.monotonic() + self.debounce)
+            while self.connection.notifies:
+                table, _, row_id = self.connection.notifies.pop(0).payload.partition(':')
+                changes[table].add(row_id)
+                received += 1
+        if received:
+            logger.info(f'Получено уведомлений об изменениях: {received}')
+        return changes
 
-    def _close_connection(self) -> None:
+    def close(self) -> None:
         """
-        Проверяем что соединение существует, и курсор не закрыт, то закрываем
+        Закрываем соединение
         :return:
         """
-        if self.connection:
-            if not self.cursor.closed:
-                self.cursor.close()
+        if self.connection is not None and not self.connection.closed:
             self.connection.close()
+        self.connection = None
+
+
+def install_notify_triggers(postgres: PostgresExctract) -> None:
+    """
+    Создаем триггеры, отправляющие уведомления об изменениях в таблицах content
+    :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :return:
+    """
+    postgres.postgres_execute(NOTIFY_TRIGGERS_REQUEST)
+    logger.info('Триггеры уведомлений об изменениях созданы')
+
+
+def install_deletion_log(postgres: PostgresExctract) -> None:
+    """
+    Создаем журнал удалений и триггеры, которые его заполняют
+    :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :return:
+    """
+    postgres.postgres_execute(DELETION_LOG_REQUEST)
+    logger.info('Журнал удалений и его триггеры созданы')
+
+
+def get_deletion_log(postgres: PostgresExctract, limit: int = 100, partitions: Optional[Set[int]] = None,
+                     partition_count: int = 0) -> List[dict]:
+    """
+    Первые записи журнала удалений. Записи удаляются из журнала после обработки, поэтому журнал
+    читается как очередь, без отметки последней прочитанной записи
+    :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param limit: максимальное количество записей
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :param partition_count: общее количество партиций
+    :return: список словарей {'id': id записи журнала, 'film_work_id': id фильма}
+    """
+    request = DELETION_LOG_READ_REQUEST
+    params = {'limit': limit}
+    if partitions is not None:
+        request = DELETION_LOG_PARTITION_READ_REQUEST
+        params.update(partitions=tuple(partitions), partition_count=partition_count)
+    result = postgres.postgres_request(request, params, query_name='deletion_log')
+    return [{'id': row['id'], 'film_work_id': str(row['film_work_id'])} for rows in result for row in rows]
+
+
+def has_pending_deletions(postgres: PostgresExctract, partitions: Optional[Set[int]] = None,
+                          partition_count: int = 0) -> bool:
+    """
+    Проверка наличия необработанных записей в журнале удалений
+    :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :param partition_count: общее количество партиций
+    :return: True, если в журнале есть записи
+    """
+    if partitions is None:
+        result = postgres.postgres_request(DELETION_LOG_PENDING_REQUEST, query_name='deletion_log_pending')
+    else:
+        result = postgres.postgres_request(DELETION_LOG_PARTITION_PENDING_REQUEST,
+                                           {'partitions': tuple(partitions), 'partition_count': partition_count},
+                                           query_name='deletion_log_pending')
+    return [row for rows in result for row in rows][0]['pending']
+
+
+def clear_deletion_log(postgres: PostgresExctract, ids: List[int]) -> None:
+    """
+    Удаляем обработанные записи журнала удалений
+    :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param ids: список id записей журнала
+    :return:
+    """
+    if ids:
+        postgres.postgres_execute(DELETION_LOG_CLEAR_REQUEST, {'ids': tuple(ids)})
+
+
+def get_existing_films(postgres: PostgresExctract, films_id: Set[str]) -> Set[str]:
+    """
+    Отбираем фильмы, которые есть в БД
+    :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param films_id: множество id фильмов
+    :return: множество id фильмов, которые есть в БД
+    """
+    result = postgres.postgres_request(EXISTING_FILMS_REQUEST, {'films_id': tuple(films_id)},
+                                       query_name='existing_films')
+    return {str(row['id']) for rows in result for row in rows}
 
 
-def get_film_list_id(postgres: PostgresExctract, data_id: tuple, table: str, field: str) -> Generator:
+def get_film_list_id(postgres: PostgresExctract, data_id: tuple, table: str, field: str, n: int = 200,
+                     partitions: Optional[Set[int]] = None, partition_count: int = 0) -> Generator:
     """
     :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
-    :param data_id: кортеж с id фильмов
+    :param data_id: кортеж с id записей связанной таблицы
     :param table: название тадлицы для линкования(Join)
     :param field: поле по которому буде идти сравнение
-    :return:
+    :param n: размер пачки id фильмов
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :param partition_count: общее количество партиций
+    :return: Генератор пачек id фильмов
     """
-    film_list = postgres.postgres_request(FILM_REQUEST,
-                                          {'persons': data_id, 'table': AsIs(table), 'field': AsIs(field)})
+    request = FILM_REQUEST
+    params = {'persons': data_id, 'table': AsIs(table), 'field': AsIs(field)}
+    if partitions is not None:
+        request = FILM_PARTITION_REQUEST
+        params.update(partitions=tuple(partitions), partition_count=partition_count)
+    film_list = postgres.postgres_request(request, params, n, 'related_films')
     return film_list
 
 
-def prepare_filmwork_update(postgres: PostgresExctract, last_request_time: datetime, table: str) -> Generator:
+def get_names(postgres: PostgresExctract, table: str, data_id: Set[str]) -> Dict[str, str]:
+    """
+    Текущие названия записей таблицы из RENAME_SOURCES
+    :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param table: название таблицы
+    :param data_id: множество id записей
+    :return: словарь {id: название}, удаленные записи в него не попадают
+    """
+    column = RENAME_SOURCES[table][0]
+    result = postgres.postgres_request(NAMES_REQUEST, {'table': AsIs(table), 'column': AsIs(column),
+                                                       'ids': tuple(data_id)}, query_name='names')
+    return {str(row['id']): row['name'] for rows in result for row in rows}
+
+
+def get_rename_links(postgres: PostgresExctract, table: str, data_id: Iterable[str]) -> List[dict]:
     """
-    Функция для отслеживания изменений в таблицах БД
+    Фильмы, связанные с переименованными записями таблицы из RENAME_SOURCES
     :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
-    :param last_request_time: время последнего запроса
+    :param table: название таблицы
+    :param data_id: id переименованных записей
+    :return: список словарей {'id': id фильма, 'data_id': id записи, 'roles': роли,
+             'value_names': текущий список режиссеров или жанров фильма, если запись в этой роли}
+    """
+    result = postgres.postgres_request(RENAME_SOURCES[table][1], {'ids': list(data_id)}, query_name='rename_links')
+    return [{'id': str(row['id']), 'data_id': str(row['data_id']), 'roles': row['roles'],
+             'value_names': row['value_names'] or []} for rows in result for row in rows]
+
+
+def prepare_filmwork_update(postgres: PostgresExctract, watermark: dict, table: str, limit: int = 100,
+                            partitions: Optional[Set[int]] = None, partition_count: int = 0,
+                            horizon: Optional[datetime] = None) -> List[dict]:
+    """
+    Функция для отслеживания изменений в таблицах БД. Возвращает не более limit записей,
+    измененных после отметки (updated_at, id) и до границы сканирования
+    :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param watermark: отметка последней обработанной записи {'updated_at': ..., 'id': ...}
     :param table:название тадлицы для линкования(Join)
+    :param limit: максимальное количество записей
+    :param partitions: партиции фильмов, к которым относятся записи (только для content.film_work),
+                       или None, если отбирать по партициям не нужно
+    :param partition_count: общее количество партиций
+    :param horizon: граница сканирования (см. get_scan_horizon), если не задана - получается запросом
+    :return: Список измененных записей, упорядоченный по (updated_at, id)
+    """
+    request = FILM_UPDATE_REQUEST
+    params = {'updatedat': watermark['updated_at'], 'last_id': watermark['id'], 'table': AsIs(table), 'limit': limit,
+              'horizon': horizon or get_scan_horizon(postgres)}
+    if partitions is not None:
+        request = FILM_UPDATE_PARTITION_REQUEST
+        params.update(partitions=tuple(partitions), partition_count=partition_count)
+    film_to_update = postgres.postgres_request(request, params, limit, 'updates')
+    return [dict(row) for rows in film_to_update for row in rows]
+
+
+def get_watermark(row: dict) -> dict:
+    """
+    Отметка последней обработанной записи для сохранения в хранилище состояния
+    :param row: запись с полями id и updated_at
+    :return: словарь отметки
+    """
+    return {'updated_at': row['updated_at'].isoformat(), 'id': str(row['id'])}
+
+
+def get_scan_horizon(postgres: PostgresExctract, max_lag: float = 0) -> datetime:
+    """
+    Граница сканирования обновлений: записи, измененные не раньше нее, могут принадлежать незафиксированным
+    транзакциям и читаются следующим циклом (см. SCAN_HORIZON_REQUEST)
+    :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param max_lag: отставание границы от текущего времени в секундах, после которого выводится предупреждение,
+                    0 - не проверять
+    :return: время границы
+    """
+    result = postgres.postgres_request(SCAN_HORIZON_REQUEST, query_name='scan_horizon')
+    row = [row for rows in result for row in rows][0]
+    return check_scan_horizon(row['horizon'], row['now'], max_lag)
+
+
+def check_scan_horizon(horizon: datetime, now: datetime, max_lag: float = 0) -> datetime:
+    """
+    Отставание границы сканирования от текущего времени: пока долгая транзакция не завершена, сканирование
+    обновлений не продвигается дальше ее начала
+    :param horizon: граница сканирования
+    :param now: текущее время БД
+    :param max_lag: отставание в секундах, после которого выводится предупреждение, 0 - не проверять
+    :return: граница сканирования
+    """
+    lag = (now - horizon).total_seconds()
+    SCAN_HORIZON_LAG.set(lag)
+    if max_lag and lag > max_lag:
+        logger.warning(f'Граница сканирования обновлений отстает на {lag:.0f} сек.: в БД есть транзакция, '
+                       f'начатая в {horizon}, изменения после этого момента не загружаются до ее завершения')
+    return horizon
+
+
+def check_stats_access(postgres: PostgresExctract) -> None:
+    """
+    Проверяем, что роль сервиса видит транзакции других сеансов, иначе граница сканирования
+    их не учитывает и изменения долгих транзакций могут быть пропущены
+    :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
     :return:
     """
-    params = {'updatedat': last_request_time, 'table': AsIs(table)}
-    film_to_update = postgres.postgres_request(FILM_UPDATE_REQUEST, params)
-    return film_to_update
+    result = postgres.postgres_request(STATS_ACCESS_REQUEST, query_name='stats_access')
+    if not [row for rows in result for row in rows][0]['allowed']:
+        raise RuntimeError(STATS_ACCESS_ERROR)
 
 
-def film_get_result_data(postgres: PostgresExctract, films: Tuple[dict]) -> Generator:
+def get_initial_watermark(postgres: PostgresExctract) -> dict:
+    """
+    Отметка, начиная с которой отслеживаются изменения, если сохраненной отметки нет: граница сканирования,
+    чтобы не пропустить изменения транзакций, которые зафиксируются после получения отметки
+    :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :return: словарь отметки
+    """
+    return {'updated_at': get_scan_horizon(postgres).isoformat(), 'id': MIN_ID}
+
+
+def get_max_updated_at(postgres: PostgresExctract, table: str) -> Optional[datetime]:
+    """
+    Время последнего изменения записей таблицы
+    :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param table: название таблицы
+    :return: время последнего изменения или None, если таблица пуста
+    """
+    result = postgres.postgres_request(MAX_UPDATED_AT_REQUEST, {'table': AsIs(table)}, query_name='max_updated_at')
+    return [row for rows in result for row in rows][0]['updated_at']
+
+
+def get_newest_position(postgres: PostgresExctract, table: str, partitions: Optional[Set[int]] = None,
+                        partition_count: int = 0) -> Optional[Tuple[datetime, str]]:
+    """
+    Позиция последней измененной записи таблицы в порядке сканирования обновлений
+    :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param table: название таблицы
+    :param partitions: партиции фильмов экземпляра, если таблица - таблица фильмов, иначе None
+    :param partition_count: общее количество партиций фильмов
+    :return: кортеж (updated_at, id) или None, если таблица пуста
+    """
+    if partitions is not None:
+        result = postgres.postgres_request(NEWEST_ROW_PARTITION_REQUEST, {
+            'table': AsIs(table), 'partitions': tuple(partitions), 'partition_count': partition_count,
+        }, query_name='newest_row')
+    else:
+        result = postgres.postgres_request(NEWEST_ROW_REQUEST, {'table': AsIs(table)}, query_name='newest_row')
+    rows = [row for rows in result for row in rows]
+    if not rows:
+        return None
+    return rows[0]['updated_at'], str(rows[0]['id'])
+
+
+@timed('film_get_result_data')
+def film_get_result_data(postgres: PostgresExctract, films: Tuple[str], n: int = 200) -> Generator:
     """
     Получаем информацию о фильмах в которых произошли изменения
     :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
-    :param films: кортеж словарей с id фиильмов
+    :param films: кортеж с id фиильмов
+    :param n: размер пачки данных
     :return: Генератор с результатом выполнения запроса
     """
-    film_result = postgres.postgres_request(FILM_REQUEST_PREPARE, {'films_id': films})
+    film_result = postgres.postgres_request(FILM_REQUEST_PREPARE, {'films_id': films}, n, 'films')
     return film_result
 
 
-def get_all_film_to_upload(postgres: PostgresExctract) -> Generator:
+def get_all_film_to_upload(postgres: PostgresExctract, page_size: int = 200,
+                           last_id: Optional[str] = None) -> Generator:
     """
-    Функция для выполнения запроса получения сведений обо всех фильмах в БД
+    Функция для получения сведений обо всех фильмах в БД постранично по id фильма (keyset pagination).
+    Каждая страница - отдельный запрос, поэтому в памяти находится не больше одной страницы
     :param postgres: экземпляр класса  PostgresExctract для выполнения запроса в БД
-    :return: Генератор сс результатом выполнения запроса в БД
+    :param page_size: количество фильмов на странице
+    :param last_id: id фильма, после которого начинается выгрузка
+    :return: Генератор со страницами результата выполнения запроса в БД
     """
-    results = postgres.postgres_request(SQL_REQUEST)
-    return results
+    last_id = last_id or MIN_ID
+    while True:
+        params = {'last_id': last_id, 'page_size': page_size}
+        result = postgres.postgres_request(SQL_REQUEST, params, page_size, 'full_load_page')
+        page = [row for rows in result for row in rows]
+        if not page:
+            break
+        yield page
+        if len(page) < page_size:
+            break
+        last_id = page[-1]['id']
 
 
+@timed('adopt_request_result')
 def adopt_request_result(request_result: List[list]) -> List[dict]:
     """
-    Функция изменяет ключи в словарях входного списка
-    :param request_result: Список словарей для изменения
+    Функция преобразует строки результата запроса FILMWORK_SELECT в словари документов для ES
+    :param request_result: Список строк результата запроса
     :return: Итоговоый список словарей
     """
-    out = []
-    for result in request_result:
-        result = dict(result)
-        if result['actors']:
-            result['actors'] = [{'id': actor['f1'], 'name': actor['f2']} for actor in result['actors']]
-        else:
-            result['actors'] = []
-        if result['writers']:
-            result['writers'] = [{'id': writer['f1'], 'name': writer['f2']} for writer in result['writers']]
-        else:
-            result['writers'] = []
-        out.append(result)
-    return out
+    return [dict(result) for result in request_result]
@@ -0,0 +1,220 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+from typing import Dict, Iterable, List
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# ограничение SQLite на количество параметров в одном запросе
+SQLITE_MAX_PARAMS = 500
+
+
+class FingerprintStore:
+    """
+    Локальное хранилище отпечатков документов, загруженных в ES: id документа -> хеш сериализованного документа.
+    Позволяет не отправлять в ES документы, которые не изменились. При превышении max_entries
+    удаляются записи, которые дольше всего не обновлялись. Кроме отпечатков хранит названия людей и жанров,
+    перенесенные в ES, чтобы при переименовании заменить старое название в документах частичным обновлением
+    """
+
+    def __init__(self, file_path: str, max_entries: int = 1000000):
+        self.max_entries = max_entries
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS fingerprint (id TEXT PRIMARY KEY, hash BLOB NOT NULL, touched INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS fingerprint_touched ON fingerprint (touched);
+            CREATE TABLE IF NOT EXISTS name (source TEXT NOT NULL, id TEXT NOT NULL, name TEXT NOT NULL,
+                                             PRIMARY KEY (source, id));
+        """)
+        self._clock = self.connection.execute('SELECT COALESCE(MAX(touched), 0) FROM fingerprint').fetchone()[0]
+        # количество отпечатков считается один раз и дальше поддерживается в памяти, чтобы проверка max_entries
+        # при каждом сохранении не просматривала всю таблицу
+        self._size = self.connection.execute('SELECT COUNT(*) FROM fingerprint').fetchone()[0]
+
+    @staticmethod
+    def get_hash(document: dict) -> bytes:
+        """
+        Хеш документа, не зависящий от порядка ключей
+        :param document: словарь с данными документа
+        :return: хеш
+        """
+        serialized = json.dumps(document, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.blake2b(serialized.encode(), digest_size=16).digest()
+
+    def _get_hashes(self, ids: List[str]) -> dict:
+        """
+        Получаем сохраненные хеши документов
+        :param ids: список id документов
+        :return: словарь {id: хеш}
+        """
+        hashes = {}
+        for i in range(0, len(ids), SQLITE_MAX_PARAMS):
+            chunk = ids[i:i + SQLITE_MAX_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(f'SELECT id, hash FROM fingerprint WHERE id IN ({placeholders})', chunk)
+            hashes.update(rows)
+        return hashes
+
+    def _count_existing(self, ids: List[str]) -> int:
+        """
+        Количество документов, для которых уже сохранен хеш
+        :param ids: список id документов без повторов
+        :return: количество
+        """
+        count = 0
+        for i in range(0, len(ids), SQLITE_MAX_PARAMS):
+            chunk = ids[i:i + SQLITE_MAX_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            count += self.connection.execute(f'SELECT COUNT(*) FROM fingerprint WHERE id IN ({placeholders})',
+                                             chunk).fetchone()[0]
+        return count
+
+    def filter_changed(self, documents: List[dict]) -> List[dict]:
+        """
+        Отбрасываем документы, которые не изменились с момента последней загрузки в ES
+        :param documents: список словарей с данными документов
+        :return: список измененных документов
+        """
+        with self._lock:
+            hashes = self._get_hashes([str(document['id']) for document in documents])
+        changed = [document for document in documents if hashes.get(str(document['id'])) != self.get_hash(document)]
+        self.stats['hits'] += len(documents) - len(changed)
+        self.stats['misses'] += len(changed)
+        return changed
+
+    def save(self, documents: List[dict], exclude: Iterable[str] = ()) -> None:
+        """
+        Сохраняем хеши загруженных в ES документов
+        :param documents: список словарей с данными документов
+        :param exclude: id документов, которые не удалось сохранить в ES
+        :return:
+        """
+        exclude = set(exclude)
+        with self._lock:
+            rows = {}
+            for document in documents:
+                if str(document['id']) in exclude:
+                    continue
+                self._clock += 1
+                rows[str(document['id'])] = (str(document['id']), self.get_hash(document), self._clock)
+            with self.connection:
+                self._size += len(rows) - self._count_existing(list(rows))
+                self.connection.executemany('INSERT OR REPLACE INTO fingerprint (id, hash, touched) VALUES (?, ?, ?)',
+                                            rows.values())
+                if exclude:
+                    self._delete(list(exclude))
+                self._evict()
+
+    def invalidate(self, ids: Iterable[str]) -> None:
+        """
+        Удаляем хеши документов, содержимое которых в ES изменилось в обход хранилища
+        :param ids: id документов
+        :return:
+        """
+        with self._lock, self.connection:
+            self._delete([str(doc_id) for doc_id in ids])
+
+    def _delete(self, ids: List[str]) -> None:
+        """
+        Удаляем хеши документов
+        :param ids: список id документов
+        :return:
+        """
+        for i in range(0, len(ids), SQLITE_MAX_PARAMS):
+            chunk = ids[i:i + SQLITE_MAX_PARAMS]
+            self._size -= self.connection.execute(f'DELETE FROM fingerprint WHERE id IN ({",".join("?" * len(chunk))})',
+                                                  chunk).rowcount
+
+    def _evict(self) -> None:
+        """
+        Удаляем записи, которые дольше всего не обновлялись, если превышен max_entries
+        :return:
+        """
+        if self._size <= self.max_entries:
+            return
+        evicted = self.connection.execute('DELETE FROM fingerprint WHERE id IN '
+                                          '(SELECT id FROM fingerprint ORDER BY touched LIMIT ?)',
+                                          (self._size - self.max_entries,)).rowcount
+        self._size -= evicted
+        self.stats['evicted'] += evicted
+
+    def get_names(self, source: str, ids: List[str]) -> Dict[str, str]:
+        """
+        Получаем названия записей, перенесенные в ES
+        :param source: название таблицы
+        :param ids: список id записей
+        :return: словарь {id: название}, записи без сохраненного названия в него не попадают
+        """
+        names = {}
+        with self._lock:
+            for i in range(0, len(ids), SQLITE_MAX_PARAMS):
+                chunk = ids[i:i + SQLITE_MAX_PARAMS]
+                placeholders = ','.join('?' * len(chunk))
+                names.update(self.connection.execute(f'SELECT id, name FROM name WHERE source = ? '
+                                                     f'AND id IN ({placeholders})', [source] + chunk))
+        return names
+
+    def save_names(self, source: str, names: Dict[str, str]) -> None:
+        """
+        Сохраняем названия записей после того, как они перенесены в ES
+        :param source: название таблицы
+        :param names: словарь {id: название}
+        :return:
+        """
+        with self._lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO name (source, id, name) VALUES (?, ?, ?)',
+                                        [(source, data_id, name) for data_id, name in names.items()])
+
+    def clear_names(self) -> None:
+        """
+        Удаляем сохраненные названия записей
+        :return:
+        """
+        with self._lock, self.connection:
+            self.connection.execute('DELETE FROM name')
+
+    def clear(self) -> None:
+        """
+        Удаляем все отпечатки и сохраненные названия
+        :return:
+        """
+        with self._lock, self.connection:
+            self.connection.execute('DELETE FROM fingerprint')
+            self.connection.execute('DELETE FROM name')
+            self._size = 0
+        logger.info('Хранилище отпечатков документов очищено')
+
+    def rebuild(self, pages: Iterable[List[dict]]) -> None:
+        """
+        Заполняем хранилище заново по документам, находящимся в ES
+        :param pages: итерируемый объект со списками документов из ES
+        :return:
+        """
+        self.clear()
+        total = 0
+        for documents in pages:
+            self.save(documents)
+            total += len(documents)
+        logger.info(f'Хранилище отпечатков документов восстановлено по данным ES: {total} документов')
+
+    def log_stats(self) -> None:
+        """
+        Выводим в лог статистику использования хранилища
+        :return:
+        """
+        checked = self.stats['hits'] + self.stats['misses']
+        hit_rate = self.stats['hits'] / checked * 100 if checked else 0
+        logger.info(f'Отпечатки документов: без изменений {self.stats["hits"]}, изменено {self.stats["misses"]}, '
+                    f'доля неизмененных {hit_rate:.1f}%, вытеснено {self.stats["evicted"]}')
+
+    def close(self) -> None:
+        """
+        Закрываем соединение с SQLite
+        :return:
+        """
+        self.connection.close()
@@ -1,21 +1,48 @@
+import asyncio
 import logging
 import os
+import signal
+import threading
 import time
-from dataclasses import asdict
+from collections import defaultdict
 from datetime import datetime
-from typing import List, Union
+from itertools import islice
+from typing import Dict, Generator, Iterable, List, Optional, Set, Tuple, Union
 from urllib.parse import urljoin
 
 import requests
 from dotenv import load_dotenv
 
-from postgres_to_es.elastic_loader import ESLoader, load_all_files
-from postgres_to_es.extract import (PostgresExctract, film_get_result_data,
-                                    get_all_film_to_upload, get_film_list_id,
+from postgres_to_es.coordinator import WorkerCoordinator, film_partition
+from postgres_to_es.elastic_loader import (FAILED_FILMS, FULL_LOAD_COMPLETED,
+                                           FULL_LOAD_LAST_ID,
+                                           INDEX_VERSION_LOADED,
+                                           REINDEX_WATERMARK, ESLoader,
+                                           add_failed_films, get_rename_change,
+                                           load_all_files)
+from postgres_to_es.extract import (MIN_ID, RENAME_SOURCES, ChangeListener,
+                                    PostgresExctract, adopt_request_result,
+                                    check_stats_access, clear_deletion_log,
+                                    film_get_result_data,
+                                    get_all_film_to_upload, get_deletion_log,
+                                    get_existing_films, get_film_list_id,
+                                    get_initial_watermark, get_max_updated_at,
+                                    get_names, get_newest_position,
+                                    get_rename_links, get_scan_horizon,
+                                    get_watermark, has_pending_deletions,
+                                    install_deletion_log,
+                                    install_notify_triggers,
                                     prepare_filmwork_update)
-from postgres_to_es.models import (Filmwork, FilmWorkTables, GenreTables,
-                                   Person, PersonTables)
-from postgres_to_es.utils import JsonFileStorage, State, backoff
+from postgres_to_es.fingerprint import FingerprintStore
+from postgres_to_es.metrics import (CYCLE_DURATION, WATERMARK_LAG,
+                                    start_metrics_server, timed)
+from postgres_to_es.models import (BaseTableClass, FilmWorkTables, GenreTables,
+                                   PersonTables)
+from postgres_to_es.pipeline import Pipeline
+from postgres_to_es.profiling import profiler
+from postgres_to_es.scheduler import PollScheduler
+from postgres_to_es.utils import (JsonFileStorage, PostgresStorage,
+                                  SqliteStorage, State, backoff)
 
 load_dotenv()
 URL = os.environ.get('URL')
@@ -28,70 +55,665 @@ DSL = {
     'port': os.environ.get('DB_PORT'),
     'options': '-c search_path=content'
 }
-SLEEP_TIME = os.environ.get('SLEEP_TIME')
+SLEEP_TIME = int(os.environ.get('SLEEP_TIME', 10))
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 5))
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 200))
+BULK_MAX_DOCS = int(os.environ.get('BULK_MAX_DOCS', 500))
+BULK_MAX_BYTES = int(os.environ.get('BULK_MAX_BYTES', 5 * 1024 * 1024))
+BULK_COMPRESS = os.environ.get('BULK_COMPRESS', '').lower() in ('1', 'true', 'yes')
+BULK_CONCURRENCY = int(os.environ.get('BULK_CONCURRENCY', 2))
+UPDATE_BATCH_SIZE = int(os.environ.get('UPDATE_BATCH_SIZE', 100))
+NOTIFY_MODE = os.environ.get('NOTIFY_MODE', '').lower() in ('1', 'true', 'yes')
+NOTIFY_DEBOUNCE = float(os.environ.get('NOTIFY_DEBOUNCE', 0.5))
+NOTIFY_MAX_BATCH = int(os.environ.get('NOTIFY_MAX_BATCH', 1000))
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 4))
+TRANSFORM_WORKERS = int(os.environ.get('TRANSFORM_WORKERS', 0))
+FINGERPRINT_DB = os.environ.get('FINGERPRINT_DB')
+FINGERPRINT_MAX_ENTRIES = int(os.environ.get('FINGERPRINT_MAX_ENTRIES', 1000000))
+FINGERPRINT_REBUILD = os.environ.get('FINGERPRINT_REBUILD', '').lower() in ('1', 'true', 'yes')
+INDEX_VERSION = os.environ.get('INDEX_VERSION')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_CYCLES = int(os.environ.get('PROFILE_CYCLES', 0))
+PROFILE_MEMORY = os.environ.get('PROFILE_MEMORY', '').lower() in ('1', 'true', 'yes')
+STATE_DB = os.environ.get('STATE_DB')
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', 1))
+ASYNC_MODE = os.environ.get('ASYNC_MODE', '').lower() in ('1', 'true', 'yes')
+ASYNC_CONCURRENCY = int(os.environ.get('ASYNC_CONCURRENCY', 4))
+POLL_ADAPTIVE = os.environ.get('POLL_ADAPTIVE', '').lower() in ('1', 'true', 'yes')
+POLL_MIN_INTERVAL = float(os.environ.get('POLL_MIN_INTERVAL', 1))
+POLL_MAX_INTERVAL = float(os.environ.get('POLL_MAX_INTERVAL', 300))
+POLL_JITTER = float(os.environ.get('POLL_JITTER', 0.1))
+PARTIAL_UPDATES = os.environ.get('PARTIAL_UPDATES', '').lower() in ('1', 'true', 'yes')
+DELETION_LOG = os.environ.get('DELETION_LOG', '').lower() in ('1', 'true', 'yes')
+WORKER_PARTITIONS = int(os.environ.get('WORKER_PARTITIONS', 0))
+SCAN_HORIZON_MAX_LAG = float(os.environ.get('SCAN_HORIZON_MAX_LAG', 300))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# событие остановки сервиса, устанавливается по SIGTERM/SIGINT
+stop_event = threading.Event()
 
-def transform_films(updated_films: List[dict]) -> List[dict]:
-    """
-    Траснформируем данные и заполняем аггрегационные поля данными
-    :param updated_films: список словарей с данными о фильмах
-    :return: список словарей с полями с данными
-    """
-
-    out = {}
-    for film in updated_films:
-        if not out.get(film['fw_id']):
-            film_class = Filmwork(
-                id=film['fw_id'],
-                title=film['title'],
-                rating=film['rating'],
-                description=film['description'],
-                writers=[],
-                actors=[],
-                writers_names=[],
-                actors_names=[],
-                director=[],
-                genre=[])
-            out.update({film['fw_id']: asdict(film_class)})
-        film_class = out.get(film['fw_id'])
-        person = Person(id=film['id'], name=film['full_name'])
-        if film['role'] == 'actor' and film['full_name'] not in film_class['actors_names']:
-            film_class['actors_names'].append(film['full_name'])
-            film_class['actors'].append(asdict(person))
-        elif film['role'] == 'writer' and film['full_name'] not in film_class['writers_names']:
-            film_class['writers_names'].append(film['full_name'])
-            film_class['writers'].append(asdict(person))
-        elif film['role'] == 'director' and film['full_name'] not in film_class['director']:
-            film_class['director'].append(film['full_name'])
-        if film['name'] not in film_class['genre']:
-            film_class['genre'].append(film['name'])
-    return list(out.values())
-
-
-def exchange_app(postgres_request: PostgresExctract, request_time: datetime,
-                 table: Union[PersonTables, GenreTables, FilmWorkTables]) -> List[dict]:
-    """
-    Мониторинг обновлений в БД
-    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
-    :param request_time: время последнего запроса
+
+@timed('exchange_app')
+def exchange_app(postgres_request: PostgresExctract, watermark: dict,
+                 table: Union[PersonTables, GenreTables, FilmWorkTables], batch_size: int = 100,
+                 esl: Optional[ESLoader] = None, fingerprints: Optional[FingerprintStore] = None,
+                 partitions: Optional[List[int]] = None,
+                 horizon: Optional[datetime] = None) -> Tuple[Set[str], Optional[dict], bool, dict]:
+    """
+    Мониторинг обновлений в БД. Читает одну пачку изменений не больше batch_size записей, начиная с отметки
+    последней обработанной записи, и собирает id затронутых фильмов. При нескольких экземплярах сервиса
+    изменения фильмов и связанные фильмы отбираются по партициям в запросах к БД
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param watermark: отметка последней обработанной записи {'updated_at': ..., 'id': ...}
     :param table: список таблиц для передачи в запрос
-    :return: данные об обновлениях
-    """
-    get_updated_data = prepare_filmwork_update(postgres_request, request_time, table.table_to_check_update)
-    get_updated_data = [dict(d) for data in get_updated_data for d in data]
-    id_data = tuple([updated_data['id'] for updated_data in get_updated_data])
-    ready_update = {}
-    if get_updated_data and table.table_list[1]:
-        film_list_id = get_film_list_id(postgres_request, id_data, *table.table_list[1:])
-        id_data = tuple(dict(f) for films in film_list_id for f in films)
-    if id_data:
-        films_result = film_get_result_data(postgres_request, id_data)
-        films_result = [dict(f) for films in films_result for f in films]
-        ready_update = transform_films(films_result)
-    return ready_update
+    :param batch_size: размер пачки изменений
+    :param esl: экземпляр класса ESLoader для частичного обновления документов или None
+    :param fingerprints: хранилище отпечатков документов или None
+    :param partitions: партиции фильмов, для которых читаются изменения, или None, если экземпляр один
+    :param horizon: граница сканирования, изменения не раньше нее читаются следующим циклом
+    :return: id фильмов для загрузки, новая отметка (None, если изменений нет), признак наличия следующей пачки,
+             названия для сохранения после загрузки (см. get_changed_films)
+    """
+    # записи людей и жанров к партициям не относятся, по партициям отбираются связанные с ними фильмы
+    film_partitions = partitions if not table.table_list[1] else None
+    updated_data = prepare_filmwork_update(postgres_request, watermark, table.table_to_check_update, batch_size,
+                                           film_partitions, WORKER_PARTITIONS, horizon)
+    if not updated_data:
+        return set(), None, False, {}
+    films_id, names = get_changed_films(postgres_request, esl, {row['id'] for row in updated_data}, table,
+                                        fingerprints, partitions)
+    return films_id, get_watermark(updated_data[-1]), len(updated_data) == batch_size, names
+
+
+def get_changed_films(postgres_request: PostgresExctract, esl: Optional[ESLoader], data_id: Set[str],
+                      table: BaseTableClass, fingerprints: Optional[FingerprintStore] = None,
+                      partitions: Optional[Iterable[int]] = None) -> Tuple[Set[str], dict]:
+    """
+    Получаем id фильмов, которые нужно пересобрать из-за изменения записей таблицы. Если включены частичные
+    обновления, переименования людей и жанров переносятся в документы сразу через update_renamed_documents
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param esl: экземпляр класса ESLoader для частичного обновления документов или None
+    :param data_id: множество id измененных записей
+    :param table: таблица, в которой произошли изменения
+    :param fingerprints: хранилище отпечатков документов или None
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return: id фильмов для загрузки и названия {id: название}, которые нужно сохранить в хранилище
+             отпечатков после загрузки фильмов
+    """
+    if (PARTIAL_UPDATES and not WORKER_PARTITIONS and esl and fingerprints
+            and table.table_to_check_update in RENAME_SOURCES):
+        return update_renamed_documents(postgres_request, esl, data_id, table, fingerprints)
+    return get_related_films(postgres_request, data_id, table, UPDATE_BATCH_SIZE, partitions), {}
+
+
+def update_renamed_documents(postgres_request: PostgresExctract, esl: ESLoader, data_id: Set[str],
+                             table: BaseTableClass, fingerprints: FingerprintStore) -> Tuple[Set[str], dict]:
+    """
+    Переносим в ES изменения названий людей или жанров частичным обновлением документов: в документах связанных
+    фильмов заменяется только название, без выборки и пересборки фильмов. Старое название берется из хранилища
+    отпечатков. Если его там нет или документа нет в индексе, фильм пересобирается полностью. Записи, название
+    которых не изменилось, на документы не влияют
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param esl: экземпляр класса ESLoader
+    :param data_id: множество id измененных записей
+    :param table: таблица, в которой произошли изменения
+    :param fingerprints: хранилище отпечатков документов
+    :return: id фильмов для полной пересборки и названия {id: название}, которые нужно сохранить
+             в хранилище отпечатков после загрузки фильмов
+    """
+    source = table.table_to_check_update
+    names = get_names(postgres_request, source, data_id)
+    saved_names = fingerprints.get_names(source, list(names))
+    unknown = {name_id for name_id in names if name_id not in saved_names}
+    # Запись с прежним названием пропускается, хотя без PARTIAL_UPDATES ее изменение пересобрало бы все связанные
+    # фильмы. Изменения связей (состав и роли в person_film_work и genre_film_work) в этом случае переносятся только
+    # по updated_at фильма или через журнал удалений (DELETION_LOG)
+    renames = {name_id: (saved_names[name_id], name) for name_id, name in names.items()
+               if name_id in saved_names and saved_names[name_id] != name}
+    films_id = get_related_films(postgres_request, unknown, table, UPDATE_BATCH_SIZE) if unknown else set()
+    changes = defaultdict(list)
+    if renames:
+        for link in get_rename_links(postgres_request, source, renames):
+            changes[link['id']].append(get_rename_change(link['data_id'], renames[link['data_id']][1],
+                                                         link['roles'], link['value_names']))
+    for film_id in films_id:
+        changes.pop(film_id, None)
+    if changes:
+        logger.info(f'Частичное обновление {len(changes)} документов после переименования {len(renames)} записей '
+                    f'{source}')
+        failed = esl.update_documents(changes, INDEX)
+        fingerprints.invalidate(changes)
+        films_id |= set(failed)
+    return films_id, {name_id: names[name_id] for name_id in unknown | set(renames)}
+
+
+def process_deletions(postgres_request: PostgresExctract, esl: ESLoader,
+                      fingerprints: Optional[FingerprintStore] = None, batch_size: int = 100,
+                      partitions: Optional[Set[int]] = None) -> Tuple[Set[str], List[int], bool]:
+    """
+    Обработка пачки записей журнала удалений: фильмы, которых больше нет в БД, удаляются из ES,
+    фильмы, у которых удалены или изменены связи с людьми и жанрами, нужно пересобрать
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param esl: экземпляр класса ESLoader
+    :param fingerprints: хранилище отпечатков документов или None
+    :param batch_size: размер пачки записей журнала
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return: id фильмов для пересборки, id записей журнала, которые можно удалить после загрузки фильмов,
+             признак наличия следующей пачки
+    """
+    entries = get_deletion_log(postgres_request, batch_size, partitions, WORKER_PARTITIONS)
+    if not entries:
+        return set(), [], False
+    films_id = {entry['film_work_id'] for entry in entries}
+    existing = get_existing_films(postgres_request, films_id)
+    deleted = films_id - existing
+    failed = set()
+    if deleted:
+        logger.info(f'Удаляем из Elastic {len(deleted)} удаленных фильмов')
+        failed = set(esl.delete_documents(sorted(deleted), INDEX))
+        if fingerprints:
+            fingerprints.invalidate(deleted)
+    # записи о фильмах, которые не удалось удалить из ES, остаются в журнале до следующего цикла
+    processed = [entry['id'] for entry in entries if entry['film_work_id'] not in failed]
+    return existing, processed, len(entries) == batch_size
+
+
+def get_related_films(postgres_request: PostgresExctract, data_id: Set[str], table: BaseTableClass,
+                      batch_size: int = 100, partitions: Optional[Iterable[int]] = None) -> Set[str]:
+    """
+    Получаем id фильмов, связанных с измененными записями таблицы
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param data_id: множество id измененных записей
+    :param table: таблица, в которой произошли изменения
+    :param batch_size: размер пачки id фильмов
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return: множество id фильмов
+    """
+    if not table.table_list[1]:
+        return filter_partitions(set(data_id), partitions)
+    film_list_id = get_film_list_id(postgres_request, tuple(data_id), *table.table_list[1:], batch_size,
+                                    partitions, WORKER_PARTITIONS)
+    return {film['id'] for films in film_list_id for film in films}
+
+
+def prepare_films(postgres_request: PostgresExctract, films_id: Set[str], batch_size: int = 100) -> Generator:
+    """
+    Получение данных о фильмах, агрегированных в БД, пачками не больше batch_size фильмов
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param films_id: множество id фильмов
+    :param batch_size: размер пачки фильмов
+    :return: Генератор списков строк результата запроса
+    """
+    films_id = sorted(films_id)
+    for i in range(0, len(films_id), batch_size):
+        films_result = film_get_result_data(postgres_request, tuple(films_id[i:i + batch_size]), batch_size)
+        yield [film for films in films_result for film in films]
+
+
+def load_films(postgres_request: PostgresExctract, esl: ESLoader, films_id: Set[str],
+               fingerprints: Optional[FingerprintStore] = None) -> Tuple[bool, Set[str]]:
+    """
+    Загрузка фильмов в ES конвейером: чтение из БД, преобразование и загрузка выполняются одновременно
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param esl: экземпляр класса ESLoader
+    :param films_id: множество id фильмов
+    :param fingerprints: хранилище отпечатков документов или None
+    :return: True, если загружены все фильмы, False, если загрузка остановлена, и id фильмов,
+             которые не удалось сохранить в ES
+    """
+    failed = set()
+    if not films_id:
+        return True, failed
+    pipeline = Pipeline('update', prepare_films(postgres_request, films_id, UPDATE_BATCH_SIZE), [
+        ('transform', lambda film_packs: map(adopt_request_result, film_packs)),
+        ('load', lambda batches: (failed.update(load_changes(esl, fingerprints, batch)) for batch in batches)),
+    ], PIPELINE_QUEUE_SIZE, stop_event)
+    return pipeline.run(), failed
+
+
+def load_changes(esl: ESLoader, fingerprints: Optional[FingerprintStore], prepared_data: List[dict]) -> List[str]:
+    """
+    Загружаем изменения в ES, пропуская документы, которые не изменились с последней загрузки
+    :param esl: экземпляр класса ESLoader
+    :param fingerprints: хранилище отпечатков документов или None
+    :param prepared_data: список словарей с данными о фильмах
+    :return: Список id фильмов, которые не удалось сохранить
+    """
+    if fingerprints:
+        prepared_data = fingerprints.filter_changed(prepared_data)
+    if not prepared_data:
+        return []
+    logger.info('Заливаем изменения в Elastic')
+    failed = esl.load_to_es(prepared_data, INDEX)
+    if fingerprints:
+        fingerprints.save(prepared_data, exclude=failed)
+    return failed
+
+
+def get_table_watermark(postgres_request: PostgresExctract, state: State, table: BaseTableClass) -> dict:
+    """
+    Получаем сохраненную отметку последней обработанной записи таблицы
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param state: хранилище состояния
+    :param table: таблица для проверки
+    :return: словарь отметки
+    """
+    watermark = state.get_state(table.table_to_check_update)
+    if not watermark:
+        return get_initial_watermark(postgres_request)
+    if isinstance(watermark, str):
+        # отметка в формате предыдущих версий - только локальное время сервиса без часового пояса
+        return {'updated_at': datetime.fromisoformat(watermark).astimezone().isoformat(), 'id': MIN_ID}
+    return watermark
+
+
+def watermark_position(watermark: dict) -> Tuple[datetime, str]:
+    """
+    Позиция отметки для сравнения отметок между собой
+    :param watermark: словарь отметки
+    :return: кортеж (updated_at, id)
+    """
+    return datetime.fromisoformat(watermark['updated_at']), watermark['id']
+
+
+def watermark_key(table: BaseTableClass, partition: Optional[int] = None) -> str:
+    """
+    Ключ состояния, в котором хранится отметка таблицы
+    :param table: таблица
+    :param partition: партиция фильмов или None, если экземпляр один
+    :return: ключ состояния
+    """
+    if partition is None:
+        return table.table_to_check_update
+    return f'{table.table_to_check_update}:{partition}'
+
+
+def get_partition_watermarks(postgres_request: PostgresExctract, state: State, table: BaseTableClass,
+                             partitions: Optional[Set[int]] = None) -> List[Tuple[List[Optional[int]], dict]]:
+    """
+    Отметки таблицы для партиций экземпляра. У каждой партиции своя отметка, потому что партиции переходят
+    между экземплярами. Партиции с одинаковыми отметками объединяются, чтобы читать изменения один раз.
+    Партиция, которая еще не обрабатывалась, начинает с отметки, сохраненной без партиций
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param state: хранилище состояния
+    :param table: таблица для проверки
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return: список пар (партиции, отметка), без партиций - [([None], отметка)]
+    """
+    if partitions is None:
+        return [([None], get_table_watermark(postgres_request, state, table))]
+    groups = {}
+    default = None
+    for partition in sorted(partitions):
+        watermark = state.get_state(watermark_key(table, partition))
+        if not watermark:
+            default = default or get_table_watermark(postgres_request, state, table)
+            watermark = default
+        group = groups.setdefault(watermark_position(watermark), ([], watermark))
+        group[0].append(partition)
+    return list(groups.values())
+
+
+def failed_films_key(partition: Optional[int] = None) -> str:
+    """
+    Ключ состояния, в котором хранятся id фильмов для повторной загрузки
+    :param partition: партиция фильмов или None, если экземпляр один
+    :return: ключ состояния
+    """
+    if partition is None:
+        return FAILED_FILMS
+    return f'{FAILED_FILMS}:{partition}'
+
+
+def get_failed_films(state: State, partitions: Optional[Set[int]] = None) -> Set[str]:
+    """
+    Фильмы, которые не удалось сохранить в ES в предыдущих циклах
+    :param state: хранилище состояния
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return: множество id фильмов
+    """
+    films_id = set()
+    for partition in sorted(partitions) if partitions is not None else [None]:
+        films_id.update(state.get_state(failed_films_key(partition)) or [])
+    return films_id
+
+
+def set_failed_films(state: State, failed: Set[str], partitions: Optional[Set[int]] = None) -> None:
+    """
+    Сохраняем фильмы, которые не удалось сохранить в ES, для повторной загрузки в следующем цикле.
+    При нескольких экземплярах фильмы хранятся отдельно для каждой партиции, потому что партиции переходят
+    между экземплярами
+    :param state: хранилище состояния
+    :param failed: множество id фильмов
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return:
+    """
+    if failed:
+        logger.warning(f'Не удалось сохранить в ES {len(failed)} фильмов, повторим загрузку в следующем цикле')
+    if partitions is None:
+        if failed or state.get_state(FAILED_FILMS):
+            state.set_state(FAILED_FILMS, sorted(failed) or None)
+        return
+    for partition in partitions:
+        films_id = sorted(filter_partitions(failed, [partition]))
+        if films_id or state.get_state(failed_films_key(partition)):
+            state.set_state(failed_films_key(partition), films_id or None)
+
+
+def distribute_failed_films(state: State) -> None:
+    """
+    Распределяем по партициям фильмы для повторной загрузки, сохраненные первичной загрузкой без партиций
+    :param state: хранилище состояния
+    :return:
+    """
+    failed = state.get_state(FAILED_FILMS)
+    if not failed:
+        return
+    for partition in range(WORKER_PARTITIONS):
+        add_failed_films(state, filter_partitions(set(failed), [partition]), failed_films_key(partition))
+    state.set_state(FAILED_FILMS, None)
+
+
+def filter_partitions(films_id: Set[str], partitions: Optional[Iterable[int]]) -> Set[str]:
+    """
+    Отбираем фильмы, относящиеся к партициям экземпляра
+    :param films_id: множество id фильмов
+    :param partitions: партиции фильмов или None, если экземпляр один
+    :return: множество id фильмов
+    """
+    if partitions is None:
+        return films_id
+    partitions = set(partitions)
+    return {film_id for film_id in films_id if film_partition(film_id, WORKER_PARTITIONS) in partitions}
+
+
+def run_full_load(film_data: Generator, esl: ESLoader, index: str, state: State,
+                  last_id_key: str = FULL_LOAD_LAST_ID, failed_key: str = FAILED_FILMS) -> bool:
+    """
+    Первичная загрузка фильмов конвейером. Если запрошено профилирование, первая страница
+    загружается отдельным запуском конвейера под профилировщиком
+    :param film_data: Генератор страниц фильмов из БД
+    :param esl: экземпляр класса ESLoader
+    :param index: название индекса
+    :param state: хранилище состояния
+    :param last_id_key: ключ состояния, в котором хранится id последнего загруженного фильма
+    :param failed_key: ключ состояния, в котором хранятся id фильмов для повторной загрузки
+    :return: True, если загружены все фильмы, False, если загрузка остановлена
+    """
+    if profiler.pending:
+        with profiler.cycle('full_load'):
+            if not load_all_files(islice(film_data, 1), esl, index, state, stop_event, PIPELINE_QUEUE_SIZE,
+                                  TRANSFORM_WORKERS, last_id_key, failed_key):
+                return False
+    return load_all_files(film_data, esl, index, state, stop_event, PIPELINE_QUEUE_SIZE, TRANSFORM_WORKERS,
+                          last_id_key, failed_key)
+
+
+def reindex(postgres_request: PostgresExctract, esl: ESLoader, state: State, tables: List[BaseTableClass],
+            fingerprints: Optional[FingerprintStore] = None) -> bool:
+    """
+    Полная загрузка данных в новый индекс INDEX_<INDEX_VERSION> без остановки поиска. Индекс создается
+    без обновления поиска и без реплик, после загрузки настройки восстанавливаются, сегменты объединяются
+    и псевдоним INDEX атомарно переключается на новый индекс. Прогресс загрузки хранится отдельно для каждого
+    нового индекса, поэтому прерванная загрузка продолжается с последней сохраненной пачки
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param esl: экземпляр класса ESLoader
+    :param state: хранилище состояния
+    :param tables: список таблиц для проверки
+    :param fingerprints: хранилище отпечатков документов или None
+    :return: True, если псевдоним переключен на новый индекс, False, если загрузка остановлена
+    """
+    target = f'{INDEX}_{INDEX_VERSION}'
+    last_id_key = f'{FULL_LOAD_LAST_ID}:{target}'
+    # фильмы, не сохраненные в новый индекс, загружаются повторно после переключения псевдонима
+    reindex_failed_key = f'{FAILED_FILMS}:{target}'
+    reindex_watermark_key = f'{REINDEX_WATERMARK}:{target}'
+    reindex_watermark = state.get_state(reindex_watermark_key)
+    if not reindex_watermark:
+        # изменения, сделанные во время загрузки, после переключения псевдонима подхватит сканирование обновлений
+        reindex_watermark = get_initial_watermark(postgres_request)
+        state.set_state(reindex_watermark_key, reindex_watermark)
+        if fingerprints:
+            fingerprints.clear()
+    for table in tables:
+        if not state.get_state(table.table_to_check_update):
+            state.set_state(table.table_to_check_update, reindex_watermark)
+    if not check_index(target):
+        logger.info(f'Создаем индекс {target} для загрузки версии {INDEX_VERSION}')
+        esl.create_index(target, bulk_load=True).raise_for_status()
+    last_id = state.get_state(last_id_key)
+    if last_id:
+        logger.info(f'Продолжаем загрузку данных о фильмах в индекс {target} после фильма {last_id}.')
+    film_data = get_all_film_to_upload(postgres_request, PAGE_SIZE, last_id)
+    if not run_full_load(film_data, esl, target, state, last_id_key, reindex_failed_key):
+        return False
+    esl.restore_index_settings(target)
+    esl.forcemerge(target)
+    for old_index in esl.swap_alias(INDEX, target):
+        esl.delete_index(old_index)
+    # старый индекс обновлялся до начала загрузки, поэтому отметки сдвигаем не дальше ее начала
+    for table in tables:
+        watermark = get_table_watermark(postgres_request, state, table)
+        if watermark_position(reindex_watermark) < watermark_position(watermark):
+            state.set_state(table.table_to_check_update, reindex_watermark)
+        # отметки партиций нескольких экземпляров сервиса
+        for partition in range(WORKER_PARTITIONS):
+            watermark = state.get_state(watermark_key(table, partition))
+            if watermark and watermark_position(reindex_watermark) < watermark_position(watermark):
+                state.set_state(watermark_key(table, partition), reindex_watermark)
+    add_failed_films(state, state.get_state(reindex_failed_key) or [])
+    state.set_state(INDEX_VERSION_LOADED, INDEX_VERSION)
+    state.set_state(FULL_LOAD_COMPLETED, True)
+    state.set_state(last_id_key, None)
+    state.set_state(reindex_failed_key, None)
+    state.set_state(reindex_watermark_key, None)
+    state.flush()
+    logger.info(f'Загрузка версии {INDEX_VERSION} в индекс {target} завершена, поиск переключен на новый индекс')
+    return True
+
+
+def update_cycle(postgres_request: PostgresExctract, esl: ESLoader, state: State,
+                 tables: List[BaseTableClass], fingerprints: Optional[FingerprintStore] = None,
+                 partitions: Optional[Set[int]] = None) -> bool:
+    """
+    Один цикл сканирования обновлений: собираем id затронутых фильмов по всем таблицам и, если включен,
+    по журналу удалений, каждый фильм получаем из БД и загружаем в ES один раз, после загрузки сохраняем отметки
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param esl: экземпляр класса ESLoader
+    :param state: хранилище состояния
+    :param tables: список таблиц для проверки
+    :param fingerprints: хранилище отпечатков документов или None
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return: признак того, что в таблицах остались необработанные изменения и работа не остановлена
+    """
+    # фильмы, которые ES не сохранил в предыдущих циклах, загружаются повторно
+    dirty_films = get_failed_films(state, partitions)
+    # граница получается до чтения изменений, одна для всех таблиц цикла
+    horizon = get_scan_horizon(postgres_request, SCAN_HORIZON_MAX_LAG)
+    watermarks = {}
+    names = {}
+    films_found = 0
+    has_more = False
+    for table in tables:
+        for group, watermark in get_partition_watermarks(postgres_request, state, table, partitions):
+            films_id, new_watermark, table_has_more, table_names = exchange_app(
+                postgres_request, watermark, table, UPDATE_BATCH_SIZE, esl, fingerprints,
+                group if partitions is not None else None, horizon)
+            films_found += len(films_id)
+            dirty_films |= films_id
+            if new_watermark:
+                watermarks.update((watermark_key(table, partition), new_watermark) for partition in group)
+            if table_names:
+                names[table.table_to_check_update] = table_names
+            has_more = has_more or table_has_more
+    log_entries = []
+    if DELETION_LOG:
+        films_id, log_entries, log_has_more = process_deletions(postgres_request, esl, fingerprints, UPDATE_BATCH_SIZE,
+                                                                partitions)
+        films_found += len(films_id)
+        dirty_films |= films_id
+        has_more = has_more or log_has_more
+    if films_found > len(dirty_films):
+        logger.info(f'Изменено фильмов: {len(dirty_films)}, '
+                    f'избежали повторной выборки {films_found - len(dirty_films)}')
+    completed, failed = load_films(postgres_request, esl, dirty_films, fingerprints)
+    if not completed:
+        return False
+    set_failed_films(state, failed, partitions)
+    for table_name, table_names in names.items():
+        fingerprints.save_names(table_name, table_names)
+    clear_deletion_log(postgres_request, log_entries)
+    for table_name, watermark in watermarks.items():
+        state.set_state(table_name, watermark)
+    return has_more and not stop_event.is_set()
+
+
+def get_oldest_watermark(postgres_request: PostgresExctract, state: State, table: BaseTableClass,
+                         partitions: Optional[Set[int]] = None) -> Tuple[datetime, str]:
+    """
+    Позиция самой старой отметки таблицы среди партиций экземпляра
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param state: хранилище состояния
+    :param table: таблица для проверки
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return: кортеж (updated_at, id)
+    """
+    return min(watermark_position(watermark)
+               for _, watermark in get_partition_watermarks(postgres_request, state, table, partitions))
+
+
+def has_changes(postgres_request: PostgresExctract, state: State, table: BaseTableClass,
+                partitions: Optional[Set[int]] = None) -> bool:
+    """
+    Дешевая проверка наличия изменений в таблице: сравниваем позицию последней измененной записи
+    с сохраненной отметкой, не выполняя запрос изменений
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param state: хранилище состояния
+    :param table: таблица для проверки
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return: True, если в таблице есть записи после отметки
+    """
+    # отметки таблицы фильмов сдвигаются только по фильмам партиций экземпляра, поэтому и последнее изменение
+    # берется среди них. Изменения людей и жанров каждый экземпляр читает целиком
+    film_partitions = partitions if not table.table_list[1] else None
+    newest = get_newest_position(postgres_request, table.table_to_check_update, film_partitions, WORKER_PARTITIONS)
+    if newest is None:
+        return False
+    return newest > get_oldest_watermark(postgres_request, state, table, partitions)
+
+
+def get_changed_tables(postgres_request: PostgresExctract, state: State, scheduler: PollScheduler,
+                       partitions: Optional[Set[int]] = None) -> List[BaseTableClass]:
+    """
+    Проверяем таблицы, для которых подошло время проверки, и назначаем время следующей проверки
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param state: хранилище состояния
+    :param scheduler: расписание проверки таблиц
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return: список таблиц, в которых есть изменения
+    """
+    changed_tables = []
+    for table in scheduler.due_tables():
+        changed = has_changes(postgres_request, state, table, partitions)
+        scheduler.record(table, changed)
+        if changed:
+            changed_tables.append(table)
+    return changed_tables
+
+
+def has_pending_work(postgres_request: PostgresExctract, state: State, tables: List[BaseTableClass],
+                     partitions: Optional[Set[int]] = None) -> bool:
+    """
+    Нужен ли цикл сканирования обновлений при адаптивном расписании: цикл пропускается, только если проверка
+    не нашла изменений в таблицах, нет фильмов для повторной загрузки и необработанных записей журнала удалений
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param state: хранилище состояния
+    :param tables: таблицы, в которых проверка нашла изменения
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return: True, если цикл нужен
+    """
+    if tables or get_failed_films(state, partitions):
+        return True
+    return DELETION_LOG and has_pending_deletions(postgres_request, partitions, WORKER_PARTITIONS)
+
+
+def update_watermark_lag(postgres_request: PostgresExctract, state: State, tables: List[BaseTableClass],
+                         partitions: Optional[Set[int]] = None) -> None:
+    """
+    Обновляем метрику отставания сохраненных отметок от последних изменений в таблицах
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param state: хранилище состояния
+    :param tables: список таблиц для проверки
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return:
+    """
+    for table in tables:
+        newest = get_max_updated_at(postgres_request, table.table_to_check_update)
+        watermark = get_oldest_watermark(postgres_request, state, table, partitions)[0]
+        lag = (newest - watermark).total_seconds() if newest else 0
+        WATERMARK_LAG.set(max(lag, 0), table=table.table_to_check_update)
+
+
+def load_notified_changes(postgres_request: PostgresExctract, esl: ESLoader, changes: Dict[str, Set[str]],
+                          tables: List[BaseTableClass], fingerprints: Optional[FingerprintStore] = None,
+                          partitions: Optional[Set[int]] = None) -> None:
+    """
+    Загружаем в ES фильмы, затронутые изменениями из уведомлений БД. Отметки не сдвигаются,
+    сканирование обновлений остается страховкой от потерянных уведомлений
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param esl: экземпляр класса ESLoader
+    :param changes: словарь {название таблицы: множество id измененных записей}
+    :param tables: список таблиц для проверки
+    :param fingerprints: хранилище отпечатков документов или None
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return:
+    """
+    dirty_films = set()
+    names = {}
+    for table in tables:
+        data_id = changes.get(table.table_to_check_update)
+        if data_id:
+            films_id, names[table.table_to_check_update] = get_changed_films(postgres_request, esl, data_id, table,
+                                                                             fingerprints, partitions)
+            dirty_films |= films_id
+    # фильмы, которые не удалось сохранить, загрузит сканирование обновлений: отметки здесь не сдвигаются
+    completed, _ = load_films(postgres_request, esl, dirty_films, fingerprints)
+    if completed:
+        for table_name, table_names in names.items():
+            if table_names:
+                fingerprints.save_names(table_name, table_names)
+
+
+def wait_for_changes(listener: Optional[ChangeListener], postgres_request: PostgresExctract, esl: ESLoader,
+                     tables: List[BaseTableClass], fingerprints: Optional[FingerprintStore] = None,
+                     sleep_time: float = SLEEP_TIME, partitions: Optional[Set[int]] = None) -> None:
+    """
+    Пауза между сканированиями обновлений. Если включен режим уведомлений, в течение паузы
+    сразу загружаем изменения, о которых сообщила БД
+    :param listener: экземпляр класса ChangeListener или None
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param esl: экземпляр класса ESLoader
+    :param tables: список таблиц для проверки
+    :param fingerprints: хранилище отпечатков документов или None
+    :param sleep_time: длительность паузы в секундах
+    :param partitions: партиции фильмов экземпляра или None, если экземпляр один
+    :return:
+    """
+    if listener is None:
+        logger.info(f'Засыпаем на {sleep_time:.1f} сек.')
+        stop_event.wait(sleep_time)
+        return
+    logger.info(f'Ждем уведомлений об изменениях, следующее сканирование через {sleep_time:.1f} сек.')
+    deadline = time.monotonic() + sleep_time
+    while time.monotonic() < deadline and not stop_event.is_set():
+        # ждем короткими интервалами, чтобы вовремя заметить сигнал остановки
+        changes = listener.wait(min(deadline - time.monotonic(), 1))
+        if changes:
+            load_notified_changes(postgres_request, esl, changes, tables, fingerprints, partitions)
 
 
 @backoff(logger)
@@ -109,45 +731,262 @@ def check_index(index_name: str) -> bool:
     return False
 
 
+def get_wait_time(scheduler: Optional[PollScheduler], coordinator: Optional[WorkerCoordinator]) -> float:
+    """
+    Длительность паузы между сканированиями обновлений. При нескольких экземплярах сервиса пауза не длиннее
+    SLEEP_TIME, чтобы партиции упавшего экземпляра перераспределялись без долгой задержки
+    :param scheduler: расписание проверки таблиц или None
+    :param coordinator: координатор экземпляров сервиса или None
+    :return: время в секундах
+    """
+    if scheduler is None:
+        return SLEEP_TIME
+    if coordinator is None:
+        return scheduler.time_to_next()
+    return min(scheduler.time_to_next(), SLEEP_TIME)
+
+
+def stop(signum, frame) -> None:
+    """
+    Обработчик SIGTERM/SIGINT: прекращаем чтение новых данных, уже полученные данные дорабатываются
+    """
+    logger.info(f'Получен сигнал {signum}, завершаем работу')
+    stop_event.set()
+
+
+def run_async(state: State, tables: List[BaseTableClass], fingerprints: Optional[FingerprintStore] = None) -> None:
+    """
+    Запуск сервиса в асинхронном режиме
+    :param state: хранилище состояния
+    :param tables: список таблиц для проверки
+    :param fingerprints: хранилище отпечатков документов или None
+    :return:
+    """
+    # asyncpg и aiohttp нужны только в асинхронном режиме
+    from postgres_to_es.async_engine import (AsyncESLoader, AsyncETL,
+                                             AsyncPostgresExtract)
+
+    if NOTIFY_MODE:
+        logger.warning('Режим уведомлений в асинхронном режиме не поддерживается, используется сканирование обновлений')
+    if INDEX_VERSION:
+        logger.warning('Загрузка в новый индекс с переключением псевдонима в асинхронном режиме не поддерживается')
+    if FINGERPRINT_REBUILD:
+        logger.warning('Восстановление отпечатков по данным ES в асинхронном режиме не поддерживается')
+    if PARTIAL_UPDATES:
+        logger.warning('Частичное обновление документов в асинхронном режиме не поддерживается')
+    if DELETION_LOG:
+        logger.warning('Обработка журнала удалений в асинхронном режиме не поддерживается')
+    if WORKER_PARTITIONS:
+        logger.warning('Несколько экземпляров сервиса в асинхронном режиме не поддерживаются, '
+                       'экземпляр обрабатывает все фильмы')
+    if POLL_ADAPTIVE:
+        logger.warning('Адаптивное расписание проверки таблиц в асинхронном режиме не поддерживается, '
+                       f'таблицы проверяются раз в {SLEEP_TIME} сек.')
+    postgres_request = AsyncPostgresExtract(DSL, DB_POOL_MIN, DB_POOL_MAX)
+    esl = AsyncESLoader(URL, BULK_MAX_DOCS, BULK_MAX_BYTES, BULK_COMPRESS, BULK_CONCURRENCY)
+    etl = AsyncETL(postgres_request, esl, state, tables, INDEX, fingerprints, PAGE_SIZE, UPDATE_BATCH_SIZE,
+                   SLEEP_TIME, ASYNC_CONCURRENCY, SCAN_HORIZON_MAX_LAG)
+    asyncio.run(etl.run())
+
+
+def initialize(postgres_request: PostgresExctract, esl: ESLoader, state: State, tables: List[BaseTableClass],
+               fingerprints: Optional[FingerprintStore] = None) -> None:
+    """
+    Подготовка к сканированию обновлений: создаем журнал удалений и триггеры уведомлений, выполняем первичную
+    загрузку или загрузку в новую версию индекса, если они еще не завершены
+    :param postgres_request: экземпляр класса  PostgresExctract для выполнения запроса в БД
+    :param esl: экземпляр класса ESLoader
+    :param state: хранилище состояния
+    :param tables: список таблиц для проверки
+    :param fingerprints: хранилище отпечатков документов или None
+    :return:
+    """
+    # журнал удалений создается до первичной загрузки, чтобы не пропустить удаления во время нее
+    if DELETION_LOG:
+        install_deletion_log(postgres_request)
+
+    # пока первичная загрузка не завершена, создаем схему при необходимости и переливаем фильмы из БД,
+    # продолжая с последней сохраненной пачки
+    if INDEX_VERSION and state.get_state(INDEX_VERSION_LOADED) != INDEX_VERSION:
+        reindex(postgres_request, esl, state, tables, fingerprints)
+        esl.log_bulk_stats()
+    elif (not state.get_state(FULL_LOAD_COMPLETED) and state.get_state(FULL_LOAD_LAST_ID) is None
+          and check_index(INDEX)):
+        # индекс загружен версией сервиса, которая не сохраняла прогресс первичной загрузки: фильмы повторно
+        # не загружаются, сканирование обновлений продолжается с сохраненных отметок
+        for table in tables:
+            state.set_state(table.table_to_check_update, get_table_watermark(postgres_request, state, table))
+        state.set_state(FULL_LOAD_COMPLETED, True)
+        state.flush()
+        logger.info(f'Схема {INDEX} загружена предыдущей версией сервиса, первичная загрузка не требуется')
+    elif not state.get_state(FULL_LOAD_COMPLETED):
+        last_id = state.get_state(FULL_LOAD_LAST_ID)
+        # изменения, сделанные во время первичной загрузки, подхватит сканирование обновлений
+        for table in tables:
+            if not state.get_state(table.table_to_check_update):
+                state.set_state(table.table_to_check_update, get_initial_watermark(postgres_request))
+        if last_id is None:
+            # начало загрузки сохраняется до создания индекса: индекс без сохраненного прогресса
+            # считается загруженным предыдущей версией сервиса
+            state.set_state(FULL_LOAD_LAST_ID, MIN_ID)
+            state.flush()
+            if fingerprints:
+                fingerprints.clear()
+        elif last_id != MIN_ID:
+            logger.info(f'Продолжаем загрузку данных о фильмах после фильма {last_id}.')
+        if not check_index(INDEX):
+            logger.info(f'Схемы {INDEX} не существует. Создаем схему')
+            esl.create_index(INDEX)
+        logger.info('Получаем данные о фильмах.')
+        film_data = get_all_film_to_upload(postgres_request, PAGE_SIZE, last_id)
+        logger.info(f'Загружаем данные о фильмах в Схему {INDEX}.')
+        if run_full_load(film_data, esl, INDEX, state):
+            state.set_state(FULL_LOAD_COMPLETED, True)
+            logger.info(f'Первичная загрузка данных в Схему {INDEX} завершена.')
+        esl.log_bulk_stats()
+    elif fingerprints and FINGERPRINT_REBUILD:
+        fingerprints.rebuild(esl.scroll_documents(INDEX))
+
+    if WORKER_PARTITIONS:
+        distribute_failed_films(state)
+
+    if NOTIFY_MODE and not stop_event.is_set():
+        install_notify_triggers(postgres_request)
+
+
 def main():
-    # Инициализируем экземплары классов
-    esl = ESLoader(URL)
-    index_status = check_index(INDEX)
-    postgres_request = PostgresExctract(DSL)
     person_tables = PersonTables(['content.person', 'content.person_film_work', 'pfw.person_id'])
-    genre_tables = GenreTables(['content.genre', 'content.person_film_work', 'pfw.genre_id'])
+    genre_tables = GenreTables(['content.genre', 'content.genre_film_work', 'pfw.genre_id'])
     firlmwork_tables = FilmWorkTables(['content.film_work', ''])
 
-    # проверяем наличие схемы и если еет создаем и переливаем все файлы из БД
-    if not index_status:
-        logger.info(f'Схемы {INDEX} не существует. Создаем схему')
-        esl.create_index(INDEX)
-        logger.info('Получаем данные о фильмах.')
-        film_data = get_all_film_to_upload(postgres_request)
-        logger.info(f'Загружаем данные о фильмах в Схему {INDEX}.')
-        load_all_files(film_data, esl, INDEX)
-    # Инициализируем хранилище и хранение состояния
-    json_storage = JsonFileStorage('sw_templates.json')
-    state = State(json_storage)
+    # Инициализируем хранилище и хранение состояния, несколько экземпляров сервиса хранят состояние в общей БД
+    if WORKER_PARTITIONS:
+        storage = PostgresStorage(DSL)
+    else:
+        storage = SqliteStorage(STATE_DB) if STATE_DB else JsonFileStorage('sw_templates.json')
+    state = State(storage, STATE_FLUSH_INTERVAL)
 
     # Список классов определяющих таблицы для проверки
     table_list_to_check = [person_tables, genre_tables, firlmwork_tables]
 
-    # цикл для сканирования обновлений
-    while True:
-        for table in table_list_to_check:
-            if not state.get_state(table.table_to_check_update):
-                run_time = datetime.now()
-            else:
-                run_time = state.get_state(table.table_to_check_update)
-            prepared_data = exchange_app(postgres_request, run_time, table)
-            if prepared_data:
-                logger.info('Заливаем изменения в Elastic')
-                esl.load_to_es(prepared_data, INDEX)
-            check_time = datetime.now().isoformat()
-            state.set_state(table.table_to_check_update, check_time)
-        logger.info(f'Засыпаем на {SLEEP_TIME} сек.')
-        time.sleep(SLEEP_TIME)
+    # Хранилище отпечатков документов, чтобы не отправлять в ES неизмененные документы
+    fingerprints = None
+    if FINGERPRINT_DB:
+        fingerprints = FingerprintStore(FINGERPRINT_DB, FINGERPRINT_MAX_ENTRIES)
+        # названия сохраняются только при частичном обновлении: без него переименования переносятся пересборкой
+        # фильмов, и сохраненные ранее названия устаревают
+        if not PARTIAL_UPDATES or ASYNC_MODE or WORKER_PARTITIONS:
+            fingerprints.clear_names()
+    elif PARTIAL_UPDATES:
+        logger.warning('Для частичного обновления документов нужно хранилище отпечатков FINGERPRINT_DB, '
+                       'переименования обрабатываются пересборкой фильмов')
+
+    if ASYNC_MODE:
+        try:
+            run_async(state, table_list_to_check, fingerprints)
+        finally:
+            if fingerprints:
+                fingerprints.close()
+            state.close()
+            logger.info('Работа завершена')
+        return
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # профилирование следующих циклов включается сигналом SIGUSR1 или сразу при запуске через PROFILE_CYCLES
+    profiler.configure(PROFILE_DIR, max(PROFILE_CYCLES, 1), PROFILE_MEMORY)
+    signal.signal(signal.SIGUSR1, profiler.on_signal)
+    if PROFILE_CYCLES:
+        profiler.request()
+
+    # Инициализируем экземплары классов
+    esl = ESLoader(URL, BULK_MAX_DOCS, BULK_MAX_BYTES, BULK_COMPRESS, BULK_CONCURRENCY)
+    postgres_request = PostgresExctract(DSL, DB_POOL_MIN, DB_POOL_MAX)
+    listener = None
+    coordinator = None
+    if WORKER_PARTITIONS:
+        coordinator = WorkerCoordinator(DSL, WORKER_PARTITIONS)
+        if PARTIAL_UPDATES:
+            logger.warning('Частичное обновление документов при нескольких экземплярах сервиса не поддерживается, '
+                           'переименования обрабатываются пересборкой фильмов')
+    metrics_server = start_metrics_server(METRICS_PORT) if METRICS_PORT else None
+    try:
+        check_stats_access(postgres_request)
+        # подготовку выполняет один экземпляр: одновременное создание одних и тех же таблиц и триггеров
+        # завершается ошибкой, остальные экземпляры после ее завершения читают общее состояние
+        if coordinator:
+            with coordinator.bootstrap(stop_event) as acquired:
+                state.reload()
+                if acquired:
+                    initialize(postgres_request, esl, state, table_list_to_check, fingerprints)
+                    state.flush()
+        else:
+            initialize(postgres_request, esl, state, table_list_to_check, fingerprints)
+
+        # в режиме уведомлений изменения загружаются сразу, а сканирование обновлений раз в SLEEP_TIME
+        # подхватывает пропущенные уведомления
+        if NOTIFY_MODE and not stop_event.is_set():
+            listener = ChangeListener(DSL, debounce=NOTIFY_DEBOUNCE, max_batch=NOTIFY_MAX_BATCH)
+
+        # при адаптивном расписании каждая таблица проверяется со своим интервалом, и сканирование обновлений
+        # запускается только для таблиц, в которых проверка нашла изменения
+        scheduler = None
+        if POLL_ADAPTIVE:
+            scheduler = PollScheduler(table_list_to_check, POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, jitter=POLL_JITTER)
+
+        # цикл для сканирования обновлений, пока есть необработанные изменения работаем без паузы
+        while not stop_event.is_set():
+            partitions = None
+            if coordinator:
+                # отметки отпускаемых партиций сохраняются до снятия блокировок, а отметки полученных партиций
+                # перечитываются, отпечатки сбрасываются: документы могли загрузить другие экземпляры
+                state.flush()
+                if coordinator.rebalance():
+                    state.reload()
+                    if fingerprints:
+                        fingerprints.clear()
+                partitions = set(coordinator.owned)
+                if not partitions:
+                    logger.info(f'Свободных партиций нет, засыпаем на {SLEEP_TIME} сек.')
+                    stop_event.wait(SLEEP_TIME)
+                    continue
+            tables = table_list_to_check
+            if scheduler:
+                tables = get_changed_tables(postgres_request, state, scheduler, partitions)
+                if not has_pending_work(postgres_request, state, tables, partitions):
+                    wait_for_changes(listener, postgres_request, esl, table_list_to_check, fingerprints,
+                                     get_wait_time(scheduler, coordinator), partitions)
+                    continue
+            has_more = True
+            while has_more:
+                with CYCLE_DURATION.time(), profiler.cycle('update'):
+                    has_more = update_cycle(postgres_request, esl, state, tables, fingerprints, partitions)
+            state.flush()
+            if metrics_server:
+                update_watermark_lag(postgres_request, state, table_list_to_check, partitions)
+            postgres_request.log_pool_stats()
+            esl.log_bulk_stats()
+            if fingerprints:
+                fingerprints.log_stats()
+            if scheduler:
+                scheduler.log_stats()
+            wait_for_changes(listener, postgres_request, esl, table_list_to_check, fingerprints,
+                             get_wait_time(scheduler, coordinator), partitions)
+    finally:
+        if listener:
+            listener.close()
+        if coordinator:
+            # состояние сохраняется до снятия блокировок партиций
+            state.flush()
+            coordinator.close()
+        if fingerprints:
+            fingerprints.close()
+        if metrics_server:
+            metrics_server.shutdown()
+        esl.close()
+        postgres_request.close()
+        state.close()
+        logger.info('Работа завершена')
 
 
 if __name__ == '__main__':
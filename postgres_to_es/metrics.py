@@ -0,0 +1,201 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Generator, Iterable, List, Tuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    """
+    Базовый класс метрики в формате Prometheus. Значения хранятся отдельно для каждого набора меток
+    """
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: Dict[str, str] = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f'{self.name}{self._format_labels(key)} {value}' for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        return '\n'.join(lines + self.samples())
+
+
+class Counter(Metric):
+    """Счетчик, значение которого только увеличивается"""
+    type_name = 'counter'
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    """Произвольное текущее значение"""
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Распределение значений по корзинам, сумма и количество наблюдений"""
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Измеряем время выполнения блока кода"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f'{self.name}_bucket{self._format_labels(key, {"le": le})} {cumulative}')
+                lines.append(f'{self.name}_sum{self._format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{self._format_labels(key)} {cumulative}')
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+QUERY_DURATION = Histogram('etl_query_duration_seconds', 'Время выполнения запроса к БД', ['query'])
+ROWS_EXTRACTED = Counter('etl_rows_extracted_total', 'Количество строк, полученных из БД', ['query'])
+BULK_DURATION = Histogram('etl_bulk_request_duration_seconds', 'Время выполнения bulk-запроса к ES')
+BULK_BYTES = Counter('etl_bulk_bytes_total', 'Объем отправленных bulk-запросов в байтах до сжатия')
+DOCUMENTS = Counter('etl_documents_total', 'Количество документов, отправленных в ES, по результату', ['result'])
+BACKOFF_RETRIES = Counter('etl_backoff_retries_total', 'Количество повторов вызова после ошибки соединения',
+                          ['function'])
+STAGE_SECONDS = Counter('etl_stage_busy_seconds_total', 'Время работы этапа конвейера без ожидания очередей',
+                        ['pipeline', 'stage'])
+STAGE_ITEMS = Counter('etl_stage_items_total', 'Количество элементов, обработанных этапом конвейера',
+                      ['pipeline', 'stage'])
+WATERMARK_LAG = Gauge('etl_watermark_lag_seconds',
+                      'Отставание сохраненной отметки от последнего изменения в таблице', ['table'])
+SCAN_HORIZON_LAG = Gauge('etl_scan_horizon_lag_seconds',
+                         'Отставание границы сканирования обновлений от текущего времени БД')
+STEP_DURATION = Histogram('etl_step_duration_seconds', 'Время выполнения шагов обработки данных', ['step'])
+CYCLE_DURATION = Histogram('etl_update_cycle_duration_seconds', 'Время цикла сканирования обновлений')
+OWNED_PARTITIONS = Gauge('etl_owned_partitions', 'Количество партиций фильмов, обрабатываемых экземпляром')
+
+
+def timed(step: str) -> Callable:
+    """
+    Декоратор, измеряющий время выполнения функции в метрике etl_step_duration_seconds. Для генераторов
+    учитывается время получения всех элементов без времени их обработки вызывающим кодом
+    :param step: название шага
+    :return: декоратор
+    """
+    def real_decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            started = time.perf_counter()
+            result = func(*args, **kwargs)
+            elapsed = time.perf_counter() - started
+            if isinstance(result, Generator):
+                return _timed_generator(result, step, elapsed)
+            STEP_DURATION.observe(elapsed, step=step)
+            return result
+        return inner
+    return real_decorator
+
+
+def _timed_generator(generator: Generator, step: str, elapsed: float) -> Generator:
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - started
+            yield item
+    finally:
+        generator.close()
+        STEP_DURATION.observe(elapsed, step=step)
+
+
+def render_metrics() -> str:
+    """
+    Все метрики в текстовом формате Prometheus
+    :return: текст метрик
+    """
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """
+    Запуск HTTP-сервера метрик в фоновом потоке
+    :param port: порт
+    :param host: адрес
+    :return: экземпляр сервера, для остановки вызвать shutdown()
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f'Метрики доступны по адресу http://{host}:{port}/metrics')
+    return server
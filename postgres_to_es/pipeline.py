@@ -0,0 +1,215 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Generator, Iterable, List, Optional, Tuple
+
+from .metrics import STAGE_ITEMS, STAGE_SECONDS
+from .profiling import profiler
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# признак окончания данных в очереди
+_DONE = object()
+
+Stage = Tuple[str, Callable[[Iterable], Iterable]]
+
+
+def ordered_map(executor: Executor, func: Callable, items: Iterable, max_in_flight: int) -> Generator:
+    """
+    Параллельное выполнение func для элементов в пуле executor с сохранением порядка результатов.
+    В отличие от Executor.map элементы читаются по мере готовности результатов, поэтому в работе находится
+    не больше max_in_flight элементов
+    :param executor: пул потоков или процессов
+    :param func: функция обработки элемента
+    :param items: итерируемый объект элементов
+    :param max_in_flight: максимальное количество одновременно обрабатываемых элементов
+    :return: Генератор результатов в порядке элементов
+    """
+    in_flight = deque()
+    for item in items:
+        in_flight.append(executor.submit(func, item))
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+class StageStats:
+    """Статистика этапа конвейера: количество элементов и время работы без учета ожидания очередей"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.wait_time = 0.0
+        self.started = None
+        self.finished = None
+
+    @property
+    def busy_time(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started - self.wait_time
+
+
+class Pipeline:
+    """
+    Конвейер обработки данных. Источник и каждый этап работают в отдельных потоках и связаны
+    очередями ограниченного размера: если последний этап не успевает, предыдущие ждут освобождения места
+    в очереди, и данные не накапливаются в памяти.
+    Этап - функция, принимающая итерируемый объект элементов и возвращающая итерируемый объект результатов,
+    результаты последнего этапа отбрасываются.
+    При установке stop_event источник перестает выдавать новые элементы, а уже полученные дорабатываются до конца
+    """
+
+    def __init__(self, name: str, source: Iterable, stages: List[Stage], queue_size: int = 4,
+                 stop_event: Optional[threading.Event] = None, log_interval: float = 30):
+        self.name = name
+        self.source = source
+        self.stages = stages
+        self.stop_event = stop_event or threading.Event()
+        self.log_interval = log_interval
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.stats = [StageStats('source')] + [StageStats(stage_name) for stage_name, _ in stages]
+        self.completed = False
+        self._errors = []
+        self._abort = threading.Event()
+
+    def run(self) -> bool:
+        """
+        Запуск конвейера и ожидание его завершения
+        :return: True, если источник был прочитан полностью, False, если конвейер остановлен через stop_event
+        """
+        threads = [threading.Thread(target=self._run_profiled, args=(self._run_source,), name=f'{self.name}-source',
+                                    daemon=True)]
+        for number, (stage_name, stage) in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._run_profiled, args=(self._run_stage, number, stage),
+                                            name=f'{self.name}-{stage_name}', daemon=True))
+        for thread in threads:
+            thread.start()
+        last_log = time.monotonic()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1)
+                if time.monotonic() - last_log >= self.log_interval:
+                    self.log_stats()
+                    last_log = time.monotonic()
+        self.log_stats()
+        for stats in self.stats:
+            STAGE_SECONDS.inc(stats.busy_time, pipeline=self.name, stage=stats.name)
+            STAGE_ITEMS.inc(stats.items, pipeline=self.name, stage=stats.name)
+        if self._errors:
+            raise self._errors[0]
+        return self.completed
+
+    def _run_profiled(self, target: Callable, *args) -> None:
+        """
+        Запуск функции потока, при включенном профилировании - под профилировщиком
+        :param target: функция потока
+        :param args: аргументы функции
+        :return:
+        """
+        with profiler.thread():
+            target(*args)
+
+    def _run_source(self) -> None:
+        """
+        Поток источника: читает источник и передает элементы первому этапу
+        :return:
+        """
+        stats = self.stats[0]
+        stats.started = time.monotonic()
+        try:
+            for item in self.source:
+                stats.items += 1
+                self._put(0, item, stats)
+                if self.stop_event.is_set() or self._abort.is_set():
+                    logger.info(f'Конвейер {self.name}: получен сигнал остановки, дорабатываем полученные данные')
+                    break
+            else:
+                self.completed = True
+        except Exception as e:
+            self._fail(e)
+        finally:
+            if hasattr(self.source, 'close'):
+                self.source.close()
+            self._put(0, _DONE, stats)
+            stats.finished = time.monotonic()
+
+    def _run_stage(self, number: int, stage: Callable[[Iterable], Iterable]) -> None:
+        """
+        Поток этапа: обрабатывает элементы из своей очереди и передает результаты следующему этапу
+        :param number: номер этапа
+        :param stage: функция этапа
+        :return:
+        """
+        stats = self.stats[number + 1]
+        stats.started = time.monotonic()
+        last_stage = number == len(self.stages) - 1
+        try:
+            for item in stage(self._iter_queue(number, stats)):
+                stats.items += 1
+                if not last_stage:
+                    self._put(number + 1, item, stats)
+        except Exception as e:
+            self._fail(e)
+            # освобождаем предыдущие этапы, которые могут ждать места в очереди
+            for _ in self._iter_queue(number, stats):
+                pass
+        finally:
+            if not last_stage:
+                self._put(number + 1, _DONE, stats)
+            stats.finished = time.monotonic()
+
+    def _iter_queue(self, number: int, stats: StageStats):
+        """
+        Чтение элементов из очереди до признака окончания данных
+        :param number: номер очереди
+        :param stats: статистика читающего этапа
+        :return: Генератор элементов
+        """
+        while True:
+            started = time.monotonic()
+            item = self.queues[number].get()
+            stats.wait_time += time.monotonic() - started
+            if item is _DONE:
+                return
+            yield item
+
+    def _put(self, number: int, item, stats: StageStats) -> None:
+        """
+        Запись элемента в очередь с ожиданием свободного места
+        :param number: номер очереди
+        :param item: элемент
+        :param stats: статистика пишущего этапа
+        :return:
+        """
+        started = time.monotonic()
+        self.queues[number].put(item)
+        stats.wait_time += time.monotonic() - started
+
+    def _fail(self, error: Exception) -> None:
+        """
+        Запоминаем ошибку и останавливаем чтение источника
+        :param error: исключение
+        :return:
+        """
+        logger.error(f'Конвейер {self.name}: ошибка {error!r}')
+        self._errors.append(error)
+        self._abort.set()
+
+    def log_stats(self) -> None:
+        """
+        Выводим в лог количество обработанных элементов, время работы этапов и заполненность очередей
+        :return:
+        """
+        parts = []
+        for number, stats in enumerate(self.stats):
+            part = f'{stats.name}: {stats.items} шт., в работе {stats.busy_time:.1f} с'
+            if number < len(self.queues):
+                part += f', очередь {self.queues[number].qsize()}'
+            parts.append(part)
+        logger.info(f'Конвейер {self.name}: ' + '; '.join(parts))
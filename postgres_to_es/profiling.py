@@ -0,0 +1,148 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import List, Optional
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ProfileSession:
+    """
+    Профилирование одного цикла: профили всех участвующих потоков объединяются в один файл
+    """
+
+    def __init__(self, name: str, memory: bool = False):
+        self.name = name
+        self.memory = memory
+        self.profiles: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+        self._started_tracemalloc = False
+
+    def start(self) -> None:
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            self._started_tracemalloc = True
+
+    def add(self, profile: cProfile.Profile) -> None:
+        with self._lock:
+            self.profiles.append(profile)
+
+    def dump(self, path_prefix: str, top: int = 50) -> None:
+        """
+        Сохраняем объединенный профиль (.prof, открывается pstats или snakeviz), текстовый отчет (.txt)
+        и, если включено, снимок памяти tracemalloc (.tracemalloc)
+        :param path_prefix: путь к файлам без расширения
+        :param top: количество строк в текстовом отчете
+        :return:
+        """
+        report = io.StringIO()
+        if self.profiles:
+            stats = pstats.Stats(*self.profiles, stream=report)
+            stats.dump_stats(f'{path_prefix}.prof')
+            stats.sort_stats('cumulative').print_stats(top)
+        if self.memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            snapshot.dump(f'{path_prefix}.tracemalloc')
+            current, peak = tracemalloc.get_traced_memory()
+            report.write(f'\ntracemalloc: текущая {current / 1024 / 1024:.1f} Мб, '
+                         f'пиковая {peak / 1024 / 1024:.1f} Мб\n')
+            for stat in snapshot.statistics('lineno')[:top]:
+                report.write(f'{stat}\n')
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+        with open(f'{path_prefix}.txt', 'w') as file:
+            file.write(report.getvalue())
+
+
+class Profiler:
+    """
+    Профилирование по запросу: после request() следующие cycles циклов выполняются под cProfile
+    и, если включено, с tracemalloc. Результаты сохраняются в output_dir в файлы с номером цикла.
+    Потоки конвейеров профилируются через thread(), процессы пула преобразования не профилируются
+    """
+
+    def __init__(self, output_dir: str = 'profiles', cycles: int = 1, memory: bool = False):
+        self.output_dir = output_dir
+        self.cycles = cycles
+        self.memory = memory
+        self.pending = 0
+        self.cycle_id = 0
+        self._session: Optional[ProfileSession] = None
+
+    def configure(self, output_dir: str, cycles: int = 1, memory: bool = False) -> None:
+        self.output_dir = output_dir
+        self.cycles = cycles
+        self.memory = memory
+
+    def request(self, cycles: Optional[int] = None) -> None:
+        """
+        Включаем профилирование следующих циклов
+        :param cycles: количество циклов, по умолчанию из настроек
+        :return:
+        """
+        self.pending = cycles or self.cycles
+        logger.info(f'Профилирование включено на {self.pending} циклов, результаты в {self.output_dir}')
+
+    def on_signal(self, signum, frame) -> None:
+        """Обработчик сигнала включения профилирования"""
+        self.request()
+
+    @contextmanager
+    def cycle(self, name: str):
+        """
+        Цикл работы сервиса: если запрошено профилирование, он выполняется под профилировщиком
+        :param name: название цикла для имени файла
+        """
+        self.cycle_id += 1
+        if not self.pending:
+            yield
+            return
+        self.pending -= 1
+        session = ProfileSession(name, self.memory)
+        session.start()
+        self._session = session
+        profile = cProfile.Profile()
+        started = time.monotonic()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._session = None
+            session.add(profile)
+            os.makedirs(self.output_dir, exist_ok=True)
+            path_prefix = os.path.join(self.output_dir, f'{time.strftime("%Y%m%d-%H%M%S")}-{name}-{self.cycle_id}')
+            session.dump(path_prefix)
+            logger.info(f'Профиль цикла {self.cycle_id} ({name}, {time.monotonic() - started:.1f} с) '
+                        f'сохранен в {path_prefix}.*')
+
+    @contextmanager
+    def thread(self):
+        """Работа потока конвейера: если идет профилирование цикла, поток профилируется вместе с ним"""
+        session = self._session
+        if session is None:
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # начиная с Python 3.12 cProfile может быть включен только в одном потоке
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            session.add(profile)
+
+
+# профилировщик сервиса, настраивается в main
+profiler = Profiler()
@@ -0,0 +1,86 @@
+import logging
+import random
+import time
+from typing import Dict, List, Optional
+
+from postgres_to_es.models import BaseTableClass
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class TableSchedule:
+    """Расписание проверки одной таблицы"""
+
+    def __init__(self, table: BaseTableClass, interval: float):
+        self.table = table
+        self.interval = interval
+        self.next_check = 0.0
+        self.checks = 0
+        self.changes = 0
+
+
+class PollScheduler:
+    """
+    Расписание проверки таблиц на изменения. Интервал проверки каждой таблицы подстраивается под частоту
+    ее изменений: если при проверке найдены изменения, интервал уменьшается в factor раз, если нет -
+    увеличивается в factor раз, оставаясь в пределах [min_interval, max_interval]. Чтобы проверки разных
+    таблиц не совпадали, к интервалу добавляется случайное отклонение до jitter от его величины
+    """
+
+    def __init__(self, tables: List[BaseTableClass], min_interval: float = 1, max_interval: float = 300,
+                 factor: float = 2, jitter: float = 0.1, seed: Optional[int] = None):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.factor = factor
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.schedules: Dict[str, TableSchedule] = {
+            table.table_to_check_update: TableSchedule(table, min_interval) for table in tables
+        }
+
+    def due_tables(self, now: Optional[float] = None) -> List[BaseTableClass]:
+        """
+        Таблицы, которые пора проверить
+        :param now: текущее время time.monotonic()
+        :return: список таблиц
+        """
+        now = time.monotonic() if now is None else now
+        return [schedule.table for schedule in self.schedules.values() if schedule.next_check <= now]
+
+    def record(self, table: BaseTableClass, changed: bool, now: Optional[float] = None) -> None:
+        """
+        Учитываем результат проверки таблицы и назначаем время следующей проверки
+        :param table: проверенная таблица
+        :param changed: признак того, что в таблице найдены изменения
+        :param now: текущее время time.monotonic()
+        :return:
+        """
+        now = time.monotonic() if now is None else now
+        schedule = self.schedules[table.table_to_check_update]
+        schedule.checks += 1
+        if changed:
+            schedule.changes += 1
+            schedule.interval = max(self.min_interval, schedule.interval / self.factor)
+        else:
+            schedule.interval = min(self.max_interval, schedule.interval * self.factor)
+        spread = schedule.interval * self.jitter
+        schedule.next_check = now + schedule.interval + self.random.uniform(-spread, spread)
+
+    def time_to_next(self, now: Optional[float] = None) -> float:
+        """
+        Время до ближайшей проверки
+        :param now: текущее время time.monotonic()
+        :return: время в секундах
+        """
+        now = time.monotonic() if now is None else now
+        return max(0.0, min(schedule.next_check for schedule in self.schedules.values()) - now)
+
+    def log_stats(self) -> None:
+        """
+        Выводим в лог интервалы проверки таблиц
+        :return:
+        """
+        parts = [f'{name}: интервал {schedule.interval:.1f} с, изменения в {schedule.changes} из {schedule.checks}'
+                 for name, schedule in self.schedules.items()]
+        logger.info('Расписание проверки таблиц: ' + '; '.join(parts))
@@ -0,0 +1,110 @@
+import json
+import re
+from datetime import date, time
+from typing import Any, List, Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ответ _bulk начинается с {"took":...,"errors":false,...}, при отсутствии ошибок список items можно не разбирать
+BULK_NO_ERRORS = re.compile(rb'"errors"\s*:\s*false')
+BULK_RESPONSE_HEAD = 256
+
+Operation = Tuple[str, int, int]
+
+
+def _default(obj: Any) -> str:
+    """
+    Сериализация типов, которые стандартный json не поддерживает. Дата и время записываются в ISO 8601,
+    как в orjson, остальные значения - строкой
+    :param obj: значение
+    :return: строка
+    """
+    if isinstance(obj, (date, time)):
+        return obj.isoformat()
+    return str(obj)
+
+
+# json.dumps с параметрами создает новый JSONEncoder при каждом вызове, поэтому кодировщик создается один раз
+JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_default)
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Сериализация в JSON. Использует orjson, если он установлен, иначе стандартный json
+    :param obj: объект для сериализации
+    :return: JSON в виде bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=str)
+    return JSON_ENCODER.encode(obj).encode()
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Разбор JSON. Использует orjson, если он установлен, иначе стандартный json
+    :param data: JSON
+    :return: объект
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def bulk_has_errors(content: bytes) -> bool:
+    """
+    Проверка ответа _bulk на наличие ошибок по началу ответа, без разбора списка items
+    :param content: тело ответа ES
+    :return: True, если в ответе есть ошибки
+    """
+    return not BULK_NO_ERRORS.search(content, 0, BULK_RESPONSE_HEAD)
+
+
+class BulkPayload:
+    """
+    Операции bulk-запроса, записанные подряд в один буфер. Операция хранится как id документа
+    и границы ее строк в буфере, пачка смежных операций передается в HTTP-запрос срезом буфера без копирования
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.operations: List[Operation] = []
+
+    def add(self, doc_id: str, action: dict, document: Optional[dict] = None) -> None:
+        """
+        Добавляем операцию: строку действия и, если нужно, строку документа
+        :param doc_id: id документа
+        :param action: действие bulk-запроса
+        :param document: документ
+        :return:
+        """
+        start = len(self.buffer)
+        if orjson is not None:
+            self.buffer += orjson.dumps(action, default=str)
+            self.buffer += b'\n'
+            if document is not None:
+                self.buffer += orjson.dumps(document, default=str)
+                self.buffer += b'\n'
+        else:
+            # стандартный json: строки операции склеиваются в str и кодируются в UTF-8 одним вызовом
+            lines = JSON_ENCODER.encode(action) + '\n'
+            if document is not None:
+                lines += JSON_ENCODER.encode(document) + '\n'
+            self.buffer += lines.encode()
+        self.operations.append((doc_id, start, len(self.buffer)))
+
+    def body(self, operations: List[Operation]) -> Union[memoryview, bytes]:
+        """
+        Тело запроса для пачки операций этого буфера
+        :param operations: список операций
+        :return: срез буфера, если операции идут подряд, иначе склеенная копия
+        """
+        view = memoryview(self.buffer)
+        if all(operations[i][2] == operations[i + 1][1] for i in range(len(operations) - 1)):
+            return view[operations[0][1]:operations[-1][2]]
+        return b''.join(view[start:end] for _, start, end in operations)
+
+    def __len__(self) -> int:
+        return len(self.operations)
@@ -1,13 +1,23 @@
 import abc
+import asyncio
 import json
+import logging
 import os
+import sqlite3
+import threading
 import time
 from functools import wraps
-from typing import Any, Optional
+from typing import Any, Iterable, Optional
 
 import psycopg2
+import requests
+from psycopg2.extras import Json, execute_values
 from urllib3.exceptions import MaxRetryError, NewConnectionError
 
+from postgres_to_es.metrics import BACKOFF_RETRIES
+
+logger = logging.getLogger(__name__)
+
 
 class BaseStorage:
     @abc.abstractmethod
@@ -20,6 +30,19 @@ class BaseStorage:
         """Загрузить состояние локально из постоянного хранилища"""
         pass
 
+    def save_keys(self, state: dict, keys: Iterable[str]) -> None:
+        """
+        Сохранить изменившиеся ключи состояния. По умолчанию состояние сохраняется целиком
+        :param state: словарь состояния
+        :param keys: изменившиеся ключи
+        :return:
+        """
+        self.save_state(state)
+
+    def close(self) -> None:
+        """Освободить ресурсы хранилища"""
+        pass
+
 
 class JsonFileStorage(BaseStorage):
     def __init__(self, file_path: Optional[str] = None):
@@ -27,12 +50,17 @@ class JsonFileStorage(BaseStorage):
 
     def save_state(self, state: dict):
         """
-        Сохраняем полученное состояние
+        Сохраняем полученное состояние. Состояние пишется во временный файл, который затем атомарно
+        заменяет основной, поэтому при сбое во время записи остается предыдущая версия файла
         :param state: словарь состояния
         :return:
         """
-        with open(self.file_path, 'w') as file:
+        tmp_path = f'{self.file_path}.tmp'
+        with open(tmp_path, 'w') as file:
             json.dump(state, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.file_path)
 
     def retrieve_state(self) -> dict:
         """Загрузить состояние локально из постоянного хранилища"""
@@ -42,33 +70,124 @@ class JsonFileStorage(BaseStorage):
             try:
                 templates = json.load(file)
             except json.decoder.JSONDecodeError:
+                logger.error(f'Файл состояния {self.file_path} поврежден, состояние сброшено')
                 templates = {}
             return templates
 
 
+class SqliteStorage(BaseStorage):
+    """
+    Хранение состояния в SQLite: каждый ключ - отдельная строка, поэтому при сохранении
+    записываются только изменившиеся ключи
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def save_state(self, state: dict) -> None:
+        """
+        Сохраняем полученное состояние целиком
+        :param state: словарь состояния
+        :return:
+        """
+        with self.connection:
+            self.connection.execute('DELETE FROM state')
+            self._upsert(state, state.keys())
+
+    def save_keys(self, state: dict, keys: Iterable[str]) -> None:
+        """
+        Сохраняем изменившиеся ключи состояния одной транзакцией
+        :param state: словарь состояния
+        :param keys: изменившиеся ключи
+        :return:
+        """
+        with self.connection:
+            self._upsert(state, keys)
+
+    def _upsert(self, state: dict, keys: Iterable[str]) -> None:
+        self.connection.executemany('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                                    [(key, json.dumps(state[key])) for key in keys])
+
+    def retrieve_state(self) -> dict:
+        """Загрузить состояние локально из постоянного хранилища"""
+        return {key: json.loads(value) for key, value in self.connection.execute('SELECT key, value FROM state')}
+
+    def close(self) -> None:
+        """
+        Закрываем соединение с SQLite
+        :return:
+        """
+        self.connection.close()
+
+
 class State:
     """
     Класс для хранения состояния при работе с данными, чтобы постоянно не перечитывать данные с начала.
-    Здесь представлена реализация с сохранением состояния в файл.
+    Состояние читается из хранилища один раз и хранится в памяти, изменения сохраняются в хранилище
+    не чаще, чем раз в flush_interval секунд (0 - при каждом изменении).
     В целом ничего не мешает поменять это поведение на работу с БД или распределённым хранилищем.
     """
 
-    def __init__(self, storage: BaseStorage):
+    def __init__(self, storage: BaseStorage, flush_interval: float = 0):
         self.storage = storage
+        self.flush_interval = flush_interval
+        self._data = storage.retrieve_state()
+        self._dirty = set()
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
 
     def set_state(self, key: str, value: Any) -> None:
         """Установить состояние для определённого ключа"""
-        data = self.storage.retrieve_state()
-        data[key] = value
-        self.storage.save_state(data)
+        with self._lock:
+            if key in self._data and self._data[key] == value:
+                return
+            self._data[key] = value
+            self._dirty.add(key)
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
 
     def get_state(self, key: str) -> Any:
         """Получить состояние по определённому ключу"""
-        data = self.storage.retrieve_state()
-        return data.get(key)
+        with self._lock:
+            return self._data.get(key)
 
+    def flush(self) -> None:
+        """Сохранить в хранилище изменения, которые еще не были сохранены"""
+        with self._lock:
+            self._flush()
 
-def backoff(logger, start_sleep_time=0.1, factor=2, border_sleep_time=10):
+    def reload(self) -> None:
+        """
+        Перечитать состояние из хранилища, которое могли изменить другие экземпляры сервиса.
+        Несохраненные изменения этого экземпляра сохраняются
+        """
+        with self._lock:
+            data = self.storage.retrieve_state()
+            data.update((key, self._data[key]) for key in self._dirty)
+            self._data = data
+
+    def close(self) -> None:
+        """Сохранить несохраненные изменения и закрыть хранилище"""
+        self.flush()
+        self.storage.close()
+
+    def _flush(self) -> None:
+        if self._dirty:
+            self.storage.save_keys(self._data, self._dirty)
+            self._dirty = set()
+        self._last_flush = time.monotonic()
+
+
+# ошибки соединения, при которых backoff повторяет вызов
+BACKOFF_EXCEPTIONS = (psycopg2.Error, TimeoutError, NewConnectionError, ConnectionError, MaxRetryError,
+                      ConnectionRefusedError, requests.ConnectionError, requests.Timeout)
+
+
+def backoff(logger, start_sleep_time=0.1, factor=2, border_sleep_time=10, exceptions=BACKOFF_EXCEPTIONS):
     """
     Функция для повторного выполнения функции через некоторое время, если возникла ошибка. Использует наивный
     экспоненциальный рост времени повтора (factor) до граничного времени ожидания (border_sleep_time)
@@ -80,6 +199,7 @@ def backoff(logger, start_sleep_time=0.1, factor=2, border_sleep_time=10):
     :param start_sleep_time: начальное время повтора
     :param factor: во сколько раз нужно увеличить время ожидания
     :param border_sleep_time: граничное время ожидания
+    :param exceptions: ошибки, при которых вызов повторяется
     :return: результат выполнения функции
     """
     def real_decorator(func):
@@ -93,9 +213,9 @@ def backoff(logger, start_sleep_time=0.1, factor=2, border_sleep_time=10):
                     out = func(*args, **kwargs)
                     logger.info('Подключение успешно выполнено')
                     return out
-                except(psycopg2.Error, TimeoutError, NewConnectionError, ConnectionError, MaxRetryError,
-                       ConnectionRefusedError) as e:
+                except exceptions as e:
                     logger.error(f'Произошла ошибка {e} при подключении')
+                    BACKOFF_RETRIES.inc(function=func.__qualname__)
                     time.sleep(t)
                     i += 1
                     if t < border_sleep_time:
@@ -104,3 +224,107 @@ def backoff(logger, start_sleep_time=0.1, factor=2, border_sleep_time=10):
                         t = border_sleep_time
         return inner
     return real_decorator
+
+
+def async_backoff(logger, start_sleep_time=0.1, factor=2, border_sleep_time=10, exceptions=BACKOFF_EXCEPTIONS):
+    """
+    Версия backoff для корутин: ожидание между повторами не блокирует цикл событий.
+    Формула времени ожидания та же, что и у backoff
+    :param logger: экземпляр логгера для логгирования
+    :param start_sleep_time: начальное время повтора
+    :param factor: во сколько раз нужно увеличить время ожидания
+    :param border_sleep_time: граничное время ожидания
+    :param exceptions: ошибки, при которых вызов повторяется
+    :return: результат выполнения корутины
+    """
+    def real_decorator(func):
+        @wraps(func)
+        async def inner(*args, **kwargs):
+            i = 0
+            t = start_sleep_time * factor ** i
+            while True:
+                try:
+                    logger.info('Пытаемся подключится')
+                    out = await func(*args, **kwargs)
+                    logger.info('Подключение успешно выполнено')
+                    return out
+                except exceptions as e:
+                    logger.error(f'Произошла ошибка {e} при подключении')
+                    BACKOFF_RETRIES.inc(function=func.__qualname__)
+                    await asyncio.sleep(t)
+                    i += 1
+                    if t < border_sleep_time:
+                        t = start_sleep_time * 2 ** i
+                    else:
+                        t = border_sleep_time
+        return inner
+    return real_decorator
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранение состояния в таблице Postgres, общей для нескольких экземпляров сервиса. Каждый ключ - отдельная
+    строка, при сохранении записываются только изменившиеся ключи, поэтому экземпляры не затирают ключи друг друга
+    """
+
+    def __init__(self, settings: dict, table: str = 'content.etl_state'):
+        self.settings = settings
+        self.table = table
+        self.connection = None
+        self._execute(f'CREATE TABLE IF NOT EXISTS {table} (key text PRIMARY KEY, value jsonb, '
+                      f'updated_at timestamp with time zone NOT NULL DEFAULT now())')
+
+    @backoff(logger)
+    def _execute(self, sql: str, rows: Optional[list] = None, fetch: bool = False) -> Optional[list]:
+        """
+        Выполнение запроса в отдельной транзакции, при разрыве соединения подключаемся заново
+        :param sql: запрос
+        :param rows: строки для подстановки через execute_values
+        :param fetch: вернуть результат запроса
+        :return: строки результата, если fetch
+        """
+        if self.connection is None or self.connection.closed:
+            self.connection = psycopg2.connect(**self.settings)
+        try:
+            with self.connection, self.connection.cursor() as cursor:
+                if rows is None:
+                    cursor.execute(sql)
+                else:
+                    execute_values(cursor, sql, rows)
+                return cursor.fetchall() if fetch else None
+        except psycopg2.OperationalError:
+            self.connection.close()
+            raise
+
+    def save_state(self, state: dict) -> None:
+        """
+        Сохраняем все ключи состояния. Ключи, которых нет в state, не удаляются: их могли записать
+        другие экземпляры сервиса
+        :param state: словарь состояния
+        :return:
+        """
+        self.save_keys(state, state.keys())
+
+    def save_keys(self, state: dict, keys: Iterable[str]) -> None:
+        """
+        Сохраняем изменившиеся ключи состояния одной транзакцией
+        :param state: словарь состояния
+        :param keys: изменившиеся ключи
+        :return:
+        """
+        rows = [(key, Json(state[key])) for key in keys]
+        if rows:
+            self._execute(f'INSERT INTO {self.table} (key, value) VALUES %s '
+                          f'ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = now()', rows)
+
+    def retrieve_state(self) -> dict:
+        """Загрузить состояние локально из постоянного хранилища"""
+        return dict(self._execute(f'SELECT key, value FROM {self.table}', fetch=True))
+
+    def close(self) -> None:
+        """
+        Закрываем соединение с БД
+        :return:
+        """
+        if self.connection is not None:
+            self.connection.close()
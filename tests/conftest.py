@@ -0,0 +1,27 @@
+import os
+
+import psycopg2
+import pytest
+
+from benchmarks.synthetic_data import ensure_database, get_settings
+
+# БД для тестов с Postgres, сервер и пользователь берутся из переменных окружения сервиса
+TEST_DB_NAME = os.environ.get('TEST_DB_NAME', 'etl_test')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'postgres: тест выполняет запросы к Postgres (DB_HOST, POSTGRES_USER ...)')
+
+
+@pytest.fixture(scope='session')
+def postgres_settings() -> dict:
+    """
+    Настройки подключения к тестовой БД, если Postgres недоступен - тест пропускается
+    :return: словарь настроек подключения в формате psycopg2
+    """
+    settings = get_settings(TEST_DB_NAME)
+    try:
+        ensure_database(settings)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'Postgres недоступен: {e}')
+    return settings
@@ -0,0 +1,27 @@
+import random
+import uuid
+
+import psycopg2
+import pytest
+
+from postgres_to_es.coordinator import PARTITION_SQL, film_partition
+
+
+@pytest.mark.postgres
+@pytest.mark.parametrize('partition_count', [1, 3, 8, 13])
+def test_film_partition_matches_sql(postgres_settings, partition_count):
+    rnd = random.Random(partition_count)
+    films_id = [str(uuid.UUID(int=rnd.getrandbits(128), version=4)) for _ in range(300)]
+    # граничные значения последних 32 бит: старший бит установлен, все биты установлены, все сброшены
+    films_id += ['00000000-0000-4000-8000-000080000000', '00000000-0000-4000-8000-0000ffffffff',
+                 'ffffffff-ffff-4fff-bfff-ffff00000000']
+    connection = psycopg2.connect(**postgres_settings)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute(f'SELECT id::text, {PARTITION_SQL.format(column="id")} '
+                           f'FROM unnest(%(films_id)s::uuid[]) AS id',
+                           {'films_id': films_id, 'partition_count': partition_count})
+            partitions = dict(cursor.fetchall())
+    finally:
+        connection.close()
+    assert partitions == {film_id: film_partition(film_id, partition_count) for film_id in films_id}
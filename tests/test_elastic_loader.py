@@ -0,0 +1,132 @@
+import pytest
+
+from benchmarks.fake_es import FakeElasticsearch
+from postgres_to_es import elastic_loader
+from postgres_to_es.elastic_loader import (FAILED_FILMS, BulkThrottle,
+                                           ESLoader, add_failed_films,
+                                           parse_bulk_errors, split_bulk)
+from postgres_to_es.serializer import dumps
+from postgres_to_es.utils import JsonFileStorage, State
+
+INDEX = 'movies_test'
+
+
+def make_documents(count: int) -> list:
+    return [{'id': f'film-{i:04}', 'title': f'Фильм {i}', 'description': 'описание ' * 20} for i in range(count)]
+
+
+@pytest.fixture
+def es():
+    server = FakeElasticsearch(seed=1).start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def no_retry_sleep(monkeypatch):
+    # пауза между повторными отправками не нужна для проверки результата
+    monkeypatch.setattr(elastic_loader.time, 'sleep', lambda seconds: None)
+
+
+def test_split_bulk_limits_documents_and_bytes():
+    operations = [(str(i), i * 10, i * 10 + 10) for i in range(10)]
+    assert [len(chunk) for chunk in split_bulk(operations, 4, 1000)] == [4, 4, 2]
+    assert [len(chunk) for chunk in split_bulk(operations, 100, 35)] == [3, 3, 3, 1]
+    # операция больше ограничения по размеру отправляется отдельной пачкой
+    chunks = list(split_bulk([('big', 0, 100), ('small', 100, 110)], 100, 50))
+    assert chunks == [[('big', 0, 100)], [('small', 100, 110)]]
+
+
+def test_parse_bulk_errors_separates_retry_and_failed():
+    operations = [('a', 0, 1), ('b', 1, 2), ('c', 2, 3), ('d', 3, 4)]
+    content = dumps({'errors': True, 'items': [
+        {'index': {'_id': 'a', 'status': 201}},
+        {'index': {'_id': 'b', 'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}},
+        {'index': {'_id': 'c', 'status': 400, 'error': {'type': 'mapper_parsing_exception'}}},
+        {'index': {'_id': 'd', 'status': 503, 'error': {'type': 'unavailable_shards_exception'}}},
+    ]})
+    retry, failed = parse_bulk_errors(operations, content)
+    assert retry == [('b', 1, 2), ('d', 3, 4)]
+    assert failed == ['c']
+
+
+def test_throttle_backs_off_and_recovers():
+    throttle = BulkThrottle(100, 4, min_batch_size=10, recovery_step=10)
+    for _ in range(5):
+        throttle.on_reject()
+    assert (throttle.batch_size, throttle.concurrency) == (10, 1)
+    for _ in range(9):
+        throttle.on_success()
+    assert (throttle.batch_size, throttle.concurrency) == (100, 1)
+    throttle.on_success()
+    assert throttle.concurrency == 2
+    for _ in range(20):
+        throttle.on_success()
+    assert (throttle.batch_size, throttle.concurrency) == (100, 4)
+
+
+def test_load_stores_all_documents(es):
+    esl = ESLoader(es.url, bulk_max_docs=7, concurrency=2)
+    try:
+        assert esl.load_to_es(make_documents(50), INDEX) == []
+    finally:
+        esl.close()
+    assert len(es.indices[INDEX]['docs']) == 50
+    assert es.stats['bulk_requests'] == 8
+    assert esl.stats == {'indexed': 50, 'retried': 0, 'failed': 0}
+
+
+def test_rejected_documents_are_retried(es):
+    es.reject = 0.3
+    esl = ESLoader(es.url, bulk_max_docs=10, concurrency=1)
+    try:
+        assert esl.load_to_es(make_documents(50), INDEX) == []
+    finally:
+        esl.close()
+    assert len(es.indices[INDEX]['docs']) == 50
+    assert esl.stats['retried'] > 0
+    assert esl.stats['indexed'] == 50
+
+
+def test_too_large_request_is_split(es):
+    documents = make_documents(16)
+    es.max_bytes = len(dumps(documents[0])) * 5
+    esl = ESLoader(es.url, bulk_max_docs=100, concurrency=1)
+    try:
+        assert esl.load_to_es(documents, INDEX) == []
+    finally:
+        esl.close()
+    assert len(es.indices[INDEX]['docs']) == 16
+    assert es.stats['bulk_requests'] >= 4
+    assert esl.stats['failed'] == 0
+
+
+def test_document_larger_than_request_limit_is_failed(es):
+    documents = make_documents(3)
+    documents[1]['description'] *= 100
+    es.max_bytes = len(dumps(documents[0])) * 10
+    esl = ESLoader(es.url, bulk_max_docs=100, concurrency=1)
+    try:
+        assert esl.load_to_es(documents, INDEX) == [documents[1]['id']]
+    finally:
+        esl.close()
+    assert set(es.indices[INDEX]['docs']) == {documents[0]['id'], documents[2]['id']}
+    assert esl.stats['failed'] == 1
+
+
+def test_update_of_missing_document_is_failed(es):
+    esl = ESLoader(es.url)
+    try:
+        esl.load_to_es(make_documents(1), INDEX)
+        changes = {'film-0000': [], 'missing': []}
+        assert esl.update_documents(changes, INDEX) == ['missing']
+    finally:
+        esl.close()
+
+
+def test_failed_films_are_merged_into_state(tmp_path):
+    state = State(JsonFileStorage(str(tmp_path / 'state.json')))
+    add_failed_films(state, ['b', 'a'])
+    add_failed_films(state, ['c', 'a'])
+    add_failed_films(state, [])
+    assert state.get_state(FAILED_FILMS) == ['a', 'b', 'c']
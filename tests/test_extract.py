@@ -0,0 +1,51 @@
+import psycopg2
+import pytest
+
+from benchmarks.synthetic_data import generate
+from postgres_to_es.extract import (PostgresExctract, get_initial_watermark,
+                                    get_scan_horizon, prepare_filmwork_update)
+
+
+@pytest.mark.postgres
+def test_scan_waits_for_uncommitted_transaction(postgres_settings):
+    generate(postgres_settings, 10, seed=2)
+    postgres = PostgresExctract(postgres_settings)
+    late = psycopg2.connect(**postgres_settings)
+    other = psycopg2.connect(**postgres_settings)
+    other.autocommit = True
+    try:
+        watermark = get_initial_watermark(postgres)
+        with late.cursor() as cursor, other.cursor() as other_cursor:
+            other_cursor.execute('SELECT id::text FROM content.film_work ORDER BY id LIMIT 2')
+            late_film, film = [row[0] for row in other_cursor.fetchall()]
+            # транзакция проставляет updated_at раньше, чем изменение, зафиксированное до нее
+            cursor.execute('UPDATE content.film_work SET updated_at = now() WHERE id = %s', (late_film,))
+            other_cursor.execute('UPDATE content.film_work SET updated_at = now() WHERE id = %s', (film,))
+        assert prepare_filmwork_update(postgres, watermark, 'content.film_work') == []
+        late.commit()
+        rows = prepare_filmwork_update(postgres, watermark, 'content.film_work')
+        assert [str(row['id']) for row in rows] == [late_film, film]
+    finally:
+        late.close()
+        other.close()
+        postgres.close()
+
+
+@pytest.mark.postgres
+def test_scan_horizon_ignores_other_databases(postgres_settings):
+    postgres = PostgresExctract(postgres_settings)
+    other_database = psycopg2.connect(**dict(postgres_settings, dbname='postgres'))
+    same_database = psycopg2.connect(**postgres_settings)
+    try:
+        with other_database.cursor() as cursor:
+            cursor.execute('SELECT now()')
+            other_started = cursor.fetchone()[0]
+        assert get_scan_horizon(postgres) > other_started
+        with same_database.cursor() as cursor:
+            cursor.execute('SELECT now()')
+            started = cursor.fetchone()[0]
+        assert get_scan_horizon(postgres) == started
+    finally:
+        other_database.close()
+        same_database.close()
+        postgres.close()
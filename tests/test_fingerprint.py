@@ -0,0 +1,74 @@
+from postgres_to_es.fingerprint import FingerprintStore
+
+
+def count_rows(store: FingerprintStore) -> int:
+    return store.connection.execute('SELECT COUNT(*) FROM fingerprint').fetchone()[0]
+
+
+def test_unchanged_documents_are_filtered(tmp_path):
+    store = FingerprintStore(str(tmp_path / 'fingerprints.db'))
+    documents = [{'id': 'a', 'title': 'A', 'genre': ['Drama']}, {'id': 'b', 'title': 'B', 'genre': []}]
+    assert store.filter_changed(documents) == documents
+    store.save(documents)
+    # порядок ключей не влияет на отпечаток
+    assert store.filter_changed([{'genre': ['Drama'], 'title': 'A', 'id': 'a'}]) == []
+    changed = {'id': 'b', 'title': 'B2', 'genre': []}
+    assert store.filter_changed([documents[0], changed]) == [changed]
+    assert store.stats == {'hits': 2, 'misses': 3, 'evicted': 0}
+    store.close()
+
+
+def test_failed_and_invalidated_documents_are_sent_again(tmp_path):
+    store = FingerprintStore(str(tmp_path / 'fingerprints.db'))
+    documents = [{'id': 'a', 'title': 'A'}, {'id': 'b', 'title': 'B'}, {'id': 'c', 'title': 'C'}]
+    store.save(documents)
+    # документ, который ES не сохранил, удаляется из хранилища, даже если его отпечаток был сохранен раньше
+    store.save(documents, exclude=['b'])
+    store.invalidate(['c'])
+    assert store.filter_changed(documents) == documents[1:]
+    store.close()
+
+
+def test_least_recently_saved_documents_are_evicted(tmp_path):
+    store = FingerprintStore(str(tmp_path / 'fingerprints.db'), max_entries=3)
+    store.save([{'id': 'a'}, {'id': 'b'}, {'id': 'c'}])
+    store.save([{'id': 'a'}, {'id': 'a'}])
+    assert store.stats['evicted'] == 0
+    store.save([{'id': 'd'}, {'id': 'e'}])
+    assert store.stats['evicted'] == 2
+    assert store.filter_changed([{'id': doc_id} for doc_id in 'abcde']) == [{'id': 'b'}, {'id': 'c'}]
+    assert count_rows(store) == 3
+    store.close()
+
+
+def test_size_is_kept_across_restarts(tmp_path):
+    path = str(tmp_path / 'fingerprints.db')
+    store = FingerprintStore(path, max_entries=4)
+    store.save([{'id': str(i)} for i in range(4)])
+    store.invalidate(['0', 'missing'])
+    store.close()
+    store = FingerprintStore(path, max_entries=4)
+    store.save([{'id': '4'}])
+    assert store.stats['evicted'] == 0
+    store.save([{'id': '5'}])
+    assert store.stats['evicted'] == 1
+    assert count_rows(store) == 4
+    store.clear()
+    store.save([{'id': str(i)} for i in range(4)])
+    assert store.stats['evicted'] == 1
+    store.close()
+
+
+def test_names_are_stored_per_source(tmp_path):
+    store = FingerprintStore(str(tmp_path / 'fingerprints.db'))
+    store.save_names('content.person', {'p1': 'Иван', 'p2': 'Петр'})
+    store.save_names('content.genre', {'p1': 'Drama'})
+    store.save_names('content.person', {'p1': 'Иван Иванов'})
+    assert store.get_names('content.person', ['p1', 'p2', 'p3']) == {'p1': 'Иван Иванов', 'p2': 'Петр'}
+    store.save([{'id': 'a'}])
+    store.clear_names()
+    assert store.get_names('content.genre', ['p1']) == {}
+    assert count_rows(store) == 1
+    store.clear()
+    assert count_rows(store) == 0
+    store.close()
@@ -0,0 +1,89 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from benchmarks.bench_workers import query
+from benchmarks.fake_es import FakeElasticsearch
+from benchmarks.synthetic_data import generate
+from postgres_to_es import main
+from postgres_to_es.coordinator import film_partition
+from postgres_to_es.elastic_loader import FAILED_FILMS, FULL_LOAD_COMPLETED
+from postgres_to_es.extract import PostgresExctract, get_initial_watermark
+from postgres_to_es.main import failed_films_key, has_changes, has_pending_work
+from postgres_to_es.models import FilmWorkTables
+from postgres_to_es.utils import JsonFileStorage, SqliteStorage, State
+
+TIMEOUT = 60
+
+
+def test_failed_films_need_cycle_without_changes(tmp_path):
+    state = State(JsonFileStorage(str(tmp_path / 'state.json')))
+    assert not has_pending_work(None, state, [])
+    state.set_state(FAILED_FILMS, ['film'])
+    assert has_pending_work(None, state, [])
+    state.set_state(failed_films_key(3), ['film'])
+    assert has_pending_work(None, state, [], {3})
+    assert not has_pending_work(None, state, [], {1, 2})
+
+
+@pytest.mark.postgres
+def test_failed_films_are_retried_when_tables_are_quiet(postgres_settings, tmp_path):
+    generate(postgres_settings, 50, seed=3)
+    films_id = sorted(str(row[0]) for row in query(postgres_settings, 'SELECT id FROM content.film_work LIMIT 5'))
+    postgres = PostgresExctract(postgres_settings)
+    try:
+        watermark = get_initial_watermark(postgres)
+    finally:
+        postgres.close()
+    # первичная загрузка завершена, изменений после отметок нет, в состоянии остались фильмы для повторной загрузки
+    state = State(SqliteStorage(str(tmp_path / 'state.db')))
+    state.set_state(FULL_LOAD_COMPLETED, True)
+    for table in ('content.person', 'content.genre', 'content.film_work'):
+        state.set_state(table, watermark)
+    state.set_state(FAILED_FILMS, films_id)
+    state.close()
+
+    es = FakeElasticsearch().start()
+    env = dict(os.environ, DB_NAME=postgres_settings['dbname'], URL=es.url, INDEX='movies_test',
+               STATE_DB=str(tmp_path / 'state.db'), POLL_ADAPTIVE='true', POLL_MIN_INTERVAL='1', SLEEP_TIME='1',
+               METRICS_PORT='0', NOTIFY_MODE='false', ASYNC_MODE='false', WORKER_PARTITIONS='0',
+               FINGERPRINT_DB='', INDEX_VERSION='', DELETION_LOG='false')
+    service = subprocess.Popen([sys.executable, '-m', 'postgres_to_es.main'], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + TIMEOUT
+        while time.monotonic() < deadline and not set(films_id) <= set(es.writes):
+            time.sleep(0.05)
+    finally:
+        service.terminate()
+        service.wait(30)
+        es.shutdown()
+    assert set(films_id) <= set(es.writes)
+    state = State(SqliteStorage(str(tmp_path / 'state.db')))
+    assert not state.get_state(FAILED_FILMS)
+    state.close()
+
+
+@pytest.mark.postgres
+def test_film_changes_are_checked_in_own_partitions(postgres_settings, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'WORKER_PARTITIONS', 4)
+    generate(postgres_settings, 50, seed=4)
+    table = FilmWorkTables(['content.film_work', ''])
+    films_id = [str(row[0]) for row in query(postgres_settings, 'SELECT id FROM content.film_work')]
+    own = next(film_id for film_id in films_id if film_partition(film_id, 4) == 0)
+    other = next(film_id for film_id in films_id if film_partition(film_id, 4) != 0)
+    postgres = PostgresExctract(postgres_settings)
+    try:
+        state = State(JsonFileStorage(str(tmp_path / 'state.json')))
+        state.set_state(table.table_to_check_update, get_initial_watermark(postgres))
+        # последнее изменение таблицы в партиции другого экземпляра не считается изменением для партиции 0
+        query(postgres_settings, 'UPDATE content.film_work SET updated_at = now() WHERE id = %s RETURNING id', (other,))
+        assert has_changes(postgres, state, table, {1, 2, 3})
+        assert not has_changes(postgres, state, table, {0})
+        query(postgres_settings, 'UPDATE content.film_work SET updated_at = now() WHERE id = %s RETURNING id', (own,))
+        assert has_changes(postgres, state, table, {0})
+    finally:
+        postgres.close()
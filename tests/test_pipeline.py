@@ -0,0 +1,121 @@
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from postgres_to_es.pipeline import Pipeline, ordered_map
+
+TIMEOUT = 10
+
+
+def run_with_timeout(pipeline: Pipeline):
+    """
+    Запуск конвейера в отдельном потоке: зависший конвейер не должен останавливать тесты
+    :param pipeline: конвейер
+    :return: результат run() или исключение, которое он выбросил
+    """
+    result = []
+
+    def target():
+        try:
+            result.append(pipeline.run())
+        except Exception as e:
+            result.append(e)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive(), 'конвейер не завершился'
+    return result[0]
+
+
+def test_items_pass_all_stages_in_order():
+    collected = []
+    pipeline = Pipeline('test', iter(range(100)), [
+        ('double', lambda items: (item * 2 for item in items)),
+        ('collect', lambda items: (collected.append(item) for item in items)),
+    ], queue_size=2)
+    assert run_with_timeout(pipeline) is True
+    assert collected == [item * 2 for item in range(100)]
+    assert [stats.items for stats in pipeline.stats] == [100, 100, 100]
+
+
+def test_stage_error_is_raised_and_source_stops():
+    read = []
+
+    def source():
+        for item in itertools.count():
+            read.append(item)
+            yield item
+
+    def fail(items):
+        for item in items:
+            if item == 5:
+                raise ValueError('ошибка этапа')
+            yield item
+
+    pipeline = Pipeline('test', source(), [('fail', fail), ('sink', lambda items: items)], queue_size=1)
+    error = run_with_timeout(pipeline)
+    assert isinstance(error, ValueError)
+    # бесконечный источник останавливается после ошибки
+    assert len(read) < 100
+
+
+def test_source_error_is_raised():
+    def source():
+        yield 1
+        raise RuntimeError('ошибка источника')
+
+    pipeline = Pipeline('test', source(), [('sink', lambda items: items)])
+    assert isinstance(run_with_timeout(pipeline), RuntimeError)
+    assert pipeline.completed is False
+
+
+def test_stop_event_finishes_received_items():
+    stop_event = threading.Event()
+    collected = []
+
+    def collect(items):
+        for item in items:
+            collected.append(item)
+            if item == 3:
+                stop_event.set()
+            yield item
+
+    pipeline = Pipeline('test', iter(range(1000)), [('collect', collect)], queue_size=1, stop_event=stop_event)
+    assert run_with_timeout(pipeline) is False
+    # полученные источником элементы дорабатываются, пропусков нет
+    assert collected == list(range(len(collected)))
+    assert len(collected) < 1000
+
+
+def test_ordered_map_keeps_order_and_limits_in_flight():
+    in_flight = []
+    lock = threading.Lock()
+    peak = [0]
+
+    def work(item):
+        with lock:
+            in_flight.append(item)
+            peak[0] = max(peak[0], len(in_flight))
+        time.sleep(0.001 * (item % 3))
+        with lock:
+            in_flight.remove(item)
+        return item * 10
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert list(ordered_map(executor, work, range(30), max_in_flight=3)) == [item * 10 for item in range(30)]
+    assert peak[0] <= 3
+
+
+def test_ordered_map_raises_item_error():
+    def work(item):
+        if item == 2:
+            raise KeyError(item)
+        return item
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(KeyError):
+            list(ordered_map(executor, work, range(5), max_in_flight=2))
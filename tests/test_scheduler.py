@@ -0,0 +1,49 @@
+from postgres_to_es.models import FilmWorkTables, GenreTables, PersonTables
+from postgres_to_es.scheduler import PollScheduler
+
+PERSON = PersonTables(['content.person', 'content.person_film_work', 'pfw.person_id'])
+GENRE = GenreTables(['content.genre', 'content.genre_film_work', 'pfw.genre_id'])
+FILM = FilmWorkTables(['content.film_work', ''])
+
+
+def test_all_tables_are_due_at_start():
+    scheduler = PollScheduler([PERSON, GENRE, FILM])
+    assert scheduler.due_tables(now=0) == [PERSON, GENRE, FILM]
+
+
+def test_interval_adapts_within_bounds():
+    scheduler = PollScheduler([PERSON], min_interval=1, max_interval=8, jitter=0)
+    now = 0.0
+    intervals = []
+    for changed in [False, False, False, False, False, True, True, True, True]:
+        scheduler.record(PERSON, changed, now=now)
+        intervals.append(scheduler.schedules['content.person'].interval)
+    assert intervals == [2, 4, 8, 8, 8, 4, 2, 1, 1]
+    schedule = scheduler.schedules['content.person']
+    assert (schedule.checks, schedule.changes) == (9, 4)
+
+
+def test_only_due_tables_are_returned():
+    scheduler = PollScheduler([PERSON, GENRE, FILM], min_interval=1, max_interval=300, jitter=0)
+    scheduler.record(PERSON, False, now=100)
+    scheduler.record(GENRE, True, now=100)
+    scheduler.record(FILM, False, now=100)
+    for _ in range(3):
+        scheduler.record(FILM, False, now=100)
+    assert scheduler.due_tables(now=100.5) == []
+    assert scheduler.due_tables(now=101) == [GENRE]
+    assert scheduler.due_tables(now=102) == [PERSON, GENRE]
+    assert scheduler.due_tables(now=116) == [PERSON, GENRE, FILM]
+    assert scheduler.time_to_next(now=100.25) == 0.75
+    assert scheduler.time_to_next(now=200) == 0
+
+
+def test_jitter_spreads_checks_within_limit():
+    scheduler = PollScheduler([PERSON], min_interval=10, max_interval=10, jitter=0.1, seed=1)
+    checks = set()
+    for _ in range(50):
+        scheduler.record(PERSON, False, now=0)
+        next_check = scheduler.schedules['content.person'].next_check
+        assert 9 <= next_check <= 11
+        checks.add(next_check)
+    assert len(checks) > 1
@@ -0,0 +1,65 @@
+import json
+import uuid
+from datetime import datetime
+
+import pytest
+
+from postgres_to_es import serializer
+from postgres_to_es.serializer import BulkPayload, bulk_has_errors, dumps
+
+DOCUMENTS = [
+    {'id': str(uuid.UUID(int=i)), 'title': f'Фильм "{i}"\n', 'rating': 7.5, 'genre': ['Drama'],
+     'actors': [{'id': str(uuid.UUID(int=i + 100)), 'name': 'Актер \\ Фамилия'}], 'description': None}
+    for i in range(5)
+]
+
+
+def make_payload() -> BulkPayload:
+    payload = BulkPayload()
+    for document in DOCUMENTS:
+        payload.add(document['id'], {'index': {'_index': 'movies', '_id': document['id']}}, document)
+    payload.add('deleted', {'delete': {'_index': 'movies', '_id': 'deleted'}})
+    return payload
+
+
+def parse_body(body) -> list:
+    return [json.loads(line) for line in bytes(body).splitlines()]
+
+
+def test_contiguous_operations_are_sliced_without_copy():
+    payload = make_payload()
+    body = payload.body(payload.operations[1:4])
+    assert isinstance(body, memoryview)
+    assert parse_body(body) == [line for document in DOCUMENTS[1:4]
+                                for line in ({'index': {'_index': 'movies', '_id': document['id']}}, document)]
+
+
+def test_non_contiguous_operations_are_joined():
+    payload = make_payload()
+    body = payload.body([payload.operations[0], payload.operations[2], payload.operations[-1]])
+    assert isinstance(body, bytes)
+    assert parse_body(body) == [{'index': {'_index': 'movies', '_id': DOCUMENTS[0]['id']}}, DOCUMENTS[0],
+                                {'index': {'_index': 'movies', '_id': DOCUMENTS[2]['id']}}, DOCUMENTS[2],
+                                {'delete': {'_index': 'movies', '_id': 'deleted'}}]
+
+
+@pytest.mark.skipif(serializer.orjson is None, reason='orjson не установлен')
+def test_stdlib_output_matches_orjson(monkeypatch):
+    with_orjson = bytes(make_payload().buffer)
+    value = {'updated_at': datetime(2021, 10, 1, 12, 30), 'id': uuid.UUID(int=1)}
+    orjson_value = dumps(value)
+    monkeypatch.setattr(serializer, 'orjson', None)
+    assert bytes(make_payload().buffer) == with_orjson
+    assert json.loads(dumps(value)) == json.loads(orjson_value)
+
+
+def test_stdlib_serializes_unknown_types_as_strings(monkeypatch):
+    monkeypatch.setattr(serializer, 'orjson', None)
+    assert dumps({'id': uuid.UUID(int=1), 'name': 'Жанр'}) == \
+        '{"id":"00000000-0000-0000-0000-000000000001","name":"Жанр"}'.encode()
+
+
+def test_bulk_errors_are_detected_by_response_head():
+    assert not bulk_has_errors(b'{"took":3,"errors":false,"items":[{"index":{"error":"in item text"}}]}')
+    assert not bulk_has_errors(b'{"took": 3, "errors" : false, "items": []}')
+    assert bulk_has_errors(b'{"took":3,"errors":true,"items":[]}')
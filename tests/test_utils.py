@@ -0,0 +1,97 @@
+import json
+import os
+
+import pytest
+
+from postgres_to_es.utils import (BaseStorage, JsonFileStorage, SqliteStorage,
+                                  State)
+
+
+class MemoryStorage(BaseStorage):
+    """Хранилище в памяти, запоминающее сохраненные ключи"""
+
+    def __init__(self, state: dict = None):
+        self.state = dict(state or {})
+        self.saved_keys = []
+
+    def save_state(self, state: dict) -> None:
+        self.state = dict(state)
+
+    def save_keys(self, state: dict, keys) -> None:
+        self.saved_keys.append(sorted(keys))
+        self.state.update((key, state[key]) for key in keys)
+
+    def retrieve_state(self) -> dict:
+        return dict(self.state)
+
+
+def test_state_is_flushed_in_batches():
+    storage = MemoryStorage({'a': 1})
+    state = State(storage, flush_interval=3600)
+    state.set_state('a', 1)
+    state.set_state('b', 2)
+    state.set_state('c', 3)
+    assert state.get_state('b') == 2
+    assert storage.saved_keys == []
+    state.flush()
+    assert storage.saved_keys == [['b', 'c']]
+    # неизмененное значение не сохраняется повторно
+    state.set_state('b', 2)
+    state.close()
+    assert storage.saved_keys == [['b', 'c']]
+    assert storage.state == {'a': 1, 'b': 2, 'c': 3}
+
+
+def test_state_is_saved_on_every_change_without_interval():
+    storage = MemoryStorage()
+    state = State(storage)
+    state.set_state('a', 1)
+    state.set_state('a', 2)
+    assert storage.saved_keys == [['a'], ['a']]
+
+
+def test_reload_keeps_unsaved_changes(tmp_path):
+    path = str(tmp_path / 'state.db')
+    state = State(SqliteStorage(path), flush_interval=3600)
+    other = State(SqliteStorage(path))
+    state.set_state('own', 'local')
+    other.set_state('own', 'other')
+    other.set_state('shared', 'other')
+    state.reload()
+    assert state.get_state('own') == 'local'
+    assert state.get_state('shared') == 'other'
+    state.close()
+    other.reload()
+    assert other.get_state('own') == 'local'
+    other.close()
+
+
+def test_sqlite_storage_saves_only_given_keys(tmp_path):
+    storage = SqliteStorage(str(tmp_path / 'state.db'))
+    storage.save_state({'a': {'updated_at': '2021-10-01T00:00:00', 'id': 'x'}, 'b': [1, 2]})
+    storage.save_keys({'a': None, 'b': [3], 'c': True}, ['b', 'c'])
+    assert storage.retrieve_state() == {'a': {'updated_at': '2021-10-01T00:00:00', 'id': 'x'}, 'b': [3], 'c': True}
+    storage.save_state({'c': False})
+    assert storage.retrieve_state() == {'c': False}
+    storage.close()
+
+
+def test_json_storage_keeps_previous_file_when_write_fails(tmp_path):
+    path = str(tmp_path / 'state.json')
+    storage = JsonFileStorage(path)
+    storage.save_state({'a': 1})
+    with pytest.raises(TypeError):
+        storage.save_state({'a': 2, 'b': object()})
+    assert storage.retrieve_state() == {'a': 1}
+    storage.save_state({'a': 3})
+    assert storage.retrieve_state() == {'a': 3}
+    assert not os.path.exists(f'{path}.tmp')
+
+
+def test_json_storage_resets_corrupted_file(tmp_path):
+    path = tmp_path / 'state.json'
+    assert JsonFileStorage(str(path)).retrieve_state() == {}
+    path.write_text('{"a": ')
+    assert JsonFileStorage(str(path)).retrieve_state() == {}
+    path.write_text(json.dumps({'a': 1}))
+    assert JsonFileStorage(str(path)).retrieve_state() == {'a': 1}
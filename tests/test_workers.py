@@ -0,0 +1,92 @@
+import argparse
+import time
+
+import psycopg2
+import pytest
+from psycopg2.extras import DictCursor
+
+from benchmarks.bench_workers import (EXPECTED_FILMS_REQUEST, INDEX, query,
+                                      reset_state, start_workers, stop_workers,
+                                      wait_balanced)
+from benchmarks.fake_es import FakeElasticsearch
+from benchmarks.synthetic_data import generate
+from postgres_to_es.extract import FILM_REQUEST_PREPARE
+
+FILMS = 2000
+TIMEOUT = 120
+
+
+def update_films(settings: dict, version: str, films: int, persons: int) -> None:
+    """
+    Изменяем названия фильмов и имена людей, к названию добавляется версия изменения
+    :param settings: настройки подключения к тестовой БД
+    :param version: версия изменения
+    :param films: количество измененных фильмов
+    :param persons: количество измененных людей
+    :return:
+    """
+    connection = psycopg2.connect(**settings)
+    try:
+        with connection, connection.cursor() as cursor:
+            for table, column, count in (('content.film_work', 'title', films),
+                                         ('content.person', 'full_name', persons)):
+                cursor.execute(f'UPDATE {table} SET {column} = {column} || %(version)s, updated_at = now() '
+                               f'WHERE id IN (SELECT id FROM {table} ORDER BY md5(id::text || %(version)s) '
+                               f'LIMIT %(count)s)', {'version': f' {version}', 'count': count})
+    finally:
+        connection.close()
+
+
+def get_stale_films(settings: dict, es: FakeElasticsearch, films_id: set) -> set:
+    """
+    Фильмы, документы которых в ES не совпадают с текущими данными в БД
+    :param settings: настройки подключения к тестовой БД
+    :param es: замена Elasticsearch
+    :param films_id: множество id фильмов
+    :return: множество id фильмов
+    """
+    connection = psycopg2.connect(**settings)
+    try:
+        with connection, connection.cursor(cursor_factory=DictCursor) as cursor:
+            cursor.execute(FILM_REQUEST_PREPARE, {'films_id': tuple(films_id)})
+            films = {str(row['id']): (row['title'], sorted(row['actors_names'])) for row in cursor.fetchall()}
+    finally:
+        connection.close()
+    with es.lock:
+        docs = dict(es.indices.get(INDEX, {}).get('docs', {}))
+    return {film_id for film_id, film in films.items()
+            if film_id not in docs or (docs[film_id]['title'], sorted(docs[film_id]['actors_names'])) != film}
+
+
+@pytest.mark.postgres
+def test_killed_worker_partitions_are_loaded(postgres_settings, tmp_path):
+    args = argparse.Namespace(db_name=postgres_settings['dbname'], partitions=8, batch_size=50,
+                              log=str(tmp_path / 'workers.log'))
+    generate(postgres_settings, FILMS, seed=1)
+    es = FakeElasticsearch(latency=0.005).start()
+    watermark = reset_state(postgres_settings)
+    workers = start_workers(2, es, args)
+    try:
+        wait_balanced(postgres_settings, 2, args)
+        update_films(postgres_settings, 'v1', films=FILMS // 2, persons=200)
+        expected = {str(row[0]) for row in query(postgres_settings, EXPECTED_FILMS_REQUEST, watermark)}
+        # экземпляр завершается посреди загрузки, его партиции должен забрать оставшийся экземпляр
+        deadline = time.monotonic() + TIMEOUT
+        while time.monotonic() < deadline:
+            with es.lock:
+                written = len(expected & set(es.writes))
+            if written * 2 >= len(expected):
+                break
+            time.sleep(0.01)
+        workers[-1].kill()
+        update_films(postgres_settings, 'v2', films=FILMS // 4, persons=100)
+        expected = {str(row[0]) for row in query(postgres_settings, EXPECTED_FILMS_REQUEST, watermark)}
+        stale = expected
+        while stale and time.monotonic() < deadline:
+            time.sleep(0.5)
+            stale = get_stale_films(postgres_settings, es, expected)
+        assert workers[0].poll() is None
+    finally:
+        stop_workers(workers)
+        es.shutdown()
+    assert not stale, f'{len(stale)} из {len(expected)} фильмов не загружены в последней версии'